@@ -0,0 +1,11 @@
+file(REMOVE_RECURSE
+  "CMakeFiles/real_space_electrostatic_sum.dir/source/c_real_space_electrostatic_sum.f90.o"
+  "CMakeFiles/real_space_electrostatic_sum.dir/source/real_space_electrostatic_sum.f90.o"
+  "libreal_space_electrostatic_sum.pdb"
+  "libreal_space_electrostatic_sum.so"
+)
+
+# Per-language clean rules from dependency scanning.
+foreach(lang Fortran)
+  include(CMakeFiles/real_space_electrostatic_sum.dir/cmake_clean_${lang}.cmake OPTIONAL)
+endforeach()
@@ -0,0 +1,10 @@
+# Remove fortran modules provided by this target.
+FILE(REMOVE
+  "c_real_space_electrostatic_sum.mod"
+  "C_REAL_SPACE_ELECTROSTATIC_SUM.mod"
+  "CMakeFiles/real_space_electrostatic_sum.dir/c_real_space_electrostatic_sum.mod.stamp"
+
+  "real_space_electrostatic_sum.mod"
+  "REAL_SPACE_ELECTROSTATIC_SUM.mod"
+  "CMakeFiles/real_space_electrostatic_sum.dir/real_space_electrostatic_sum.mod.stamp"
+  )
@@ -1,6 +1,8 @@
 #ifndef __C_REAL_SPACE_ELECTROSTATIC_SUM_H__
 #define __C_REAL_SPACE_ELECTROSTATIC_SUM_H__
 
+#include <cstdint>
+
 extern "C"
 void c_real_space_electrostatic_sum_energy(
         const double* a1, const double* a2, const double* a3,
@@ -31,4 +33,233 @@ void c_real_space_electrostatic_sum_stress(
         const double* rd,
         double* s);
 
+extern "C"
+void c_real_space_electrostatic_sum_energy_force_stress(
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        const int* do_e, const int* do_f, const int* do_s,
+        double* e,
+        double* fx, double* fy, double* fz,
+        double* s);
+
+// single-precision variant of c_real_space_electrostatic_sum_energy_force_stress,
+// for screening; relative errors are about 1e-6
+extern "C"
+void c_real_space_electrostatic_sum_energy_force_stress_f32(
+        const float* a1, const float* a2, const float* a3,
+        const int* num,
+        const float* rx, const float* ry, const float* rz,
+        const float* z,
+        const float* rc,
+        const float* rd,
+        const int* do_e, const int* do_f, const int* do_s,
+        float* e,
+        float* fx, float* fy, float* fz,
+        float* s);
+
+// contributions of ions i0 to i1-1 (zero-based) to the energy and stress,
+// and their forces (fx, fy, fz have length i1-i0); summing e and s over
+// ranges that partition the ions gives the totals; only the pair sums are
+// split, as binning the images still scans all num ions for every range.
+// unless 0 <= i0 <= i1 <= num, nothing is computed and e and s are nan
+extern "C"
+void c_real_space_electrostatic_sum_energy_force_stress_range(
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        const int* i0, const int* i1,
+        const int* do_e, const int* do_f, const int* do_s,
+        double* e,
+        double* fx, double* fy, double* fz,
+        double* s);
+
+// same as c_real_space_electrostatic_sum_energy_force_stress, but with the
+// lattice vectors as the rows of a[3][3] and with positions r[num][3] and
+// forces f[num][3] stored in row-major (x, y, z) order
+extern "C"
+void c_real_space_electrostatic_sum_energy_force_stress_xyz(
+        const double* a,
+        const int* num,
+        const double* r,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        const int* do_e, const int* do_f, const int* do_s,
+        double* e,
+        double* f,
+        double* s);
+
+// energies for num_cutoffs pairs (rc[k], rd[k]) from a single pass
+extern "C"
+void c_real_space_electrostatic_sum_energy_sweep(
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const int* num_cutoffs,
+        const double* rc,
+        const double* rd,
+        double* e);
+
+// batch of frames in a packed layout: frame k has num[k] ions and lattice
+// vectors a[9*k:9*k+3], a[9*k+3:9*k+6], a[9*k+6:9*k+9]; its ions follow
+// those of the preceding frames in rx, ry, rz, z, fx, fy, and fz
+extern "C"
+void c_real_space_electrostatic_sum_energy_force_stress_batch(
+        const int* num_frames,
+        const int* num,
+        const double* a,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        const int* do_e, const int* do_f, const int* do_s,
+        double* e,
+        double* fx, double* fy, double* fz,
+        double* s);
+
+// persistent neighbor list (opaque handle), rebuilt only when an ion has
+// moved by more than skin/2 or the lattice or cutoff has changed
+extern "C"
+void c_real_space_electrostatic_sum_neighbor_list_create(
+        const double* skin,
+        void** nl);
+
+extern "C"
+void c_real_space_electrostatic_sum_neighbor_list_destroy(
+        void** nl);
+
+extern "C"
+void c_real_space_electrostatic_sum_neighbor_list_energy_force_stress(
+        void* nl,
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        const int* do_e, const int* do_f, const int* do_s,
+        double* e,
+        double* fx, double* fy, double* fz,
+        double* s);
+
+extern "C"
+void c_real_space_electrostatic_sum_neighbor_list_num_builds(
+        void* nl,
+        int* num_builds);
+
+// monte carlo state (opaque handle): the energy change of a proposed move of
+// one ion, or swap of the charges of two ions, is computed from the terms
+// involving the affected ions only; indices are zero-based, and a proposal
+// with an index outside [0, num) is ignored and returns de = nan
+extern "C"
+void c_real_space_electrostatic_sum_mc_create(
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* z,
+        const double* rc,
+        const double* rd,
+        void** mc);
+
+extern "C"
+void c_real_space_electrostatic_sum_mc_destroy(
+        void** mc);
+
+extern "C"
+void c_real_space_electrostatic_sum_mc_propose_move(
+        void* mc,
+        const int* k,
+        const double* x, const double* y, const double* z,
+        double* de);
+
+extern "C"
+void c_real_space_electrostatic_sum_mc_propose_swap(
+        void* mc,
+        const int* k, const int* l,
+        double* de);
+
+extern "C"
+void c_real_space_electrostatic_sum_mc_accept(
+        void* mc);
+
+extern "C"
+void c_real_space_electrostatic_sum_mc_energy(
+        void* mc,
+        double* e);
+
+// pair terms of a fixed geometry (opaque handle), for energies of many charge
+// vectors; returns the energy, the potential v[num] of the pair terms at each
+// ion, and the derivative dedz[num] of the energy with respect to each charge
+extern "C"
+void c_real_space_electrostatic_sum_site_matrix_create(
+        const double* a1, const double* a2, const double* a3,
+        const int* num,
+        const double* rx, const double* ry, const double* rz,
+        const double* rc,
+        const double* rd,
+        void** sm);
+
+extern "C"
+void c_real_space_electrostatic_sum_site_matrix_destroy(
+        void** sm);
+
+extern "C"
+void c_real_space_electrostatic_sum_site_matrix_energy(
+        void* sm,
+        const double* z,
+        double* e,
+        double* v,
+        double* dedz);
+
+// tolerance for interpolated erfc/exp in the energy, force, and stress
+// kernels (<= 0, the default, for exact evaluation). the tolerance bounds the
+// interpolated functions, not the energy, forces, or stress. tables are
+// limited in size, so very small tolerances may not be reached; get_table_error
+// returns the error achieved by the tables of the most recent kernel call
+extern "C"
+void c_real_space_electrostatic_sum_set_table_tolerance(const double* tol);
+
+extern "C"
+void c_real_space_electrostatic_sum_get_table_tolerance(double* tol);
+
+extern "C"
+void c_real_space_electrostatic_sum_get_table_error(double* err);
+
+// instrumentation, accumulated over calls while enabled (disabled by
+// default, in which case the kernels do no counting or timing). times are in
+// seconds and are summed over concurrent calls, e.g. the frames of a batch.
+struct c_real_space_electrostatic_sum_stats {
+    int64_t num_calls;       // kernel calls
+    int64_t num_images;      // periodic images visited while binning
+    int64_t num_candidates;  // candidate pairs tested against rc
+    int64_t num_pairs;       // pairs accepted within rc
+    double setup_time;       // binning, neighbor lists, and tables
+    double pair_time;        // loop over pairs
+    double correction_time;  // correction terms
+};
+
+extern "C"
+void c_real_space_electrostatic_sum_set_stats_enabled(const int* enabled);
+
+extern "C"
+void c_real_space_electrostatic_sum_get_stats(
+        c_real_space_electrostatic_sum_stats* stats);
+
+extern "C"
+void c_real_space_electrostatic_sum_reset_stats();
+
+extern "C"
+void c_real_space_electrostatic_sum_set_num_threads(const int* num_threads);
+
+extern "C"
+void c_real_space_electrostatic_sum_get_num_threads(int* num_threads);
+
 #endif // __C_REAL_SPACE_ELECTROSTATIC_SUM_H
@@ -0,0 +1,306 @@
+# MIT License
+#
+# Copyright (c) 2019-2020 William C. Witt
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Headless benchmark suite for the energy, force, and stress routines.
+
+Supercells of the Al, Si, SiO2, and Al2SiO5 cells from the test set are
+timed for a range of cutoffs, cell skewness, and thread counts. Each case
+runs in a fresh process, so its peak memory can be measured, and the results
+are written as JSON for comparison between builds. For example:
+
+    python python/benchmark.py --sizes 1 2 3 --threads 1 4 -o results.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import real_space_electrostatic_sum
+
+#______________________________________________________________________________
+#                                                               structures
+
+def structures():
+    """Return the test structures as {name: (a, frac, z, h_max)}.
+
+    a has the lattice vectors as rows and frac holds fractional coordinates.
+    h_max is the value used with the cutoff heuristic in the test set.
+    """
+
+    s = {}
+
+    # Al
+    a = np.array([[5.41141973394663, 0.00000000000000, 0.00000000000000],
+                  [2.70570986697332, 4.68642696013821, 0.00000000000000],
+                  [2.70570986697332, 1.56214232004608, 4.41840571073226]])
+    frac = np.zeros([1,3])
+    z = 3.0 * np.ones(frac.shape[0])
+    s['Al'] = (a, frac, z, 4.42)
+
+    # Si
+    a = np.array([[7.25654832321381, 0.00000000000000, 0.00000000000000],
+                  [3.62827416160690, 6.28435519169252, 0.00000000000000],
+                  [3.62827416160690, 2.09478506389751, 5.92494689524090]])
+    frac = np.array([[0.0,  0.0,  0.0],
+                     [0.25, 0.25, 0.25]])
+    z = 4.0 * np.ones(frac.shape[0])
+    s['Si'] = (a, frac, z, 5.92)
+
+    # SiO2
+    a = np.array([[ 9.28422445623683, 0.00000000000000, 0.00000000000000],
+                  [-4.64211222811842, 8.04037423353787, 0.00000000000000],
+                  [ 0.00000000000000, 0.00000000000000, 10.2139697101486]])
+    frac = np.array([[0.41500, 0.27200, 0.21300],
+                     [0.72800, 0.14300, 0.54633],
+                     [0.85700, 0.58500, 0.87967],
+                     [0.27200, 0.41500, 0.78700],
+                     [0.14300, 0.72800, 0.45367],
+                     [0.58500, 0.85700, 0.12033],
+                     [0.46500, 0.00000, 0.33333],
+                     [0.00000, 0.46500, 0.66667],
+                     [0.53500, 0.53500, 0.00000]])
+    z = 6.0 * np.ones(frac.shape[0]) # most are O
+    z[6:] = 4.0                      # three are Si
+    s['SiO2'] = (a, frac, z, 10.21)
+
+    # Al2SiO5
+    a = np.array([[14.7289033699982, 0.00000000000000, 0.00000000000000],
+                  [0.00000000000000, 14.9260018049230, 0.00000000000000],
+                  [0.00000000000000, 0.00000000000000, 10.5049875335275]])
+    frac = np.array([[0.23030, 0.13430, 0.23900],
+                     [0.76970, 0.86570, 0.23900],
+                     [0.26970, 0.63430, 0.26100],
+                     [0.73030, 0.36570, 0.26100],
+                     [0.76970, 0.86570, 0.76100],
+                     [0.23030, 0.13430, 0.76100],
+                     [0.73030, 0.36570, 0.73900],
+                     [0.26970, 0.63430, 0.73900],
+                     [0.00000, 0.00000, 0.24220],
+                     [0.50000, 0.50000, 0.25780],
+                     [0.00000, 0.00000, 0.75780],
+                     [0.50000, 0.50000, 0.74220],
+                     [0.37080, 0.13870, 0.50000],
+                     [0.42320, 0.36270, 0.50000],
+                     [0.62920, 0.86130, 0.50000],
+                     [0.57680, 0.63730, 0.50000],
+                     [0.12920, 0.63870, 0.00000],
+                     [0.07680, 0.86270, 0.00000],
+                     [0.87080, 0.36130, 0.00000],
+                     [0.92320, 0.13730, 0.00000],
+                     [0.24620, 0.25290, 0.00000],
+                     [0.42400, 0.36290, 0.00000],
+                     [0.10380, 0.40130, 0.00000],
+                     [0.75380, 0.74710, 0.00000],
+                     [0.57600, 0.63710, 0.00000],
+                     [0.89620, 0.59870, 0.00000],
+                     [0.25380, 0.75290, 0.50000],
+                     [0.07600, 0.86290, 0.50000],
+                     [0.39620, 0.90130, 0.50000],
+                     [0.74620, 0.24710, 0.50000],
+                     [0.92400, 0.13710, 0.50000],
+                     [0.60380, 0.09870, 0.50000]])
+    z = 6.0 * np.ones(frac.shape[0]) # most are O
+    z[8:13]  = 3.0                   # eight are Al
+    z[14] = 3.0
+    z[16] = 3.0
+    z[18] = 3.0
+    z[20] = 4.0                      # four are Si
+    z[23] = 4.0
+    z[26] = 4.0
+    z[29] = 4.0
+    s['Al2SiO5'] = (a, frac, z, 14.93)
+
+    return s
+
+def supercell(a, frac, z, size, skew=0):
+    """Return (a, r, z) for a size x size x size supercell.
+
+    With an integer skew > 0, the supercell vectors are replaced by the
+    equivalent vectors a2 + skew*a1 and a3 + skew*(a1 + a2), so the crystal,
+    volume, and number of ions are unchanged but the cell is less orthogonal.
+    """
+
+    shifts = np.array(list(itertools.product(range(size), repeat=3)))
+    frac = ((frac[None,:,:] + shifts[:,None,:]) / size).reshape(-1, 3)
+    z = np.tile(z, shifts.shape[0])
+    a = size * a
+    r = frac.dot(a)
+    a[1] += skew * a[0]
+    a[2] += skew * (a[0] + a[1])
+    frac = r.dot(np.linalg.inv(a))
+    return a, (frac - np.floor(frac)).dot(a), z
+
+#______________________________________________________________________________
+#                                                                    cases
+
+quantities = {'energy': (True, False, False),
+              'force': (False, True, False),
+              'stress': (False, False, True),
+              'all': (True, True, True)}
+
+def run_case(case, repeat):
+    """Time a single case in the current process and return its results."""
+
+    real_space_electrostatic_sum.set_num_threads(case['threads'])
+    baseline_rss = _peak_rss()
+
+    # build the structure and cutoffs
+    a, frac, z, h_max = structures()[case['structure']]
+    a, r, z = supercell(a, frac, z, case['size'], case['skew'])
+    rc = 3.0 * case['r_d_hat']**2 * h_max
+    rd = case['r_d_hat'] * h_max
+    calc = real_space_electrostatic_sum.Calculator(rc, rd)
+    e, f, s = quantities[case['quantity']]
+
+    # time repeated evaluations (the first also loads the library)
+    calc.energy_force_stress(a, r, z, e, f, s)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        calc.energy_force_stress(a, r, z, e, f, s)
+        times.append(time.perf_counter() - start)
+
+    # one more (untimed) evaluation with the instrumentation enabled, for
+    # the number of pairs and the breakdown of the time
+    real_space_electrostatic_sum.reset_stats()
+    real_space_electrostatic_sum.set_stats_enabled(True)
+    calc.energy_force_stress(a, r, z, e, f, s)
+    real_space_electrostatic_sum.set_stats_enabled(False)
+    stats = real_space_electrostatic_sum.get_stats()
+
+    result = dict(case)
+    result.update(
+            num_ions=r.shape[0], rc=rc, rd=rd,
+            num_threads=real_space_electrostatic_sum.get_num_threads(),
+            wall_time_min=min(times),
+            wall_time_median=float(np.median(times)),
+            pairs=stats['num_pairs'],
+            pairs_per_second=stats['num_pairs'] / min(times),
+            stats=stats,
+            peak_rss_mb=_peak_rss(),
+            baseline_rss_mb=baseline_rss)
+    return result
+
+def _peak_rss():
+    # peak resident set size of this process in MB (ru_maxrss is in kB on
+    # linux and in bytes on macos)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0**2 if sys.platform == 'darwin' else 1024.0)
+
+def _run_case_in_child(conn, case, repeat):
+    try:
+        conn.send(run_case(case, repeat))
+    except Exception as err:
+        conn.send({'error': repr(err)})
+    conn.close()
+
+def run_isolated(case, repeat, context):
+    """Run a case in a fresh process, so that peak memory is per case."""
+
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case_in_child,
+                              args=(send, case, repeat))
+    process.start()
+    send.close()
+    result = receive.recv()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('case {} failed: {}'.format(case, result['error']))
+    return result
+
+#______________________________________________________________________________
+#                                                                     main
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--structures', nargs='+',
+                        default=['Al', 'Si', 'SiO2', 'Al2SiO5'],
+                        choices=['Al', 'Si', 'SiO2', 'Al2SiO5'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 2],
+                        help='supercell sizes (repetitions along each axis)')
+    parser.add_argument('--r-d-hat', nargs='+', type=float, default=[1.0, 1.5],
+                        help='rd = r_d_hat*h_max and rc = 3*r_d_hat**2*h_max')
+    parser.add_argument('--skew', nargs='+', type=int, default=[0, 1],
+                        help='integer shear of the supercell vectors')
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument('--quantities', nargs='+', default=list(quantities),
+                        choices=list(quantities))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed evaluations per case')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run all cases in this process (peak memory '
+                             'is then cumulative)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else 'spawn')
+    results = []
+    for structure, size, r_d_hat, skew, threads, quantity in itertools.product(
+            args.structures, args.sizes, args.r_d_hat, args.skew,
+            args.threads, args.quantities):
+        case = dict(structure=structure, size=size, r_d_hat=r_d_hat,
+                    skew=skew, threads=threads, quantity=quantity)
+        if args.in_process:
+            result = run_case(case, args.repeat)
+        else:
+            result = run_isolated(case, args.repeat, context)
+        results.append(result)
+        print('{structure:>8} size={size} r_d_hat={r_d_hat} skew={skew} '
+              'threads={threads} {quantity:>6}: {wall_time_min:.4g} s, '
+              '{pairs_per_second:.3g} pairs/s, {peak_rss_mb:.1f} MB'.format(
+                    **result), file=sys.stderr)
+
+    report = {
+        'metadata': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'library': real_space_electrostatic_sum._library_path,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
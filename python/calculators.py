@@ -0,0 +1,213 @@
+# MIT License
+#
+# Copyright (c) 2019-2020 William C. Witt
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Calculators that serve repeated requests for a structure from a cache.
+
+Drivers such as optimizers often ask for the energy, forces, and stress of
+one structure in separate calls. Here the first request computes all three
+in a single fused call, and the results are stored under a hash of the
+lattice, positions, charges, and cutoffs, so later requests for the same
+structure are served without another evaluation. The cache holds the most
+recently used structures, up to a fixed number.
+
+CachedCalculator works with arrays; ASECalculator follows the calculator
+interface of ASE (without importing it).
+"""
+
+import collections
+import hashlib
+
+import numpy as np
+
+import real_space_electrostatic_sum
+
+# e**2/(4*pi*epsilon_0) in eV*angstrom, converting energies computed from
+# positions in angstrom (and charges in units of e) to eV
+coulomb_constant = 14.399645351950548
+
+#______________________________________________________________________________
+#                                                                    cache
+
+class ResultCache:
+    """Least-recently-used store of (e, f, s), keyed on the inputs."""
+
+    def __init__(self, maxsize=16):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def key(a, r, z, rc, rd):
+        """Return a hash of the lattice, positions, charges, and cutoffs."""
+        h = hashlib.blake2b(digest_size=20)
+        for x in (a, r, z, np.array((rc, rd))):
+            x = np.ascontiguousarray(x, dtype=np.float64)
+            h.update(repr(x.shape).encode())
+            h.update(x.tobytes())
+        return h.digest()
+
+    def get(self, key):
+        """Return the results stored under key (or None)."""
+        results = self._results.get(key)
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._results.move_to_end(key)
+        return results
+
+    def put(self, key, results):
+        """Store results under key, evicting the least recently used."""
+        self._results[key] = results
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        """Forget all results."""
+        self._results.clear()
+
+#______________________________________________________________________________
+#                                                                   arrays
+
+class CachedCalculator:
+    """Energy, forces, and stress with a cache of recent structures.
+
+    Lattices are given as (3, 3) arrays with the lattice vectors as rows,
+    positions as (n, 3) arrays, and forces are returned as (n, 3) arrays.
+    Returned arrays are read-only, as they are shared with the cache.
+    """
+
+    def __init__(self, rc, rd, maxsize=16):
+        self.rc = rc
+        self.rd = rd
+        self.cache = ResultCache(maxsize)
+        self._calc = real_space_electrostatic_sum.Calculator(rc, rd)
+
+    def energy_force_stress(self, a, r, z):
+        """Return (e, f, s), from the cache if possible."""
+        key = ResultCache.key(a, r, z, self.rc, self.rd)
+        results = self.cache.get(key)
+        if results is None:
+            # compute everything in one call, into arrays owned by the cache
+            n = np.shape(r)[0]
+            f = np.zeros((n, 3))
+            s = np.zeros(6)
+            e, _, _ = self._calc.energy_force_stress(
+                    a, r, z, out_force=f, out_stress=s)
+            f.flags.writeable = False
+            s.flags.writeable = False
+            results = (e, f, s)
+            self.cache.put(key, results)
+        return results
+
+    def energy(self, a, r, z):
+        return self.energy_force_stress(a, r, z)[0]
+
+    def force(self, a, r, z):
+        return self.energy_force_stress(a, r, z)[1]
+
+    def stress(self, a, r, z):
+        return self.energy_force_stress(a, r, z)[2]
+
+#______________________________________________________________________________
+#                                                                      ase
+
+class ASECalculator:
+    """Calculator for ASE Atoms objects.
+
+    Positions and cutoffs are in angstrom, and the results are in eV,
+    eV/angstrom, and eV/angstrom**3 (with the stress in Voigt order xx, yy,
+    zz, yz, xz, xy, as ASE expects). The charges are taken from the initial
+    charges of the atoms unless given here. Only fully periodic cells are
+    supported.
+    """
+
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+
+    def __init__(self, rc, rd, charges=None, maxsize=16):
+        self.rc = rc
+        self.rd = rd
+        self.charges = None if charges is None else np.array(charges, float)
+        self.calc = CachedCalculator(rc, rd, maxsize)
+        self.atoms = None
+        self.results = {}
+
+    def calculate(self, atoms=None, properties=None, system_changes=None):
+        """Compute (or fetch) all properties of atoms into self.results."""
+        if atoms is None:
+            atoms = self.atoms
+        if atoms is None:
+            raise ValueError('no atoms to compute')
+        if not np.all(atoms.pbc):
+            raise ValueError('only fully periodic cells are supported')
+        a = np.asarray(atoms.get_cell())
+        r = atoms.get_positions()
+        z = (atoms.get_initial_charges() if self.charges is None
+             else self.charges)
+        e, f, s = self.calc.energy_force_stress(a, r, z)
+        self.atoms = atoms.copy()
+        self.results = {'energy': coulomb_constant * e,
+                        'free_energy': coulomb_constant * e,
+                        'forces': coulomb_constant * f,
+                        'stress': coulomb_constant * s}
+
+    def get_property(self, name, atoms=None, allow_calculation=True):
+        if name not in self.implemented_properties:
+            raise ValueError('{} is not implemented'.format(name))
+        if atoms is None:
+            atoms = self.atoms
+        if self.calculation_required(atoms, [name]):
+            if not allow_calculation:
+                return None
+            self.calculate(atoms)
+        result = self.results[name]
+        return result.copy() if isinstance(result, np.ndarray) else result
+
+    def calculation_required(self, atoms, properties):
+        # results are current if they are for the same structure (the cache
+        # serves any earlier structure without another evaluation)
+        if not self.results or atoms is None or self.atoms is None:
+            return True
+        return not (len(atoms) == len(self.atoms)
+                    and np.array_equal(np.asarray(atoms.get_cell()),
+                                       np.asarray(self.atoms.get_cell()))
+                    and np.array_equal(atoms.get_positions(),
+                                       self.atoms.get_positions())
+                    and np.array_equal(atoms.get_initial_charges(),
+                                       self.atoms.get_initial_charges()))
+
+    def get_potential_energy(self, atoms=None, force_consistent=False):
+        return self.get_property(
+                'free_energy' if force_consistent else 'energy', atoms)
+
+    def get_forces(self, atoms=None):
+        return self.get_property('forces', atoms)
+
+    def get_stress(self, atoms=None):
+        return self.get_property('stress', atoms)
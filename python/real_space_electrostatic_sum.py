@@ -27,56 +27,402 @@ import numpy as np
 #______________________________________________________________________________
 #                                                             ctypes setup
 
-# load library
-lib = ct.cdll.LoadLibrary(os.path.dirname(os.path.abspath(__file__)) 
-                            + '/../build/libreal_space_electrostatic_sum.so')
-
-# set argtypes and restype for 'c_real_space_electrostatic_sum_energy'
-lib.c_real_space_electrostatic_sum_energy.argtypes = [
-        ct.POINTER(ct.c_double), # a1
-        ct.POINTER(ct.c_double), # a2
-        ct.POINTER(ct.c_double), # a3
-        ct.POINTER(ct.c_int),    # n
-        ct.POINTER(ct.c_double), # rx
-        ct.POINTER(ct.c_double), # ry
-        ct.POINTER(ct.c_double), # rz
-        ct.POINTER(ct.c_double), # z
-        ct.POINTER(ct.c_double), # rc
-        ct.POINTER(ct.c_double), # rd
-        ct.POINTER(ct.c_double)] # e
-lib.c_real_space_electrostatic_sum_energy.restype = None
-
-# set argtypes and restype for 'c_real_space_electrostatic_sum_force'
-lib.c_real_space_electrostatic_sum_force.argtypes = [
-        ct.POINTER(ct.c_double), # a1
-        ct.POINTER(ct.c_double), # a2
-        ct.POINTER(ct.c_double), # a3
-        ct.POINTER(ct.c_int),    # n
-        ct.POINTER(ct.c_double), # rx
-        ct.POINTER(ct.c_double), # ry
-        ct.POINTER(ct.c_double), # rz
-        ct.POINTER(ct.c_double), # z
-        ct.POINTER(ct.c_double), # rc
-        ct.POINTER(ct.c_double), # rd
-        ct.POINTER(ct.c_double), # fx
-        ct.POINTER(ct.c_double), # fy
-        ct.POINTER(ct.c_double)] # fz
-lib.c_real_space_electrostatic_sum_force.restype = None
-
-# set argtypes and restype for 'c_real_space_electrostatic_sum_stress'
-lib.c_real_space_electrostatic_sum_stress.argtypes = [
-        ct.POINTER(ct.c_double), # a1
-        ct.POINTER(ct.c_double), # a2
-        ct.POINTER(ct.c_double), # a3
-        ct.POINTER(ct.c_int),    # n
-        ct.POINTER(ct.c_double), # rx
-        ct.POINTER(ct.c_double), # ry
-        ct.POINTER(ct.c_double), # rz
-        ct.POINTER(ct.c_double), # z
-        ct.POINTER(ct.c_double), # rc
-        ct.POINTER(ct.c_double), # rd
-        ct.POINTER(ct.c_double)] # s
-lib.c_real_space_electrostatic_sum_stress.restype = None
+# path to the shared library
+_library_path = (os.path.dirname(os.path.abspath(__file__))
+                    + '/../build/libreal_space_electrostatic_sum.so')
+
+# the library is loaded on first use, so importing this module is cheap
+_lib = None
+
+def _library():
+    """Return the shared library, loading it and declaring its functions on
+    first use."""
+
+    global _lib
+    if _lib is not None:
+        return _lib
+
+    # load library
+    lib = ct.cdll.LoadLibrary(_library_path)
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy'
+    lib.c_real_space_electrostatic_sum_energy.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_double)] # e
+    lib.c_real_space_electrostatic_sum_energy.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_force'
+    lib.c_real_space_electrostatic_sum_force.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_double), # fx
+            ct.POINTER(ct.c_double), # fy
+            ct.POINTER(ct.c_double)] # fz
+    lib.c_real_space_electrostatic_sum_force.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_stress'
+    lib.c_real_space_electrostatic_sum_stress.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_double)] # s
+    lib.c_real_space_electrostatic_sum_stress.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_force_stress'
+    lib.c_real_space_electrostatic_sum_energy_force_stress.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_int),    # do_e
+            ct.POINTER(ct.c_int),    # do_f
+            ct.POINTER(ct.c_int),    # do_s
+            ct.POINTER(ct.c_double), # e
+            ct.POINTER(ct.c_double), # fx
+            ct.POINTER(ct.c_double), # fy
+            ct.POINTER(ct.c_double), # fz
+            ct.POINTER(ct.c_double)] # s
+    lib.c_real_space_electrostatic_sum_energy_force_stress.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_force_stress_f32'
+    lib.c_real_space_electrostatic_sum_energy_force_stress_f32.argtypes = [
+            ct.POINTER(ct.c_float),  # a1
+            ct.POINTER(ct.c_float),  # a2
+            ct.POINTER(ct.c_float),  # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_float),  # rx
+            ct.POINTER(ct.c_float),  # ry
+            ct.POINTER(ct.c_float),  # rz
+            ct.POINTER(ct.c_float),  # z
+            ct.POINTER(ct.c_float),  # rc
+            ct.POINTER(ct.c_float),  # rd
+            ct.POINTER(ct.c_int),    # do_e
+            ct.POINTER(ct.c_int),    # do_f
+            ct.POINTER(ct.c_int),    # do_s
+            ct.POINTER(ct.c_float),  # e
+            ct.POINTER(ct.c_float),  # fx
+            ct.POINTER(ct.c_float),  # fy
+            ct.POINTER(ct.c_float),  # fz
+            ct.POINTER(ct.c_float)]  # s
+    lib.c_real_space_electrostatic_sum_energy_force_stress_f32.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_force_stress_range'
+    lib.c_real_space_electrostatic_sum_energy_force_stress_range.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_int),    # i0
+            ct.POINTER(ct.c_int),    # i1
+            ct.POINTER(ct.c_int),    # do_e
+            ct.POINTER(ct.c_int),    # do_f
+            ct.POINTER(ct.c_int),    # do_s
+            ct.POINTER(ct.c_double), # e
+            ct.POINTER(ct.c_double), # fx
+            ct.POINTER(ct.c_double), # fy
+            ct.POINTER(ct.c_double), # fz
+            ct.POINTER(ct.c_double)] # s
+    lib.c_real_space_electrostatic_sum_energy_force_stress_range.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_force_stress_xyz'
+    # (arrays are passed as raw addresses, which is cheaper than pointer objects)
+    lib.c_real_space_electrostatic_sum_energy_force_stress_xyz.argtypes = [
+            ct.c_void_p,             # a
+            ct.POINTER(ct.c_int),    # n
+            ct.c_void_p,             # r
+            ct.c_void_p,             # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_int),    # do_e
+            ct.POINTER(ct.c_int),    # do_f
+            ct.POINTER(ct.c_int),    # do_s
+            ct.POINTER(ct.c_double), # e
+            ct.c_void_p,             # f
+            ct.c_void_p]             # s
+    lib.c_real_space_electrostatic_sum_energy_force_stress_xyz.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_sweep'
+    lib.c_real_space_electrostatic_sum_energy_sweep.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_int),    # m
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_double)] # e
+    lib.c_real_space_electrostatic_sum_energy_sweep.restype = None
+
+    # set argtypes and restype for 'c_real_space_electrostatic_sum_energy_force_stress_batch'
+    lib.c_real_space_electrostatic_sum_energy_force_stress_batch.argtypes = [
+            ct.POINTER(ct.c_int),    # num_frames
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # a
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_int),    # do_e
+            ct.POINTER(ct.c_int),    # do_f
+            ct.POINTER(ct.c_int),    # do_s
+            ct.POINTER(ct.c_double), # e
+            ct.POINTER(ct.c_double), # fx
+            ct.POINTER(ct.c_double), # fy
+            ct.POINTER(ct.c_double), # fz
+            ct.POINTER(ct.c_double)] # s
+    lib.c_real_space_electrostatic_sum_energy_force_stress_batch.restype = None
+
+    # set argtypes and restype for the neighbor-list functions
+    lib.c_real_space_electrostatic_sum_neighbor_list_create.argtypes = [
+            ct.POINTER(ct.c_double), # skin
+            ct.POINTER(ct.c_void_p)] # nl
+    lib.c_real_space_electrostatic_sum_neighbor_list_create.restype = None
+    lib.c_real_space_electrostatic_sum_neighbor_list_destroy.argtypes = [
+            ct.POINTER(ct.c_void_p)] # nl
+    lib.c_real_space_electrostatic_sum_neighbor_list_destroy.restype = None
+    lib.c_real_space_electrostatic_sum_neighbor_list_energy_force_stress.argtypes = [
+            ct.c_void_p] + lib.c_real_space_electrostatic_sum_energy_force_stress.argtypes
+    lib.c_real_space_electrostatic_sum_neighbor_list_energy_force_stress.restype = None
+    lib.c_real_space_electrostatic_sum_neighbor_list_num_builds.argtypes = [
+            ct.c_void_p,             # nl
+            ct.POINTER(ct.c_int)]    # num_builds
+    lib.c_real_space_electrostatic_sum_neighbor_list_num_builds.restype = None
+
+    # set argtypes and restype for the monte carlo functions
+    lib.c_real_space_electrostatic_sum_mc_create.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_void_p)] # mc
+    lib.c_real_space_electrostatic_sum_mc_create.restype = None
+    lib.c_real_space_electrostatic_sum_mc_destroy.argtypes = [
+            ct.POINTER(ct.c_void_p)] # mc
+    lib.c_real_space_electrostatic_sum_mc_destroy.restype = None
+    lib.c_real_space_electrostatic_sum_mc_propose_move.argtypes = [
+            ct.c_void_p,             # mc
+            ct.POINTER(ct.c_int),    # k
+            ct.POINTER(ct.c_double), # x
+            ct.POINTER(ct.c_double), # y
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double)] # de
+    lib.c_real_space_electrostatic_sum_mc_propose_move.restype = None
+    lib.c_real_space_electrostatic_sum_mc_propose_swap.argtypes = [
+            ct.c_void_p,             # mc
+            ct.POINTER(ct.c_int),    # k
+            ct.POINTER(ct.c_int),    # l
+            ct.POINTER(ct.c_double)] # de
+    lib.c_real_space_electrostatic_sum_mc_propose_swap.restype = None
+    lib.c_real_space_electrostatic_sum_mc_accept.argtypes = [
+            ct.c_void_p]             # mc
+    lib.c_real_space_electrostatic_sum_mc_accept.restype = None
+    lib.c_real_space_electrostatic_sum_mc_energy.argtypes = [
+            ct.c_void_p,             # mc
+            ct.POINTER(ct.c_double)] # e
+    lib.c_real_space_electrostatic_sum_mc_energy.restype = None
+
+    # set argtypes and restype for the site matrix functions
+    lib.c_real_space_electrostatic_sum_site_matrix_create.argtypes = [
+            ct.POINTER(ct.c_double), # a1
+            ct.POINTER(ct.c_double), # a2
+            ct.POINTER(ct.c_double), # a3
+            ct.POINTER(ct.c_int),    # n
+            ct.POINTER(ct.c_double), # rx
+            ct.POINTER(ct.c_double), # ry
+            ct.POINTER(ct.c_double), # rz
+            ct.POINTER(ct.c_double), # rc
+            ct.POINTER(ct.c_double), # rd
+            ct.POINTER(ct.c_void_p)] # sm
+    lib.c_real_space_electrostatic_sum_site_matrix_create.restype = None
+    lib.c_real_space_electrostatic_sum_site_matrix_destroy.argtypes = [
+            ct.POINTER(ct.c_void_p)] # sm
+    lib.c_real_space_electrostatic_sum_site_matrix_destroy.restype = None
+    lib.c_real_space_electrostatic_sum_site_matrix_energy.argtypes = [
+            ct.c_void_p,             # sm
+            ct.POINTER(ct.c_double), # z
+            ct.POINTER(ct.c_double), # e
+            ct.POINTER(ct.c_double), # v
+            ct.POINTER(ct.c_double)] # dedz
+    lib.c_real_space_electrostatic_sum_site_matrix_energy.restype = None
+
+    # set argtypes and restype for the table-tolerance setter and getter
+    lib.c_real_space_electrostatic_sum_set_table_tolerance.argtypes = [
+            ct.POINTER(ct.c_double)] # tol
+    lib.c_real_space_electrostatic_sum_set_table_tolerance.restype = None
+    lib.c_real_space_electrostatic_sum_get_table_tolerance.argtypes = [
+            ct.POINTER(ct.c_double)] # tol
+    lib.c_real_space_electrostatic_sum_get_table_tolerance.restype = None
+    lib.c_real_space_electrostatic_sum_get_table_error.argtypes = [
+            ct.POINTER(ct.c_double)] # err
+    lib.c_real_space_electrostatic_sum_get_table_error.restype = None
+
+    # set argtypes and restype for the instrumentation functions
+    lib.c_real_space_electrostatic_sum_set_stats_enabled.argtypes = [
+            ct.POINTER(ct.c_int)]    # enabled
+    lib.c_real_space_electrostatic_sum_set_stats_enabled.restype = None
+    lib.c_real_space_electrostatic_sum_get_stats.argtypes = [
+            ct.POINTER(_Stats)]      # stats
+    lib.c_real_space_electrostatic_sum_get_stats.restype = None
+    lib.c_real_space_electrostatic_sum_reset_stats.argtypes = []
+    lib.c_real_space_electrostatic_sum_reset_stats.restype = None
+
+    # set argtypes and restype for the thread-count setter and getter
+    lib.c_real_space_electrostatic_sum_set_num_threads.argtypes = [
+            ct.POINTER(ct.c_int)]    # num_threads
+    lib.c_real_space_electrostatic_sum_set_num_threads.restype = None
+    lib.c_real_space_electrostatic_sum_get_num_threads.argtypes = [
+            ct.POINTER(ct.c_int)]    # num_threads
+    lib.c_real_space_electrostatic_sum_get_num_threads.restype = None
+
+    _lib = lib
+    return _lib
+
+def __getattr__(name):
+    # keep 'lib' available as a module attribute (loaded on first access)
+    if name == 'lib':
+        return _library()
+    raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+
+#______________________________________________________________________________
+#                                                                  threads
+
+def set_num_threads(num_threads):
+    """Set the number of threads used by the library (<= 0 for the default).
+
+    The default is determined by the OpenMP runtime, e.g. OMP_NUM_THREADS.
+    Has no effect if the library was built without OpenMP.
+    """
+    _library().c_real_space_electrostatic_sum_set_num_threads(
+            ct.byref(ct.c_int(num_threads)))
+
+def get_num_threads():
+    """Return the number of threads the library will use."""
+    num_threads = ct.c_int()
+    _library().c_real_space_electrostatic_sum_get_num_threads(
+            ct.byref(num_threads))
+    return num_threads.value
+
+#______________________________________________________________________________
+#                                                                    stats
+
+class _Stats(ct.Structure):
+    # mirrors struct c_real_space_electrostatic_sum_stats
+    _fields_ = [('num_calls', ct.c_int64),
+                ('num_images', ct.c_int64),
+                ('num_candidates', ct.c_int64),
+                ('num_pairs', ct.c_int64),
+                ('setup_time', ct.c_double),
+                ('pair_time', ct.c_double),
+                ('correction_time', ct.c_double)]
+
+def set_stats_enabled(enabled):
+    """Enable or disable the instrumentation counters and timings.
+
+    While enabled, the kernels accumulate the statistics returned by
+    get_stats. They are disabled by default, in which case the kernels do no
+    counting or timing.
+    """
+    _library().c_real_space_electrostatic_sum_set_stats_enabled(
+            ct.byref(ct.c_int(bool(enabled))))
+
+def get_stats():
+    """Return the statistics accumulated since the last reset as a dict.
+
+    The entries are the number of kernel calls, periodic images visited while
+    binning, candidate pairs tested against rc, and pairs accepted within rc,
+    and the wall times (seconds) spent in setup, in the pair loop, and on the
+    correction terms. Times are summed over concurrent calls, e.g. the frames
+    of a batch.
+    """
+    stats = _Stats()
+    _library().c_real_space_electrostatic_sum_get_stats(ct.byref(stats))
+    return {name: getattr(stats, name) for name, _ in _Stats._fields_}
+
+def reset_stats():
+    """Set all statistics to zero."""
+    _library().c_real_space_electrostatic_sum_reset_stats()
+
+#______________________________________________________________________________
+#                                                                   tables
+
+def set_table_tolerance(tol):
+    """Select exact (tol <= 0, the default) or tabulated erfc/exp evaluation.
+
+    With tol > 0, the energy, force, and stress kernels interpolate
+    erfc(r/rd) and 2/sqrt(pi)*(r/rd)*exp(-(r/rd)**2) + erfc(r/rd) from cubic
+    tables with maximum absolute error below tol. The tolerance bounds these
+    functions, not the energy, forces, or stress. The tables are built once
+    per (rd, rc, tol) and reused by later calls. Their size is limited, so
+    very small tolerances may not be reached; see get_table_error.
+    """
+    _library().c_real_space_electrostatic_sum_set_table_tolerance(
+            ct.byref(ct.c_double(tol)))
+
+def get_table_tolerance():
+    """Return the current table tolerance (0 for exact evaluation)."""
+    tol = ct.c_double()
+    _library().c_real_space_electrostatic_sum_get_table_tolerance(
+            ct.byref(tol))
+    return tol.value
+
+def get_table_error():
+    """Return the interpolation error of the tables used by the last call.
+
+    This exceeds the tolerance if the tables could not reach it, and is 0 if
+    no tables have been used.
+    """
+    err = ct.c_double()
+    _library().c_real_space_electrostatic_sum_get_table_error(ct.byref(err))
+    return err.value
 
 #______________________________________________________________________________
 #                                                                   energy
@@ -99,7 +445,7 @@ def energy(a1, a2, a3, n, rx, ry, rz, z, rc, rd):
     z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
 
     # call library function
-    lib.c_real_space_electrostatic_sum_energy(
+    _library().c_real_space_electrostatic_sum_energy(
             a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
@@ -140,7 +486,7 @@ def force(a1, a2, a3, n, rx, ry, rz, z, rc, rd):
     fz = np.require(np.zeros(n, dtype=ct.c_double), requirements=['C','A'])
 
     # call library function
-    lib.c_real_space_electrostatic_sum_force(
+    _library().c_real_space_electrostatic_sum_force(
             a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
@@ -181,7 +527,7 @@ def stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd):
     s = np.require(np.zeros(6, dtype=ct.c_double), requirements=['C','A'])
 
     # call library function
-    lib.c_real_space_electrostatic_sum_stress(
+    _library().c_real_space_electrostatic_sum_stress(
             a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
             a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
@@ -196,3 +542,681 @@ def stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd):
 
     # return the stress
     return s
+
+#______________________________________________________________________________
+#                                                      energy_force_stress
+
+def energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                        compute_energy=True, compute_force=True,
+                        compute_stress=True):
+    """Compute any subset of energy, forces, and stress in a single pass.
+
+    Returns (e, fx, fy, fz, s). Quantities that are not requested are None.
+    """
+    return _energy_force_stress(
+            _library().c_real_space_electrostatic_sum_energy_force_stress, (),
+            a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+            compute_energy, compute_force, compute_stress)
+
+def _energy_force_stress(function, leading_args,
+                         a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                         compute_energy, compute_force, compute_stress):
+
+    # create c variables (except for numpy arrays)
+    n_c = ct.c_int(n)
+    rc_c = ct.c_double(rc)
+    rd_c = ct.c_double(rd)
+    do_e_c = ct.c_int(int(bool(compute_energy)))
+    do_f_c = ct.c_int(int(bool(compute_force)))
+    do_s_c = ct.c_int(int(bool(compute_stress)))
+    e_c = ct.c_double()
+
+    # ensure numpy arrays are stored as expected
+    a1_c = np.require(a1, dtype=ct.c_double, requirements=['C','A'])
+    a2_c = np.require(a2, dtype=ct.c_double, requirements=['C','A'])
+    a3_c = np.require(a3, dtype=ct.c_double, requirements=['C','A'])
+    rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+    ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+    rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+    z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+
+    # create numpy arrays for forces and stress
+    fx = np.require(np.zeros(n, dtype=ct.c_double), requirements=['C','A'])
+    fy = np.require(np.zeros(n, dtype=ct.c_double), requirements=['C','A'])
+    fz = np.require(np.zeros(n, dtype=ct.c_double), requirements=['C','A'])
+    s = np.require(np.zeros(6, dtype=ct.c_double), requirements=['C','A'])
+
+    # call library function
+    function(
+            *leading_args,
+            a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(n_c),
+            rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(rc_c),
+            ct.byref(rd_c),
+            ct.byref(do_e_c),
+            ct.byref(do_f_c),
+            ct.byref(do_s_c),
+            ct.byref(e_c),
+            fx.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fy.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fz.ctypes.data_as(ct.POINTER(ct.c_double)),
+            s.ctypes.data_as(ct.POINTER(ct.c_double)))
+
+    # return the requested quantities
+    e = e_c.value if compute_energy else None
+    if not compute_force:
+        fx = fy = fz = None
+    if not compute_stress:
+        s = None
+    return e, fx, fy, fz, s
+
+#______________________________________________________________________________
+#                                                  energy_force_stress_f32
+
+def energy_force_stress_f32(a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                            compute_energy=True, compute_force=True,
+                            compute_stress=True):
+    """Single-precision variant of energy_force_stress, for screening.
+
+    Inputs are converted to float32 (if they are not already), and the forces
+    and stress are returned as float32 arrays. Relative errors are about 1e-6.
+    """
+
+    # create c variables (except for numpy arrays)
+    n_c = ct.c_int(n)
+    rc_c = ct.c_float(rc)
+    rd_c = ct.c_float(rd)
+    do_e_c = ct.c_int(int(bool(compute_energy)))
+    do_f_c = ct.c_int(int(bool(compute_force)))
+    do_s_c = ct.c_int(int(bool(compute_stress)))
+    e_c = ct.c_float()
+
+    # ensure numpy arrays are stored as expected
+    a1_c = np.require(a1, dtype=ct.c_float, requirements=['C','A'])
+    a2_c = np.require(a2, dtype=ct.c_float, requirements=['C','A'])
+    a3_c = np.require(a3, dtype=ct.c_float, requirements=['C','A'])
+    rx_c = np.require(rx, dtype=ct.c_float, requirements=['C','A'])
+    ry_c = np.require(ry, dtype=ct.c_float, requirements=['C','A'])
+    rz_c = np.require(rz, dtype=ct.c_float, requirements=['C','A'])
+    z_c = np.require(z, dtype=ct.c_float, requirements=['C','A'])
+
+    # create numpy arrays for forces and stress
+    fx = np.zeros(n, dtype=ct.c_float)
+    fy = np.zeros(n, dtype=ct.c_float)
+    fz = np.zeros(n, dtype=ct.c_float)
+    s = np.zeros(6, dtype=ct.c_float)
+
+    # call library function
+    _library().c_real_space_electrostatic_sum_energy_force_stress_f32(
+            a1_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            a2_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            a3_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            ct.byref(n_c),
+            rx_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            ry_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            rz_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            z_c.ctypes.data_as(ct.POINTER(ct.c_float)),
+            ct.byref(rc_c),
+            ct.byref(rd_c),
+            ct.byref(do_e_c),
+            ct.byref(do_f_c),
+            ct.byref(do_s_c),
+            ct.byref(e_c),
+            fx.ctypes.data_as(ct.POINTER(ct.c_float)),
+            fy.ctypes.data_as(ct.POINTER(ct.c_float)),
+            fz.ctypes.data_as(ct.POINTER(ct.c_float)),
+            s.ctypes.data_as(ct.POINTER(ct.c_float)))
+
+    # return the requested quantities
+    e = e_c.value if compute_energy else None
+    if not compute_force:
+        fx = fy = fz = None
+    if not compute_stress:
+        s = None
+    return e, fx, fy, fz, s
+
+#______________________________________________________________________________
+#                                                 energy_force_stress_range
+
+def energy_force_stress_range(a1, a2, a3, n, rx, ry, rz, z, rc, rd, i0, i1,
+                              compute_energy=True, compute_force=True,
+                              compute_stress=True, out_force=None):
+    """Compute the contributions of ions i0 to i1-1 only.
+
+    Returns (e, fx, fy, fz, s), where e and s are the parts of the energy and
+    stress that belong to the ions in the range and fx, fy, fz (of length
+    i1-i0) are their forces. Summing e and s over ranges that partition the
+    ions gives the totals. If given, out_force is a tuple of three writeable
+    float64 arrays of length i1-i0 that receive the forces.
+
+    Only the pair sums are restricted to the range: binning the periodic
+    images still scans all n ions for each lattice translation that can
+    reach the range, so every range repeats that O(n) setup.
+    """
+
+    if not 0 <= i0 <= i1 <= n:
+        raise ValueError('expected 0 <= i0 <= i1 <= n, got i0={}, i1={}, '
+                         'n={}'.format(i0, i1, n))
+
+    # create c variables (except for numpy arrays)
+    n_c = ct.c_int(n)
+    rc_c = ct.c_double(rc)
+    rd_c = ct.c_double(rd)
+    i0_c = ct.c_int(i0)
+    i1_c = ct.c_int(i1)
+    do_e_c = ct.c_int(int(bool(compute_energy)))
+    do_f_c = ct.c_int(int(bool(compute_force)))
+    do_s_c = ct.c_int(int(bool(compute_stress)))
+    e_c = ct.c_double()
+
+    # ensure numpy arrays are stored as expected
+    a1_c = np.require(a1, dtype=ct.c_double, requirements=['C','A'])
+    a2_c = np.require(a2, dtype=ct.c_double, requirements=['C','A'])
+    a3_c = np.require(a3, dtype=ct.c_double, requirements=['C','A'])
+    rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+    ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+    rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+    z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+
+    # create (or validate) arrays for forces and stress
+    if out_force is None:
+        fx, fy, fz = [np.zeros(i1 - i0, dtype=ct.c_double) for _ in range(3)]
+    else:
+        fx, fy, fz = out_force
+        for f in out_force:
+            if (f.shape != (i1 - i0,) or f.dtype != np.float64
+                    or not f.flags['C_CONTIGUOUS']
+                    or not f.flags['WRITEABLE']):
+                raise ValueError('out_force must hold writeable C-contiguous '
+                                 'float64 arrays of length i1-i0')
+    s = np.zeros(6, dtype=ct.c_double)
+
+    # call library function
+    _library().c_real_space_electrostatic_sum_energy_force_stress_range(
+            a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(n_c),
+            rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(rc_c),
+            ct.byref(rd_c),
+            ct.byref(i0_c),
+            ct.byref(i1_c),
+            ct.byref(do_e_c),
+            ct.byref(do_f_c),
+            ct.byref(do_s_c),
+            ct.byref(e_c),
+            fx.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fy.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fz.ctypes.data_as(ct.POINTER(ct.c_double)),
+            s.ctypes.data_as(ct.POINTER(ct.c_double)))
+
+    # return the requested quantities
+    e = e_c.value if compute_energy else None
+    if not compute_force:
+        fx = fy = fz = None
+    if not compute_stress:
+        s = None
+    return e, fx, fy, fz, s
+
+#______________________________________________________________________________
+#                                                             energy_sweep
+
+def energy_sweep(a1, a2, a3, n, rx, ry, rz, z, rc, rd):
+    """Compute the energy for many cutoffs with a single pass over pairs.
+
+    rc and rd may be arrays of the same length, or either may be a scalar
+    that is shared by all cutoffs. Returns an array of energies with one
+    entry per (rc, rd) pair.
+    """
+
+    # broadcast the cutoffs against each other
+    rc, rd = np.broadcast_arrays(np.atleast_1d(rc), np.atleast_1d(rd))
+
+    # create c variables (except for numpy arrays)
+    n_c = ct.c_int(n)
+    m_c = ct.c_int(rc.shape[0])
+
+    # ensure numpy arrays are stored as expected
+    a1_c = np.require(a1, dtype=ct.c_double, requirements=['C','A'])
+    a2_c = np.require(a2, dtype=ct.c_double, requirements=['C','A'])
+    a3_c = np.require(a3, dtype=ct.c_double, requirements=['C','A'])
+    rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+    ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+    rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+    z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+    rc_c = np.require(rc, dtype=ct.c_double, requirements=['C','A'])
+    rd_c = np.require(rd, dtype=ct.c_double, requirements=['C','A'])
+
+    # create numpy array for energies
+    e = np.zeros(rc.shape[0], dtype=ct.c_double)
+
+    # call library function
+    _library().c_real_space_electrostatic_sum_energy_sweep(
+            a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(n_c),
+            rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(m_c),
+            rc_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rd_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            e.ctypes.data_as(ct.POINTER(ct.c_double)))
+
+    # return the energies
+    return e
+
+#______________________________________________________________________________
+#                                                                    batch
+
+def energy_force_stress_batch(a, n, rx, ry, rz, z, rc, rd,
+                              compute_energy=True, compute_force=True,
+                              compute_stress=True):
+    """Evaluate many frames with a single library call.
+
+    Frame k has n[k] ions and lattice vectors a[k,0], a[k,1], a[k,2] (so a
+    has shape (num_frames, 3, 3)). The ions of all frames are packed in
+    order into rx, ry, rz, and z, each of length sum(n).
+
+    Returns (e, fx, fy, fz, s) with e of shape (num_frames,), fx/fy/fz packed
+    like rx, and s of shape (num_frames, 6). Quantities that are not
+    requested are None.
+    """
+
+    # ensure numpy arrays are stored as expected
+    a_c = np.require(a, dtype=ct.c_double, requirements=['C','A'])
+    n_c = np.require(n, dtype=ct.c_int, requirements=['C','A'])
+    rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+    ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+    rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+    z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+    num_frames = n_c.shape[0]
+    num_ions = int(n_c.sum())
+    if a_c.shape != (num_frames, 3, 3):
+        raise ValueError('a must have shape (num_frames, 3, 3)')
+    for r in (rx_c, ry_c, rz_c, z_c):
+        if r.shape != (num_ions,):
+            raise ValueError('rx, ry, rz, and z must have length sum(n)')
+
+    # create c variables (except for numpy arrays)
+    num_frames_c = ct.c_int(num_frames)
+    rc_c = ct.c_double(rc)
+    rd_c = ct.c_double(rd)
+    do_e_c = ct.c_int(int(bool(compute_energy)))
+    do_f_c = ct.c_int(int(bool(compute_force)))
+    do_s_c = ct.c_int(int(bool(compute_stress)))
+
+    # create numpy arrays for energies, forces, and stresses
+    e = np.zeros(num_frames, dtype=ct.c_double)
+    fx = np.zeros(num_ions, dtype=ct.c_double)
+    fy = np.zeros(num_ions, dtype=ct.c_double)
+    fz = np.zeros(num_ions, dtype=ct.c_double)
+    s = np.zeros((num_frames, 6), dtype=ct.c_double)
+
+    # call library function
+    _library().c_real_space_electrostatic_sum_energy_force_stress_batch(
+            ct.byref(num_frames_c),
+            n_c.ctypes.data_as(ct.POINTER(ct.c_int)),
+            a_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.byref(rc_c),
+            ct.byref(rd_c),
+            ct.byref(do_e_c),
+            ct.byref(do_f_c),
+            ct.byref(do_s_c),
+            e.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fx.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fy.ctypes.data_as(ct.POINTER(ct.c_double)),
+            fz.ctypes.data_as(ct.POINTER(ct.c_double)),
+            s.ctypes.data_as(ct.POINTER(ct.c_double)))
+
+    # return the requested quantities
+    if not compute_energy:
+        e = None
+    if not compute_force:
+        fx = fy = fz = None
+    if not compute_stress:
+        s = None
+    return e, fx, fy, fz, s
+
+#______________________________________________________________________________
+#                                                            NeighborList
+
+class NeighborList:
+    """Persistent (Verlet) neighbor list for a sequence of related structures.
+
+    The list holds all images within rc + skin and is rebuilt only when the
+    number of ions, the lattice, or rc changes, or when an ion has moved by
+    more than skin/2 since the last build. Intended for MD trajectories.
+    """
+
+    def __init__(self, skin):
+        self._nl = ct.c_void_p()
+        _library().c_real_space_electrostatic_sum_neighbor_list_create(
+                ct.byref(ct.c_double(skin)), ct.byref(self._nl))
+
+    def __del__(self):
+        if getattr(self, '_nl', None):
+            _library().c_real_space_electrostatic_sum_neighbor_list_destroy(
+                    ct.byref(self._nl))
+
+    @property
+    def num_builds(self):
+        """Number of times the list has been (re)built."""
+        num_builds = ct.c_int()
+        _library().c_real_space_electrostatic_sum_neighbor_list_num_builds(
+                self._nl, ct.byref(num_builds))
+        return num_builds.value
+
+    def energy_force_stress(self, a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                            compute_energy=True, compute_force=True,
+                            compute_stress=True):
+        """Same as the module-level energy_force_stress, using the list."""
+        return _energy_force_stress(
+                _library().c_real_space_electrostatic_sum_neighbor_list_energy_force_stress,
+                (self._nl,),
+                a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                compute_energy, compute_force, compute_stress)
+
+    def energy(self, a1, a2, a3, n, rx, ry, rz, z, rc, rd):
+        return self.energy_force_stress(
+                a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                compute_force=False, compute_stress=False)[0]
+
+    def force(self, a1, a2, a3, n, rx, ry, rz, z, rc, rd):
+        return self.energy_force_stress(
+                a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                compute_energy=False, compute_stress=False)[1:4]
+
+    def stress(self, a1, a2, a3, n, rx, ry, rz, z, rc, rd):
+        return self.energy_force_stress(
+                a1, a2, a3, n, rx, ry, rz, z, rc, rd,
+                compute_energy=False, compute_force=False)[4]
+
+#______________________________________________________________________________
+#                                                               MonteCarlo
+
+class MonteCarlo:
+    """Energy changes for single-ion moves and charge swaps.
+
+    The energy of the initial structure is computed once. Thereafter, the
+    energy change of a proposed move is computed from the pair terms
+    involving the moved ions and the correction terms of the ions whose
+    charge within rc changes. The ions are kept binned, and the bins are
+    updated on acceptance, so a proposal only visits the bins within rc of
+    the moved ions. Its cost does not grow with n, and a sweep of n
+    proposals costs a small multiple of one full evaluation (each proposal
+    searches the neighbors of both the old and the new position). Positions
+    are mapped into the cell, both initially and when moved. A proposal
+    takes effect only when accepted; a new proposal discards the previous
+    one. Ion indices are zero-based.
+    """
+
+    def __init__(self, a1, a2, a3, n, rx, ry, rz, z, rc, rd):
+
+        # ensure numpy arrays are stored as expected
+        a1_c = np.require(a1, dtype=ct.c_double, requirements=['C','A'])
+        a2_c = np.require(a2, dtype=ct.c_double, requirements=['C','A'])
+        a3_c = np.require(a3, dtype=ct.c_double, requirements=['C','A'])
+        rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+        ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+        rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+        z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+
+        # create the state, which copies the structure
+        self._mc = ct.c_void_p()
+        _library().c_real_space_electrostatic_sum_mc_create(
+                a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ct.byref(ct.c_int(n)),
+                rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ct.byref(ct.c_double(rc)),
+                ct.byref(ct.c_double(rd)),
+                ct.byref(self._mc))
+        self.n = n
+
+        # arguments reused by every proposal
+        self._k_c = ct.c_int()
+        self._l_c = ct.c_int()
+        self._x_c = ct.c_double()
+        self._y_c = ct.c_double()
+        self._z_c = ct.c_double()
+        self._de_c = ct.c_double()
+
+    def __del__(self):
+        if getattr(self, '_mc', None):
+            _library().c_real_space_electrostatic_sum_mc_destroy(
+                    ct.byref(self._mc))
+
+    @property
+    def energy(self):
+        """Energy of the current (accepted) structure."""
+        e = ct.c_double()
+        _library().c_real_space_electrostatic_sum_mc_energy(
+                self._mc, ct.byref(e))
+        return e.value
+
+    def _check_index(self, k):
+        if not 0 <= k < self.n:
+            raise ValueError('ion index {} not in [0, {})'.format(k, self.n))
+
+    def propose_move(self, k, position):
+        """Return the energy change for moving ion k to position (x, y, z)."""
+        self._check_index(k)
+        self._k_c.value = k
+        self._x_c.value, self._y_c.value, self._z_c.value = position
+        _library().c_real_space_electrostatic_sum_mc_propose_move(
+                self._mc, ct.byref(self._k_c),
+                ct.byref(self._x_c),
+                ct.byref(self._y_c),
+                ct.byref(self._z_c),
+                ct.byref(self._de_c))
+        return self._de_c.value
+
+    def propose_swap(self, k, l):
+        """Return the energy change for swapping the charges of ions k, l."""
+        self._check_index(k)
+        self._check_index(l)
+        self._k_c.value = k
+        self._l_c.value = l
+        _library().c_real_space_electrostatic_sum_mc_propose_swap(
+                self._mc, ct.byref(self._k_c), ct.byref(self._l_c),
+                ct.byref(self._de_c))
+        return self._de_c.value
+
+    def accept(self):
+        """Apply the most recent proposal."""
+        _library().c_real_space_electrostatic_sum_mc_accept(self._mc)
+
+#______________________________________________________________________________
+#                                                               SiteMatrix
+
+class SiteMatrix:
+    """Energies of many charge vectors for one geometry.
+
+    The pair terms are bilinear in the charges, so they are tabulated once
+    for the geometry, as an n x n matrix, and each charge vector then costs
+    only matrix-vector products. The correction terms are evaluated exactly
+    for each charge vector. Suited to charge equilibration and fitting.
+    """
+
+    def __init__(self, a1, a2, a3, n, rx, ry, rz, rc, rd):
+
+        # ensure numpy arrays are stored as expected
+        a1_c = np.require(a1, dtype=ct.c_double, requirements=['C','A'])
+        a2_c = np.require(a2, dtype=ct.c_double, requirements=['C','A'])
+        a3_c = np.require(a3, dtype=ct.c_double, requirements=['C','A'])
+        rx_c = np.require(rx, dtype=ct.c_double, requirements=['C','A'])
+        ry_c = np.require(ry, dtype=ct.c_double, requirements=['C','A'])
+        rz_c = np.require(rz, dtype=ct.c_double, requirements=['C','A'])
+
+        # tabulate the pair terms
+        self.n = n
+        self._sm = ct.c_void_p()
+        _library().c_real_space_electrostatic_sum_site_matrix_create(
+                a1_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                a2_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                a3_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ct.byref(ct.c_int(n)),
+                rx_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ry_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                rz_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ct.byref(ct.c_double(rc)),
+                ct.byref(ct.c_double(rd)),
+                ct.byref(self._sm))
+
+    def __del__(self):
+        if getattr(self, '_sm', None):
+            _library().c_real_space_electrostatic_sum_site_matrix_destroy(
+                    ct.byref(self._sm))
+
+    def evaluate(self, z):
+        """Return (e, v, dedz) for charges z.
+
+        v is the potential of the pair terms at each ion, so that their part
+        of the energy is z.v/2, and dedz the derivative of the energy with
+        respect to each charge.
+        """
+        z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+        if z_c.shape != (self.n,):
+            raise ValueError('expected {} charges'.format(self.n))
+        e = ct.c_double()
+        v = np.zeros(self.n, dtype=ct.c_double)
+        dedz = np.zeros(self.n, dtype=ct.c_double)
+        _library().c_real_space_electrostatic_sum_site_matrix_energy(
+                self._sm,
+                z_c.ctypes.data_as(ct.POINTER(ct.c_double)),
+                ct.byref(e),
+                v.ctypes.data_as(ct.POINTER(ct.c_double)),
+                dedz.ctypes.data_as(ct.POINTER(ct.c_double)))
+        return e.value, v, dedz
+
+    def energy(self, z):
+        """Return the energy for charges z."""
+        return self.evaluate(z)[0]
+
+    def energy_gradient(self, z):
+        """Return the energy and its derivatives for charges z."""
+        e, _, dedz = self.evaluate(z)
+        return e, dedz
+
+#______________________________________________________________________________
+#                                                               Calculator
+
+class Calculator:
+    """Repeated evaluations with fixed cutoffs and reusable buffers.
+
+    Lattices are given as (3, 3) arrays with the lattice vectors as rows,
+    positions as (n, 3) arrays, and forces are returned as (n, 3) arrays.
+    Inputs that are already C-contiguous float64 arrays are passed to the
+    library without copying.
+
+    Unless out arrays are given, results are written to buffers owned by the
+    calculator, which are overwritten by the next call; copy them to keep
+    them.
+    """
+
+    def __init__(self, rc, rd):
+        self.rc = rc
+        self.rd = rd
+
+        # create c variables once
+        self._n_c = ct.c_int(0)
+        self._rc_c = ct.c_double(rc)
+        self._rd_c = ct.c_double(rd)
+        self._e_c = ct.c_double()
+        self._flags_c = [ct.c_int(0), ct.c_int(1)]
+
+        # reusable output buffers
+        self._f = np.zeros((0, 3), dtype=ct.c_double)
+        self._s = np.zeros(6, dtype=ct.c_double)
+
+    def energy_force_stress(self, a, r, z,
+                            compute_energy=True, compute_force=True,
+                            compute_stress=True, out_force=None,
+                            out_stress=None):
+        """Compute any subset of energy, forces, and stress in a single pass.
+
+        Returns (e, f, s). Quantities that are not requested are None.
+        """
+
+        # ensure numpy arrays are stored as expected (copies only if not)
+        a_c = np.require(a, dtype=ct.c_double, requirements=['C','A'])
+        r_c = np.require(r, dtype=ct.c_double, requirements=['C','A'])
+        z_c = np.require(z, dtype=ct.c_double, requirements=['C','A'])
+        n = r_c.shape[0]
+        if a_c.shape != (3, 3) or r_c.shape != (n, 3) or z_c.shape != (n,):
+            raise ValueError('expected a (3, 3), r (n, 3), and z (n,)')
+
+        # select output arrays
+        f = self._output(out_force, (n, 3), '_f')
+        s = self._output(out_stress, (6,), '_s')
+
+        # call library function
+        self._n_c.value = n
+        _library().c_real_space_electrostatic_sum_energy_force_stress_xyz(
+                a_c.ctypes.data,
+                ct.byref(self._n_c),
+                r_c.ctypes.data,
+                z_c.ctypes.data,
+                ct.byref(self._rc_c),
+                ct.byref(self._rd_c),
+                ct.byref(self._flags_c[bool(compute_energy)]),
+                ct.byref(self._flags_c[bool(compute_force)]),
+                ct.byref(self._flags_c[bool(compute_stress)]),
+                ct.byref(self._e_c),
+                f.ctypes.data,
+                s.ctypes.data)
+
+        # return the requested quantities
+        return (self._e_c.value if compute_energy else None,
+                f if compute_force else None,
+                s if compute_stress else None)
+
+    def energy(self, a, r, z):
+        return self.energy_force_stress(
+                a, r, z, compute_force=False, compute_stress=False)[0]
+
+    def force(self, a, r, z, out=None):
+        return self.energy_force_stress(
+                a, r, z, compute_energy=False, compute_stress=False,
+                out_force=out)[1]
+
+    def stress(self, a, r, z, out=None):
+        return self.energy_force_stress(
+                a, r, z, compute_energy=False, compute_force=False,
+                out_stress=out)[2]
+
+    def _output(self, out, shape, buffer_name):
+        # validate a user-supplied output array or (re)use an internal buffer
+        if out is not None:
+            if (out.shape != shape or out.dtype != np.float64
+                    or not out.flags['C_CONTIGUOUS']
+                    or not out.flags['WRITEABLE']):
+                raise ValueError('out must be a writeable C-contiguous '
+                                 'float64 array of shape {}'.format(shape))
+            return out
+        buffer = getattr(self, buffer_name)
+        if buffer.shape != shape:
+            buffer = np.zeros(shape, dtype=ct.c_double)
+            setattr(self, buffer_name, buffer)
+        return buffer
@@ -0,0 +1,238 @@
+# MIT License
+#
+# Copyright (c) 2019-2020 William C. Witt
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Evaluation of a single large cell by a pool of processes.
+
+The ions are ordered along a space-filling curve and split into contiguous
+shards, [i0, i1), each of which is evaluated by a worker with the range entry
+point of the library. Positions and charges are placed in shared memory, so
+only the shard bounds are sent to the workers, which write their forces
+directly into a shared output array. The energy and stress are reduced in a
+fixed order, so results do not depend on scheduling.
+
+Load balancing works in two ways. There are several shards per worker, which
+are handed out as workers become free. And the shard bounds are chosen to
+equalize the predicted cost of the shards, using per-ion costs measured in
+the previous call (uniform at first), so that dense and sparse regions, e.g.
+a slab and its vacuum, are split fairly on repeated calls.
+
+Only the pair sums are divided among the shards. Each shard still scans all
+n ions for the lattice translations that can reach its ions, so this setup,
+O(n) per shard, is repeated rather than shared, and it bounds the speedup for
+cells with few ions per shard.
+"""
+
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import time
+
+import numpy as np
+
+import real_space_electrostatic_sum
+
+#______________________________________________________________________________
+#                                                                   worker
+
+# shared memory blocks attached by this (worker) process, by name
+_attached = {}
+
+def _initialize_worker(num_threads):
+    real_space_electrostatic_sum.set_num_threads(num_threads)
+
+def _attach(name, shape):
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.float64, buffer=_attached[name].buf)
+
+def _detach_except(names):
+    # close the blocks of earlier calls (the evaluator replaces its blocks
+    # when the number of ions changes), so their mappings are released
+    for name in [name for name in _attached if name not in names]:
+        _attached.pop(name).close()
+
+def _evaluate_shard(task):
+    (k, name_in, name_out, n, i0, i1, a, rc, rd,
+            compute_energy, compute_force, compute_stress) = task
+    start = time.perf_counter()
+    _detach_except((name_in, name_out))
+    rx, ry, rz, z = _attach(name_in, (4, n))
+    out = None
+    if compute_force:
+        f = _attach(name_out, (3, n))
+        out = (f[0,i0:i1], f[1,i0:i1], f[2,i0:i1])
+    e, _, _, _, s = real_space_electrostatic_sum.energy_force_stress_range(
+            a[0], a[1], a[2], n, rx, ry, rz, z, rc, rd, i0, i1,
+            compute_energy, compute_force, compute_stress, out_force=out)
+    return k, e, s, time.perf_counter() - start
+
+#______________________________________________________________________________
+#                                                                     pool
+
+class ShardedEvaluator:
+    """Energy, forces, and stress of one cell from a pool of processes.
+
+    Lattices are given as (3, 3) arrays with the lattice vectors as rows,
+    positions as (n, 3) arrays, and forces are returned as (n, 3) arrays.
+    The pool is started on first use; call close (or use a with block) to
+    stop it and release the shared memory.
+    """
+
+    def __init__(self, num_workers=None, shards_per_worker=4,
+                 threads_per_worker=1, context=None):
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.shards_per_worker = shards_per_worker
+        self.threads_per_worker = threads_per_worker
+        self._context = context or multiprocessing.get_context()
+        self._pool = None
+        self._shm_in = None
+        self._shm_out = None
+        self._n = 0
+        self._cost = None  # measured cost of each ion in the previous call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        if getattr(self, '_pool', None) is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for shm in (getattr(self, '_shm_in', None),
+                    getattr(self, '_shm_out', None)):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._shm_in = self._shm_out = None
+        self._n = 0
+
+    def energy_force_stress(self, a, r, z, rc, rd, compute_energy=True,
+                            compute_force=True, compute_stress=True):
+        """Compute any subset of energy, forces, and stress.
+
+        Returns (e, f, s). Quantities that are not requested are None.
+        """
+
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        r = np.asarray(r, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        n = r.shape[0]
+        if a.shape != (3, 3) or r.shape != (n, 3) or z.shape != (n,):
+            raise ValueError('expected a (3, 3), r (n, 3), and z (n,)')
+        self._prepare(n)
+
+        # order the ions along a space-filling curve, so that each shard is
+        # compact and its workers bin only the images near it
+        order = _morton_order(a, r)
+        data = np.ndarray((4, n), dtype=np.float64, buffer=self._shm_in.buf)
+        data[0:3] = r[order].T
+        data[3] = z[order]
+
+        # choose shard bounds that equalize the predicted cost
+        bounds = _split(self._cost[order],
+                        min(n, self.num_workers * self.shards_per_worker))
+        tasks = [(k, self._shm_in.name, self._shm_out.name, n,
+                  int(bounds[k]), int(bounds[k+1]), a, rc, rd,
+                  compute_energy, compute_force, compute_stress)
+                 for k in range(len(bounds) - 1)]
+
+        # evaluate the shards, handing them out as workers become free
+        results = [None] * len(tasks)
+        for k, e, s, elapsed in self._pool.imap_unordered(
+                _evaluate_shard, tasks):
+            results[k] = (e, s, elapsed)
+
+        # update the measured cost per ion
+        for k in range(len(tasks)):
+            i0, i1 = bounds[k], bounds[k+1]
+            self._cost[order[i0:i1]] = results[k][2] / max(i1 - i0, 1)
+
+        # reduce in shard order
+        e = sum(x[0] for x in results) if compute_energy else None
+        s = np.sum([x[1] for x in results], axis=0) if compute_stress else None
+        f = None
+        if compute_force:
+            f = np.empty((n, 3))
+            f[order] = np.ndarray((3, n), dtype=np.float64,
+                                  buffer=self._shm_out.buf).T
+        return e, f, s
+
+    def energy(self, a, r, z, rc, rd):
+        return self.energy_force_stress(
+                a, r, z, rc, rd, compute_force=False, compute_stress=False)[0]
+
+    def force(self, a, r, z, rc, rd):
+        return self.energy_force_stress(
+                a, r, z, rc, rd, compute_energy=False, compute_stress=False)[1]
+
+    def stress(self, a, r, z, rc, rd):
+        return self.energy_force_stress(
+                a, r, z, rc, rd, compute_energy=False, compute_force=False)[2]
+
+    def _prepare(self, n):
+        # start the pool and (re)allocate the shared memory for n ions
+        if self._pool is None:
+            # workers share this process's resource tracker, which then sees
+            # their attachments to the shared memory as the same blocks
+            resource_tracker.ensure_running()
+            self._pool = self._context.Pool(
+                    self.num_workers, _initialize_worker,
+                    (self.threads_per_worker,))
+        if n != self._n:
+            for shm in (self._shm_in, self._shm_out):
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+            self._shm_in = shared_memory.SharedMemory(create=True,
+                                                      size=4 * 8 * n)
+            self._shm_out = shared_memory.SharedMemory(create=True,
+                                                       size=3 * 8 * n)
+            self._n = n
+            self._cost = np.ones(n)
+
+#______________________________________________________________________________
+#                                                                  helpers
+
+def _split(cost, num_shards):
+    # bounds of num_shards contiguous ranges with similar total cost
+    c = np.concatenate(([0.0], np.cumsum(cost)))
+    targets = c[-1] * np.arange(1, num_shards) / num_shards
+    inner = np.searchsorted(c, targets)
+    bounds = np.concatenate(([0], inner, [cost.shape[0]]))
+    return np.unique(bounds)
+
+def _morton_order(a, r, bits=10):
+    # order of the ions along a z-order curve in fractional coordinates
+    frac = r.dot(np.linalg.inv(a))
+    frac -= np.floor(frac)
+    g = np.minimum((frac * 2**bits).astype(np.int64), 2**bits - 1)
+    key = np.zeros(r.shape[0], dtype=np.int64)
+    for b in range(bits):
+        for d in range(3):
+            key |= ((g[:,d] >> b) & 1) << (3 * b + d)
+    return np.argsort(key, kind='stable')
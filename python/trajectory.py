@@ -0,0 +1,357 @@
+# MIT License
+#
+# Copyright (c) 2019-2020 William C. Witt
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Streaming evaluation of trajectories.
+
+Frames are read incrementally from an extended-XYZ file or a raw binary file
+and evaluated in chunks with the batch entry point of the library. A reader
+thread prepares the next chunks while the current one is evaluated (the
+library releases the GIL), so memory use is bounded by a few chunks
+regardless of the length of the trajectory. For example:
+
+    python python/trajectory.py md.xyz -o results --rc 20 --rd 6 \\
+        --charges Si=4 O=6
+
+writes energies.npy (frames,), forces.npy (frames, n, 3), and stresses.npy
+(frames, 6) to the directory results as memory-mapped arrays, together with
+progress.json, which records the frames completed so far. Rerunning with
+--resume continues an interrupted run from there.
+
+A raw binary file holds, for each frame, the lattice vectors (as rows) and
+then the positions of the n ions as (x, y, z) triples, all as little-endian
+float64. Its charges are the same in every frame and are given separately.
+"""
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+
+import numpy as np
+
+import real_space_electrostatic_sum
+
+#______________________________________________________________________________
+#                                                                  readers
+
+def read_extxyz(path, charges=None, start=0):
+    """Yield the frames (a, r, z) of an extended-XYZ file, from frame start.
+
+    a has the lattice vectors as rows and r is an (n, 3) array of positions.
+    The charges are read from a 'charge' or 'initial_charges' column if the
+    file has one, and otherwise from charges, a dict of charge by species.
+    """
+    with open(path) as f:
+        k = 0
+        while True:
+            line = f.readline()
+            if not line.strip():
+                return
+            n = int(line)
+            if k < start:
+                for _ in range(n + 1):
+                    f.readline()
+            else:
+                header = f.readline()
+                lines = [f.readline() for _ in range(n)]
+                yield _parse_extxyz_frame(header, lines, charges, path, k)
+            k += 1
+
+def _parse_extxyz_frame(header, lines, charges, path, k):
+    info = {key: value.strip('"') for key, value
+            in re.findall(r'(\w+)=("[^"]*"|\S+)', header)}
+    if 'Lattice' not in info:
+        raise ValueError('{}: frame {} has no Lattice'.format(path, k))
+    a = np.array(info['Lattice'].split(), dtype=np.float64).reshape(3, 3)
+
+    # locate the columns from the Properties (name:type:count triples)
+    columns = {}
+    start = 0
+    fields = info.get('Properties', 'species:S:1:pos:R:3').split(':')
+    for name, count in zip(fields[0::3], fields[2::3]):
+        columns[name] = (start, start + int(count))
+        start += int(count)
+    table = [line.split() for line in lines]
+    i0, i1 = columns['pos']
+    r = np.array([row[i0:i1] for row in table], dtype=np.float64)
+    for name in ('charge', 'initial_charges'):
+        if name in columns:
+            i0, i1 = columns[name]
+            z = np.array([row[i0] for row in table], dtype=np.float64)
+            break
+    else:
+        if charges is None:
+            raise ValueError('{}: frame {} has no charges; give charges '
+                             'by species'.format(path, k))
+        i0, i1 = columns['species']
+        z = np.array([charges[row[i0]] for row in table], dtype=np.float64)
+    return a, r, z
+
+def read_binary(path, z, start=0):
+    """Yield the frames (a, r, z) of a raw binary file, from frame start.
+
+    z holds the charges of the n ions, which are the same in every frame.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    size = 8 * (9 + 3 * z.shape[0])
+    with open(path, 'rb') as f:
+        f.seek(start * size)
+        while True:
+            data = f.read(size)
+            if len(data) < size:
+                return
+            x = np.frombuffer(data, dtype='<f8')
+            yield x[:9].reshape(3, 3), x[9:].reshape(-1, 3), z
+
+def count_frames(path, n=None):
+    """Return the number of frames in a file (n ions per frame if binary)."""
+    if n is not None:
+        return os.path.getsize(path) // (8 * (9 + 3 * n))
+    count = 0
+    with open(path) as f:
+        while True:
+            line = f.readline()
+            if not line.strip():
+                return count
+            for _ in range(int(line) + 1):
+                f.readline()
+            count += 1
+
+#______________________________________________________________________________
+#                                                                 evaluate
+
+def evaluate(frames, rc, rd, chunk_size=64, prefetch=2):
+    """Yield (e, f, s) for each of frames, an iterable of (a, r, z).
+
+    f is an (n, 3) array. Frames are evaluated chunk_size at a time, with up
+    to prefetch further chunks read ahead in the background.
+    """
+    for n, e, f, s in evaluate_chunks(frames, rc, rd, chunk_size, prefetch):
+        offsets = np.concatenate(([0], np.cumsum(n)))
+        for k in range(n.shape[0]):
+            yield e[k], f[offsets[k]:offsets[k+1]], s[k]
+
+def evaluate_chunks(frames, rc, rd, chunk_size=64, prefetch=2):
+    """Yield (n, e, f, s) for consecutive chunks of frames.
+
+    n holds the number of ions in each frame of the chunk and f the forces of
+    all its ions, packed in order as an (n.sum(), 3) array.
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_chunks,
+                              args=(frames, chunk_size, chunks, stop),
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            a, n, r, z = chunk
+            e, fx, fy, fz, s = \
+                    real_space_electrostatic_sum.energy_force_stress_batch(
+                            a, n, r[:,0], r[:,1], r[:,2], z, rc, rd)
+            yield n, e, np.column_stack((fx, fy, fz)), s
+    finally:
+        # stop the reader if the chunks are abandoned early
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def _read_chunks(frames, chunk_size, chunks, stop):
+    # pack frames into chunks for the batch routine, in a background thread
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    try:
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) == chunk_size:
+                if not put(_pack(batch)):
+                    return
+                batch = []
+        if batch and not put(_pack(batch)):
+            return
+        put(None)
+    except Exception as error:
+        put(error)
+
+def _pack(batch):
+    a = np.array([x[0] for x in batch], dtype=np.float64)
+    n = np.array([len(x[2]) for x in batch], dtype=np.int32)
+    r = np.concatenate([x[1] for x in batch]).astype(np.float64, copy=False)
+    z = np.concatenate([x[2] for x in batch]).astype(np.float64, copy=False)
+    return a, n, np.ascontiguousarray(r), z
+
+#______________________________________________________________________________
+#                                                                      run
+
+def run(path, output, rc, rd, charges=None, binary=False, chunk_size=64,
+        prefetch=2, resume=False, max_frames=None):
+    """Evaluate a trajectory file into memory-mapped arrays in output.
+
+    For an extended-XYZ file, charges is an optional dict of charge by
+    species; for a binary file (binary=True), it holds the charge of each
+    ion. Every frame must have the same number of ions. With resume, a run
+    in output that was interrupted (or limited by max_frames) is continued
+    from the last completed chunk. Returns the number of frames evaluated.
+    """
+
+    # count the frames and ions
+    if binary:
+        charges = np.asarray(charges, dtype=np.float64)
+        n = charges.shape[0]
+        num_frames = count_frames(path, n)
+        frames = lambda start: read_binary(path, charges, start)
+    else:
+        num_frames = count_frames(path)
+        frames = lambda start: read_extxyz(path, charges, start)
+        n = next(frames(0))[1].shape[0] if num_frames > 0 else 0
+
+    # open the outputs, continuing a previous run if requested
+    progress_path = os.path.join(output, 'progress.json')
+    progress = {'input': os.path.abspath(path), 'rc': rc, 'rd': rd,
+                'num_frames': num_frames, 'num_ions': n, 'completed': 0}
+    names = ('energies', 'forces', 'stresses')
+    shapes = ((num_frames,), (num_frames, n, 3), (num_frames, 6))
+    if resume and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            previous = json.load(f)
+        if any(previous[key] != progress[key] for key in progress
+               if key != 'completed'):
+            raise ValueError('{} holds a run with different inputs'.format(
+                    output))
+        progress['completed'] = previous['completed']
+        mode = 'r+'
+    else:
+        os.makedirs(output, exist_ok=True)
+        mode = 'w+'
+    arrays = [np.lib.format.open_memmap(os.path.join(output, name + '.npy'),
+                                        mode=mode, dtype=np.float64,
+                                        shape=shape)
+              for name, shape in zip(names, shapes)]
+    energies, forces, stresses = arrays
+    _write_progress(progress_path, progress)
+
+    # evaluate the remaining frames, recording progress after each chunk
+    start = progress['completed']
+    stop = num_frames if max_frames is None else min(num_frames,
+                                                     start + max_frames)
+    k = start
+    chunks = evaluate_chunks(_frames_until(frames(start), stop - start,
+                                           n, path),
+                             rc, rd, chunk_size, prefetch)
+    for m, e, f, s in chunks:
+        count = m.shape[0]
+        energies[k:k+count] = e
+        forces[k:k+count] = f.reshape(count, n, 3)
+        stresses[k:k+count] = s
+        k += count
+        for x in arrays:
+            x.flush()
+        progress['completed'] = k
+        _write_progress(progress_path, progress)
+    return k - start
+
+def _frames_until(frames, count, n, path):
+    # the first count frames, which must have n ions each
+    for k, frame in zip(range(count), frames):
+        if frame[1].shape[0] != n:
+            raise ValueError('{}: every frame must have {} ions'.format(
+                    path, n))
+        yield frame
+
+def _write_progress(path, progress):
+    # write to a temporary file and rename, so the record is never partial
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+#______________________________________________________________________________
+#                                                                      cli
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', help='extended-XYZ or raw binary trajectory')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output directory')
+    parser.add_argument('--rc', type=float, required=True)
+    parser.add_argument('--rd', type=float, required=True)
+    parser.add_argument('--binary', action='store_true',
+                        help='the input is a raw binary file')
+    parser.add_argument('--charges', nargs='+',
+                        help='charges by species (e.g. Si=4 O=6) for '
+                             'extended XYZ, or a .npy or text file with the '
+                             'charge of each ion for binary input')
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='frames per library call')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='chunks read ahead of the evaluation')
+    parser.add_argument('--threads', type=int,
+                        help='threads per library call')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run in the output '
+                             'directory')
+    parser.add_argument('--max-frames', type=int,
+                        help='stop after this many frames (resume later)')
+    args = parser.parse_args(argv)
+
+    charges = None
+    if args.binary:
+        if not args.charges or len(args.charges) != 1:
+            parser.error('binary input requires --charges with a file')
+        if args.charges[0].endswith('.npy'):
+            charges = np.load(args.charges[0])
+        else:
+            charges = np.loadtxt(args.charges[0], ndmin=1)
+    elif args.charges:
+        charges = {}
+        for item in args.charges:
+            species, _, value = item.partition('=')
+            charges[species] = float(value)
+    if args.threads is not None:
+        real_space_electrostatic_sum.set_num_threads(args.threads)
+
+    count = run(args.input, args.output, args.rc, args.rd, charges,
+                binary=args.binary, chunk_size=args.chunk_size,
+                prefetch=args.prefetch, resume=args.resume,
+                max_frames=args.max_frames)
+    print('evaluated {} frames'.format(count), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# MIT License
+#
+# Copyright (c) 2019-2020 William C. Witt
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Automatic selection of (rc, rd) from a target accuracy.
+
+The cutoffs are chosen from a grid of candidates, rd = r_d_hat*s and
+rc = ratio*rd, where s = (V/n)**(1/3) is the mean spacing between ions. The
+error of each candidate is estimated against a tight reference evaluation of
+the same structure. The cost of an evaluation is set by the number of pairs
+within rc, which grows as rc**3 and does not depend on rd, so the candidate
+with the smallest rc that meets every target is returned (the smaller rd on
+ties). No timings are needed.
+
+Results are cached per cell shape (lattice metric, charges, and targets), so
+a high-throughput run over many structures of the same shape tunes once.
+"""
+
+import numpy as np
+
+import real_space_electrostatic_sum
+
+#______________________________________________________________________________
+#                                                               parameters
+
+# candidate cutoffs, in units of the mean ionic spacing (r_d_hat) and of rd
+r_d_hat_grid = np.arange(1.0, 3.01, 0.25)
+ratio_grid = np.arange(2.0, 5.51, 0.25)
+
+# reference cutoffs, used to estimate the errors of the candidates
+r_d_hat_reference = 3.0
+ratio_reference = 6.0
+
+# relative precision of the lattice metric in the cache key
+cache_precision = 1e-6
+
+# tuned cutoffs, keyed on cell shape, charges, and targets
+_cache = {}
+
+def clear_cache():
+    """Forget all tuned cutoffs."""
+    _cache.clear()
+
+#______________________________________________________________________________
+#                                                                     tune
+
+def tune(a, r, z, energy_tol=None, force_tol=None, stress_tol=None,
+         use_cache=True):
+    """Return the (rc, rd) with the smallest rc that meets the targets.
+
+    a is a (3, 3) array with the lattice vectors as rows, r an (n, 3) array
+    of positions, and z the charges. The targets are absolute errors: in the
+    total energy, in the largest force component, and in the largest stress
+    component. At least one must be given.
+
+    The errors are estimated for the structure r, so it should be
+    representative of the structures the cutoffs will be used for. Raises
+    ValueError if no candidate meets the targets.
+    """
+
+    if energy_tol is None and force_tol is None and stress_tol is None:
+        raise ValueError('at least one of energy_tol, force_tol, and '
+                         'stress_tol is required')
+    a = np.asarray(a, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    n = r.shape[0]
+
+    # return cached cutoffs for this cell shape if available
+    key = _cache_key(a, z, energy_tol, force_tol, stress_tol)
+    if use_cache and key in _cache:
+        return _cache[key]
+
+    # candidate cutoffs
+    vol = abs(np.linalg.det(a))
+    s = (vol / n)**(1.0/3.0)
+    rd, rc = [x.ravel() for x in np.meshgrid(r_d_hat_grid * s, ratio_grid)]
+    rc = rc * rd
+
+    # candidates from cheapest up: by rc, then by rd
+    order = np.lexsort((rd, rc))
+
+    # estimated errors (nan for candidates that are not evaluated)
+    err = _estimate_errors(a, r, z, s, rc, rd, order,
+                           energy_tol, force_tol, stress_tol)
+
+    # choose the cheapest candidate that meets every target
+    ok = np.ones(rc.shape[0], dtype=bool)
+    for tol, e in zip((energy_tol, force_tol, stress_tol), err):
+        if tol is not None:
+            ok &= e <= tol
+    if not np.any(ok):
+        raise ValueError('no candidate cutoffs meet the targets; '
+                         'consider looser tolerances')
+    best = [k for k in order if ok[k]][0]
+    result = (float(rc[best]), float(rd[best]))
+    if use_cache:
+        _cache[key] = result
+    return result
+
+def _cache_key(a, z, energy_tol, force_tol, stress_tol):
+    # the metric a*a^T is invariant to rotations of the cell
+    metric = a.dot(a.T)
+    scale = cache_precision * np.abs(metric).max()
+    return (tuple(np.round(metric / scale).astype(np.int64).ravel()),
+            tuple(np.sort(z)), energy_tol, force_tol, stress_tol)
+
+#______________________________________________________________________________
+#                                                                   errors
+
+def _estimate_errors(a, r, z, s, rc, rd, order,
+                     energy_tol, force_tol, stress_tol):
+    m = rc.shape[0]
+    err = [np.full(m, np.nan) for _ in range(3)]
+    rd_ref = r_d_hat_reference * s
+    rc_ref = ratio_reference * rd_ref
+
+    # energies of all candidates (and the reference) in a single pass
+    if energy_tol is not None:
+        e = real_space_electrostatic_sum.energy_sweep(
+                a[0], a[1], a[2], r.shape[0], r[:,0], r[:,1], r[:,2], z,
+                np.append(rc, rc_ref), np.append(rd, rd_ref))
+        err[0] = _envelope(rc, rd, np.abs(e[:-1] - e[-1]))
+
+    # forces and stresses require a full evaluation per candidate, so visit
+    # the candidates from cheapest up and stop at the first that succeeds
+    if force_tol is not None or stress_tol is not None:
+        calc = real_space_electrostatic_sum.Calculator(rc_ref, rd_ref)
+        _, f_ref, s_ref = calc.energy_force_stress(a, r, z,
+                                                   compute_energy=False)
+        for k in order:
+            if energy_tol is not None and not err[0][k] <= energy_tol:
+                continue
+            calc = real_space_electrostatic_sum.Calculator(rc[k], rd[k])
+            _, f, st = calc.energy_force_stress(a, r, z, compute_energy=False)
+            err[1][k] = np.abs(f - f_ref).max()
+            err[2][k] = np.abs(st - s_ref).max()
+            if ((force_tol is None or err[1][k] <= force_tol)
+                    and (stress_tol is None or err[2][k] <= stress_tol)):
+                break
+    return err
+
+def _envelope(rc, rd, err):
+    # the error is not monotonic in rc, so a candidate may happen to be
+    # accurate for this structure. guard against this by assigning each
+    # candidate the largest error of any candidate with the same rd and a
+    # larger rc.
+    env = err.copy()
+    for x in np.unique(rd):
+        i = np.flatnonzero(rd == x)
+        i = i[np.argsort(rc[i])]
+        env[i] = np.maximum.accumulate(err[i][::-1])[::-1]
+    return env
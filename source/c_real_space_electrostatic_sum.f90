@@ -22,11 +22,24 @@
 
 module c_real_space_electrostatic_sum
 
-    use iso_c_binding, only: c_double, c_int
+    use iso_c_binding, only: c_double, c_float, c_int, c_int64_t, c_ptr, c_null_ptr, &
+                             c_loc, c_f_pointer, c_associated
+    use, intrinsic :: ieee_arithmetic, only: ieee_value, ieee_quiet_nan
     use real_space_electrostatic_sum
 
     implicit none
 
+    ! mirrors struct c_real_space_electrostatic_sum_stats in the header
+    type, bind(c) :: c_stats
+        integer(c_int64_t)  ::  num_calls
+        integer(c_int64_t)  ::  num_images
+        integer(c_int64_t)  ::  num_candidates
+        integer(c_int64_t)  ::  num_pairs
+        real(c_double)      ::  setup_time
+        real(c_double)      ::  pair_time
+        real(c_double)      ::  correction_time
+    end type
+
 contains
 
 subroutine c_real_space_electrostatic_sum_energy(&
@@ -86,4 +99,507 @@ subroutine c_real_space_electrostatic_sum_stress(&
 
 end subroutine
 
+subroutine c_real_space_electrostatic_sum_energy_force_stress(&
+        a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+        do_e, do_f, do_s, e, fx, fy, fz, s) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  z(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_double), intent(out)  ::  e
+    real(c_double), intent(out)  ::  fx(n), fy(n), fz(n)
+    real(c_double), intent(out)  ::  s(6)
+!______________________________________________________________________________
+!
+    call energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                             do_e /= 0, do_f /= 0, do_s /= 0, &
+                             e, fx, fy, fz, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_energy_force_stress_f32(&
+        a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+        do_e, do_f, do_s, e, fx, fy, fz, s) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_float),  intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_float),  intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_float),  intent(in)   ::  z(n)
+    real(c_float),  intent(in)   ::  rc
+    real(c_float),  intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_float),  intent(out)  ::  e
+    real(c_float),  intent(out)  ::  fx(n), fy(n), fz(n)
+    real(c_float),  intent(out)  ::  s(6)
+!______________________________________________________________________________
+!
+    call energy_force_stress_sp(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                                do_e /= 0, do_f /= 0, do_s /= 0, &
+                                e, fx, fy, fz, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_energy_force_stress_range(&
+        a1, a2, a3, n, rx, ry, rz, z, rc, rd, i0, i1, &
+        do_e, do_f, do_s, e, fx, fy, fz, s) bind(c)
+!   (ions i0 to i1-1, zero-based; fx, fy, fz have length i1-i0). unless
+!   0 <= i0 <= i1 <= n, nothing is computed and e and s are nan.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  z(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  i0, i1
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_double), intent(out)  ::  e
+    real(c_double), intent(out)  ::  fx(i1-i0), fy(i1-i0), fz(i1-i0)
+    real(c_double), intent(out)  ::  s(6)
+!______________________________________________________________________________
+!
+    if (i0 < 0 .or. i1 < i0 .or. i1 > n) then
+        e = ieee_value(e, ieee_quiet_nan)
+        s = ieee_value(e, ieee_quiet_nan)
+        return
+    end if
+    call energy_force_stress_range(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+            i0+1, i1, do_e /= 0, do_f /= 0, do_s /= 0, e, fx, fy, fz, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_energy_force_stress_xyz(&
+        a, n, r, z, rc, rd, do_e, do_f, do_s, e, f, s) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a(3,3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  r(3,n)
+    real(c_double), intent(in)   ::  z(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_double), intent(out)  ::  e
+    real(c_double), intent(out)  ::  f(3,n)
+    real(c_double), intent(out)  ::  s(6)
+!______________________________________________________________________________
+!
+    call energy_force_stress_xyz(a, n, r, z, rc, rd, &
+                                 do_e /= 0, do_f /= 0, do_s /= 0, e, f, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_energy_sweep(&
+        a1, a2, a3, n, rx, ry, rz, z, m, rc, rd, e) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  z(n)
+    integer(c_int), intent(in)   ::  m
+    real(c_double), intent(in)   ::  rc(m)
+    real(c_double), intent(in)   ::  rd(m)
+    real(c_double), intent(out)  ::  e(m)
+!______________________________________________________________________________
+!
+    call energy_sweep(a1, a2, a3, n, rx, ry, rz, z, m, rc, rd, e)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_energy_force_stress_batch(&
+        nf, n, a, rx, ry, rz, z, rc, rd, &
+        do_e, do_f, do_s, e, fx, fy, fz, s) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer(c_int), intent(in)   ::  nf
+    integer(c_int), intent(in)   ::  n(nf)
+    real(c_double), intent(in)   ::  a(3,3,nf)
+    real(c_double), intent(in)   ::  rx(*), ry(*), rz(*)
+    real(c_double), intent(in)   ::  z(*)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_double), intent(out)  ::  e(nf)
+    real(c_double), intent(out)  ::  fx(*), fy(*), fz(*)
+    real(c_double), intent(out)  ::  s(6,nf)
+!______________________________________________________________________________
+!
+    call energy_force_stress_batch(nf, n, a, rx, ry, rz, z, rc, rd, &
+                                   do_e /= 0, do_f /= 0, do_s /= 0, &
+                                   e, fx, fy, fz, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_neighbor_list_create(skin, nl) &
+        bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  skin
+    type(c_ptr),    intent(out)  ::  nl
+
+    type(neighbor_list), pointer ::  nl_f
+!______________________________________________________________________________
+!
+    allocate(nl_f)
+    call neighbor_list_init(nl_f, skin)
+    nl = c_loc(nl_f)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_neighbor_list_destroy(nl) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), intent(inout)   ::  nl
+
+    type(neighbor_list), pointer ::  nl_f
+!______________________________________________________________________________
+!
+    if (.not. c_associated(nl)) return
+    call c_f_pointer(nl, nl_f)
+    deallocate(nl_f)
+    nl = c_null_ptr
+
+end subroutine
+
+subroutine c_neighbor_list_energy_force_stress(&
+        nl, a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+        do_e, do_f, do_s, e, fx, fy, fz, s) bind(c, name=&
+        'c_real_space_electrostatic_sum_neighbor_list_energy_force_stress')
+!   (the fortran name is shortened to stay within the 63-character limit)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  nl
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  z(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    integer(c_int), intent(in)   ::  do_e, do_f, do_s
+    real(c_double), intent(out)  ::  e
+    real(c_double), intent(out)  ::  fx(n), fy(n), fz(n)
+    real(c_double), intent(out)  ::  s(6)
+
+    type(neighbor_list), pointer ::  nl_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(nl, nl_f)
+    call neighbor_list_energy_force_stress(nl_f, &
+            a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+            do_e /= 0, do_f /= 0, do_s /= 0, e, fx, fy, fz, s)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_neighbor_list_num_builds(&
+        nl, nbuilds) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  nl
+    integer(c_int), intent(out)  ::  nbuilds
+
+    type(neighbor_list), pointer ::  nl_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(nl, nl_f)
+    nbuilds = nl_f%nbuilds
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_create(&
+        a1, a2, a3, n, rx, ry, rz, z, rc, rd, mc) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  z(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    type(c_ptr),    intent(out)  ::  mc
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    allocate(mc_f)
+    call mc_init(mc_f, a1, a2, a3, n, rx, ry, rz, z, rc, rd)
+    mc = c_loc(mc_f)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_destroy(mc) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), intent(inout)   ::  mc
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    if (.not. c_associated(mc)) return
+    call c_f_pointer(mc, mc_f)
+    deallocate(mc_f)
+    mc = c_null_ptr
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_propose_move(&
+        mc, k, x, y, z, de) bind(c)
+!   (k is zero-based)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  mc
+    integer(c_int), intent(in)   ::  k
+    real(c_double), intent(in)   ::  x, y, z
+    real(c_double), intent(out)  ::  de
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(mc, mc_f)
+    call mc_propose_move(mc_f, k + 1, x, y, z, de)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_propose_swap(mc, k, l, de) &
+        bind(c)
+!   (k and l are zero-based)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  mc
+    integer(c_int), intent(in)   ::  k, l
+    real(c_double), intent(out)  ::  de
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(mc, mc_f)
+    call mc_propose_swap(mc_f, k + 1, l + 1, de)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_accept(mc) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  mc
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(mc, mc_f)
+    call mc_accept(mc_f)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_mc_energy(mc, e) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  mc
+    real(c_double), intent(out)  ::  e
+
+    type(mc_state), pointer ::  mc_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(mc, mc_f)
+    e = mc_f%e
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_site_matrix_create(&
+        a1, a2, a3, n, rx, ry, rz, rc, rd, sm) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer(c_int), intent(in)   ::  n
+    real(c_double), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(c_double), intent(in)   ::  rc
+    real(c_double), intent(in)   ::  rd
+    type(c_ptr),    intent(out)  ::  sm
+
+    type(site_matrix), pointer ::  sm_f
+!______________________________________________________________________________
+!
+    allocate(sm_f)
+    call site_matrix_init(sm_f, a1, a2, a3, n, rx, ry, rz, rc, rd)
+    sm = c_loc(sm_f)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_site_matrix_destroy(sm) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), intent(inout)   ::  sm
+
+    type(site_matrix), pointer ::  sm_f
+!______________________________________________________________________________
+!
+    if (.not. c_associated(sm)) return
+    call c_f_pointer(sm, sm_f)
+    deallocate(sm_f)
+    sm = c_null_ptr
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_site_matrix_energy(&
+        sm, z, e, v, dedz) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_ptr), value           ::  sm
+    real(c_double), intent(in)   ::  z(*)
+    real(c_double), intent(out)  ::  e
+    real(c_double), intent(out)  ::  v(*)
+    real(c_double), intent(out)  ::  dedz(*)
+
+    type(site_matrix), pointer ::  sm_f
+!______________________________________________________________________________
+!
+    call c_f_pointer(sm, sm_f)
+    call site_matrix_energy(sm_f, z(1:sm_f%n), e, v(1:sm_f%n), dedz(1:sm_f%n))
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_set_table_tolerance(tol) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(in)   ::  tol
+!______________________________________________________________________________
+!
+    call set_table_tolerance(tol)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_get_table_tolerance(tol) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(out)  ::  tol
+!______________________________________________________________________________
+!
+    tol = table_tol
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_get_table_error(err) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(c_double), intent(out)  ::  err
+!______________________________________________________________________________
+!
+    err = get_table_error()
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_set_stats_enabled(enabled) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer(c_int), intent(in)   ::  enabled
+!______________________________________________________________________________
+!
+    call set_stats_enabled(enabled /= 0)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_get_stats(st) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(c_stats), intent(out)   ::  st
+!______________________________________________________________________________
+!
+    st%num_calls = stats%ncalls
+    st%num_images = stats%nimages
+    st%num_candidates = stats%ncandidates
+    st%num_pairs = stats%npairs
+    st%setup_time = stats%t_setup
+    st%pair_time = stats%t_pairs
+    st%correction_time = stats%t_correction
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_reset_stats() bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+!______________________________________________________________________________
+!
+    call reset_stats()
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_set_num_threads(nt) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer(c_int), intent(in)   ::  nt
+!______________________________________________________________________________
+!
+    call set_num_threads(nt)
+
+end subroutine
+
+subroutine c_real_space_electrostatic_sum_get_num_threads(nt) bind(c)
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer(c_int), intent(out)  ::  nt
+!______________________________________________________________________________
+!
+    nt = effective_num_threads()
+
+end subroutine
+
 end module
@@ -22,13 +22,134 @@
 
 module real_space_electrostatic_sum
 
+    use, intrinsic :: ieee_arithmetic, only: ieee_value, ieee_quiet_nan
+
     implicit none
 
+    integer,  parameter  ::  sp = 4
     integer,  parameter  ::  dp = 8
+    integer,  parameter  ::  i8 = selected_int_kind(18)
     real(dp), parameter  ::  pi = 3.14159265358979323846264338327950288419_dp
     real(dp), parameter  ::  sqrt_pi = sqrt(pi)
     real(dp), parameter  ::  one_third = 1.0_dp/3.0_dp
 
+    ! periodic images of the ions, binned on a regular grid (linked cells).
+    ! the images in bin b are stored contiguously in x/y/z/src at positions
+    ! start(b) to start(b+1)-1, and home(i) is the position of the unshifted
+    ! image of ion i.
+    type :: cell_list
+        integer               ::  nimg = 0
+        integer               ::  nb(3), reach(3)
+        real(dp)              ::  lo(3), w(3)
+        real(dp), allocatable ::  x(:), y(:), z(:)
+        integer,  allocatable ::  src(:), start(:), home(:)
+    end type
+
+    ! lattice translations t(:,k) = shift(1,k)*a1 + shift(2,k)*a2 +
+    ! shift(3,k)*a3 for which some point of the translated cell lies within rc
+    ! of some point of the cell. t(:,k0) is the zero translation.
+    type :: translation_list
+        real(dp)              ::  a(3,3) = 0.0_dp, rc = -1.0_dp
+        integer               ::  nt = 0, k0 = 0
+        real(dp), allocatable ::  t(:,:)
+        integer,  allocatable ::  shift(:,:)
+    end type
+
+    ! the most recently built translation list
+    type(translation_list), save  ::  cached_translations
+
+    ! persistent (Verlet) neighbor list. the neighbors of ion i are stored at
+    ! positions start(i) to start(i+1)-1 as the source ion j and the lattice
+    ! translation (tx, ty, tz) of its image. the list holds every image within
+    ! rc + skin when it is built, so it remains valid until an ion has moved
+    ! by more than skin/2 or the lattice changes.
+    type :: neighbor_list
+        real(dp)              ::  skin = 0.0_dp
+        integer               ::  n = 0, mmax = 0, nbuilds = 0
+        real(dp)              ::  rc = -1.0_dp, a(3,3) = 0.0_dp
+        real(dp), allocatable ::  x0(:), y0(:), z0(:)
+        real(dp), allocatable ::  tx(:), ty(:), tz(:)
+        integer,  allocatable ::  j(:), start(:)
+    end type
+
+    ! monte carlo state: the current configuration, its energy e, and the
+    ! charge q(i) within rc of each ion. a proposed move of the ions moved(1:nm)
+    ! to positions r_new with charges z_new is held, together with the energy
+    ! change de and the resulting change dq in q, until it is accepted; dq is
+    ! zero except for the ions touched(1:ntouched), which are flagged in
+    ! listed. the positions are kept inside the cell (ainv is the inverse of
+    ! a) and binned on a grid of nb(1) x nb(2) x nb(3) bins in fractional
+    ! coordinates, in which rc spans rf(d) along direction d. bin c has cap
+    ! slots, from (c-1)*cap+1, of which the first count(c) hold the positions
+    ! (bx, by, bz) and source ions (bsrc) of the ions in the bin; bin(i) and
+    ! slot(i) locate ion i. dx to g are buffers for the neighbors of a moved
+    ! ion, as in sum_over_ions.
+    type :: mc_state
+        integer               ::  n = 0, nm = 0, moved(2) = 0, ntouched = 0
+        integer               ::  nb(3), cap = 0
+        real(dp)              ::  a(3,3), ainv(3,3), rf(3), rc, rd, rho, e
+        real(dp)              ::  r_new(3,2), z_new(2), de
+        real(dp), allocatable ::  r(:,:), z(:), q(:), dq(:)
+        real(dp), allocatable ::  bx(:), by(:), bz(:)
+        integer,  allocatable ::  touched(:), count(:), bsrc(:), bin(:), slot(:)
+        logical,  allocatable ::  listed(:)
+        real(dp), allocatable ::  dx(:), dy(:), dz(:), zq(:), rr(:), ef(:), g(:)
+        integer,  allocatable ::  idx(:)
+        type(translation_list) ::  tl
+    end type
+
+    ! pair terms of a fixed geometry, for energies of many charge vectors. p(j,i)
+    ! is the sum of erfc(r/rd)/r over the images of ion j within rc of ion i,
+    ! and c(j,i) the number of those images; both are symmetric.
+    type :: site_matrix
+        integer               ::  n = 0
+        real(dp)              ::  rd, vol
+        real(dp), allocatable ::  p(:,:), c(:,:)
+    end type
+
+    ! target bin width as a fraction of the cutoff
+    real(dp), parameter  ::  bin_width_rc = 0.5_dp
+
+    ! number of threads requested through set_num_threads (0 for default)
+    integer  ::  num_threads = 0
+
+    ! cubic interpolation tables for erfc(r/rd) (f) and for the force/stress
+    ! factor 2/sqrt(pi)*(r/rd)*exp(-(r/rd)**2) + erfc(r/rd) (g) on a uniform
+    ! grid over [0, rmax]. interval k holds the polynomial coefficients in
+    ! cf(:,k) and cg(:,k), in powers of the fractional position u in [0, 1).
+    ! err is the error achieved, which exceeds tol if the table reached
+    ! max_table_intervals, and users counts the kernels reading the table.
+    type :: erfc_table
+        real(dp)              ::  rd = -1.0_dp, rmax = -1.0_dp, tol = -1.0_dp
+        real(dp)              ::  err = 0.0_dp
+        real(dp)              ::  inv_h = 0.0_dp
+        integer               ::  nint = 0
+        integer               ::  users = 0
+        real(dp), allocatable ::  cf(:,:), cg(:,:)
+    end type
+
+    ! error tolerance for the interpolation tables (0 for exact evaluation),
+    ! the error achieved by the most recently used table, and the cached table
+    real(dp)  ::  table_tol = 0.0_dp
+    real(dp)  ::  table_err = 0.0_dp
+    type(erfc_table), target, save  ::  cached_table
+
+    ! upper limit on the number of table intervals
+    integer,  parameter  ::  max_table_intervals = 2**20
+
+    ! instrumentation, accumulated over calls while stats_enabled is set:
+    ! kernel calls, periodic images visited while binning, candidate pairs
+    ! tested against rc, pairs accepted within rc, and wall times (seconds)
+    ! spent in setup, in the pair loop, and on the correction terms. when
+    ! disabled, the kernels skip all counting and timing.
+    type :: kernel_stats
+        integer(i8)  ::  ncalls = 0, nimages = 0, ncandidates = 0, npairs = 0
+        real(dp)     ::  t_setup = 0.0_dp, t_pairs = 0.0_dp, &
+                         t_correction = 0.0_dp
+    end type
+    logical  ::  stats_enabled = .false.
+    type(kernel_stats), save  ::  stats
+
 contains
 
 subroutine energy(a1, a2, a3, n, rx, ry, rz, z, rc, rd, e)
@@ -44,91 +165,157 @@ subroutine energy(a1, a2, a3, n, rx, ry, rz, z, rc, rd, e)
     real(dp), intent(in)   ::  rd
     real(dp), intent(out)  ::  e
 
-    real(dp) ::  vol, rho, ei, qi, rij, a(3,3), bt(3,3), &
-                 d_100, d_010, d_001, origin_j(3), xyz_ij(3), ra
-    integer  ::  i, j, shift1, shift2, shift3, &
-                 shift1max, shift2max, shift3max
+    real(dp) ::  s(6)
+    real(dp), allocatable ::  fx(:), fy(:), fz(:)
 !______________________________________________________________________________
 !
-    ! compute cell volume and average density
-    vol = a1(1) * (a2(2)*a3(3) - a2(3)*a3(2)) + &
-          a1(2) * (a2(3)*a3(1) - a2(1)*a3(3)) + &
-          a1(3) * (a2(1)*a3(2) - a2(2)*a3(1))
-    vol = abs(vol) ! for left-handed coordinate systems
-    rho = sum(z) / vol
+    allocate(fx(n), fy(n), fz(n))
+    call energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                             .true., .false., .false., e, fx, fy, fz, s)
 
-    ! compute reciprocal lattice vectors
-    a(:,1) = a1;  a(:,2) = a2;  a(:,3) = a3
-    call invert_3x3(a, bt)  ! note: bt still missing factor of 2*pi
+end subroutine
 
-    ! compute distances between planes (accounts for missing 2*pi in bt)
-    d_100 = 1.0_dp / sqrt(sum(bt(1,:) * bt(1,:)))
-    d_010 = 1.0_dp / sqrt(sum(bt(2,:) * bt(2,:)))
-    d_001 = 1.0_dp / sqrt(sum(bt(3,:) * bt(3,:)))
+subroutine force(a1, a2, a3, n, rx, ry, rz, z, rc, rd, fx, fy, fz)
+!______________________________________________________________________________
+!
+    implicit none
 
-    ! compute the number of cells to include along each direction
-    shift1max = ceiling(rc / d_100)
-    shift2max = ceiling(rc / d_010)
-    shift3max = ceiling(rc / d_001)
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    real(dp), intent(out)  ::  fx(n), fy(n), fz(n)
 
-    ! prepare for loop over ions in cell
-    e = 0.0_dp
+    real(dp) ::  e, s(6)
+!______________________________________________________________________________
+!
+    call energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                             .false., .true., .false., e, fx, fy, fz, s)
 
-    ! loop over ions in cell
-    do i = 1, n
-    
-        ! prepare for loop over neighboring ions
-        ei = 0.0_dp
-        qi = z(i)  ! b/c the i==j part of the sum is skipped below
+end subroutine
 
-        ! loop over cells
-        do shift3 = -shift3max, shift3max
-        do shift2 = -shift2max, shift2max
-        do shift1 = -shift1max, shift1max
+subroutine stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, s)
+!______________________________________________________________________________
+!
+    implicit none
 
-            ! get origin of shifted cell and loop over ions in that cell
-            origin_j = shift1*a1 + shift2*a2 + shift3*a3            
-            do j = 1, n
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    real(dp), intent(out)  ::  s(6)
 
-                ! exclude i==j
-                if (i==j .and. shift1==0 .and. shift2==0 .and. shift3==0) cycle
+    real(dp) ::  e
+    real(dp), allocatable ::  fx(:), fy(:), fz(:)
+!______________________________________________________________________________
+!
+    allocate(fx(n), fy(n), fz(n))
+    call energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                             .false., .false., .true., e, fx, fy, fz, s)
 
-                ! compute distance between points
-                xyz_ij = (/rx(i), ry(i), rz(i)/) &
-                                - (origin_j + (/rx(j), ry(j), rz(j)/))
-                rij = sqrt(sum(xyz_ij * xyz_ij))
+end subroutine
 
-                ! only proceed if rij < rc
-                if (rij > rc) cycle
+subroutine energy_force_stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                               do_e, do_f, do_s, e, fx, fy, fz, s)
+!______________________________________________________________________________
+!
+!   computes any subset of the energy, forces, and stress with a single pass
+!   over the pairs. outputs that are not requested are set to zero.
+!______________________________________________________________________________
+!
+    implicit none
 
-                ! update energy and charge
-                ei = ei + z(j) * erfc(rij/rd) / rij
-                qi = qi + z(j)
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(:), ry(:), rz(:)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  fx(:), fy(:), fz(:)
+    real(dp), intent(out)  ::  s(6)
 
-            end do  ! j
+    real(dp) ::  t0
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    ! bin the periodic images of the ions
+    if (stats_enabled) t0 = wall_time()
+    call build_cell_list(a1, a2, a3, n, rx, ry, rz, rc, cl)
+    if (stats_enabled) call add_stats(t_setup=wall_time()-t0)
 
-        end do  ! shift1
-        end do  ! shift2
-        end do  ! shift3
+    ! sum over the ions in the cell
+    call sum_over_ions(n, rx, ry, rz, z, rc, rd, cell_volume(a1, a2, a3), &
+                       do_e, do_f, do_s, e, fx, fy, fz, s, cl=cl)
 
-        ! apply 1/2 z(i) factor to energy
-        ei = 0.5_dp * z(i) * ei
-    
-        ! add correction terms
-        ra = (3.0_dp * qi / (4.0_dp * pi * rho))**one_third  ! adaptive cutoff
-        ei = ei - pi * z(i) * rho * ra * ra  &
-              + pi * z(i) * rho * (ra*ra - rd*rd/2.0_dp) * erf(ra/rd)  &
-              + sqrt_pi * z(i) * rho * ra * rd * exp(-ra*ra/(rd*rd)) &
-              - 1.0/(sqrt_pi * rd) * z(i) * z(i)
+end subroutine
 
-        ! increment the total energy
-        e = e + ei
+subroutine energy_force_stress_sp(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                                  do_e, do_f, do_s, e, fx, fy, fz, s)
+!______________________________________________________________________________
+!
+!   single-precision variant of energy_force_stress, for screening. the pair
+!   terms are evaluated in single precision and accumulated in double
+!   precision, giving relative errors of about 1e-6.
+!______________________________________________________________________________
+!
+    implicit none
 
-    end do  ! i
+    real(sp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(sp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(sp), intent(in)   ::  z(n)
+    real(sp), intent(in)   ::  rc
+    real(sp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(sp), intent(out)  ::  e
+    real(sp), intent(out)  ::  fx(n), fy(n), fz(n)
+    real(sp), intent(out)  ::  s(6)
+
+    real(dp) ::  b1(3), b2(3), b3(3), e_dp, s_dp(6), t0
+    real(dp), allocatable ::  x(:), y(:), w(:), q(:), gx(:), gy(:), gz(:)
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    ! the images are binned and displaced in double precision, so that only
+    ! the pair terms are affected by the lower precision
+    b1 = a1;  b2 = a2;  b3 = a3
+    allocate(x(n), y(n), w(n), q(n), gx(n), gy(n), gz(n))
+    x = rx;  y = ry;  w = rz;  q = z
+
+    ! bin the periodic images of the ions
+    if (stats_enabled) t0 = wall_time()
+    call build_cell_list(b1, b2, b3, n, x, y, w, real(rc, dp), cl)
+    if (stats_enabled) call add_stats(t_setup=wall_time()-t0)
+
+    ! sum over the ions in the cell
+    call sum_over_ions(n, x, y, w, q, real(rc, dp), real(rd, dp), &
+                       cell_volume(b1, b2, b3), do_e, do_f, do_s, &
+                       e_dp, gx, gy, gz, s_dp, cl=cl, single=.true.)
+    e = real(e_dp, sp)
+    fx = real(gx, sp);  fy = real(gy, sp);  fz = real(gz, sp)
+    s = real(s_dp, sp)
 
 end subroutine
 
-subroutine force(a1, a2, a3, n, rx, ry, rz, z, rc, rd, fx, fy, fz)
+subroutine energy_force_stress_range(a1, a2, a3, n, rx, ry, rz, z, rc, rd, &
+                                     first, last, do_e, do_f, do_s, &
+                                     e, fx, fy, fz, s)
+!______________________________________________________________________________
+!
+!   same as energy_force_stress, but only for the terms of the outer sum that
+!   belong to ions first to last: their forces, and their contributions to
+!   the energy and stress. summing e and s over ranges that partition 1 to n
+!   gives the totals, so the ions can be shared among processes. only the
+!   pair sums are split, though: each range still scans all n ions for every
+!   lattice translation whose images can reach its ions (o(n) work per range,
+!   o(n*nt) when the range spans the cell), so the setup is repeated by every
+!   process rather than shared.
 !______________________________________________________________________________
 !
     implicit none
@@ -139,192 +326,2203 @@ subroutine force(a1, a2, a3, n, rx, ry, rz, z, rc, rd, fx, fy, fz)
     real(dp), intent(in)   ::  z(n)
     real(dp), intent(in)   ::  rc
     real(dp), intent(in)   ::  rd
-    real(dp), intent(out)  ::  fx(n), fy(n), fz(n)
+    integer,  intent(in)   ::  first, last
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  fx(first:last), fy(first:last), fz(first:last)
+    real(dp), intent(out)  ::  s(6)
 
-    real(dp) ::  rij, rijrij, rij_rd, a(3,3), bt(3,3), &
-                 d_100, d_010, d_001, origin_j(3), xyz_ij(3), t
-    integer  ::  i, j, shift1, shift2, shift3, &
-                 shift1max, shift2max, shift3max
+    real(dp) ::  t0
+    type(cell_list) ::  cl
 !______________________________________________________________________________
 !
-    ! compute reciprocal lattice vectors
-    a(:,1) = a1;  a(:,2) = a2;  a(:,3) = a3
-    call invert_3x3(a, bt)  ! note: bt still missing factor of 2*pi
+    e = 0.0_dp
+    s = 0.0_dp
+    if (last < first) return
 
-    ! compute distances between planes (accounts for missing 2*pi in bt)
-    d_100 = 1.0_dp / sqrt(sum(bt(1,:) * bt(1,:)))
-    d_010 = 1.0_dp / sqrt(sum(bt(2,:) * bt(2,:)))
-    d_001 = 1.0_dp / sqrt(sum(bt(3,:) * bt(3,:)))
+    ! bin the periodic images near the ions in the range
+    if (stats_enabled) t0 = wall_time()
+    call build_cell_list(a1, a2, a3, n, rx, ry, rz, rc, cl, first, last)
+    if (stats_enabled) call add_stats(t_setup=wall_time()-t0)
 
-    ! compute the number of cells to include along each direction
-    shift1max = ceiling(rc / d_100)
-    shift2max = ceiling(rc / d_010)
-    shift3max = ceiling(rc / d_001)
+    ! sum over the ions in the range
+    call sum_over_ions(n, rx, ry, rz, z, rc, rd, cell_volume(a1, a2, a3), &
+                       do_e, do_f, do_s, e, fx, fy, fz, s, &
+                       cl=cl, first=first, last=last)
 
-    ! prepare for loop over ions in cell
-    fx = 0.0_dp
-    fy = 0.0_dp
-    fz = 0.0_dp
+end subroutine
+
+subroutine energy_force_stress_xyz(a, n, r, z, rc, rd, &
+                                   do_e, do_f, do_s, e, f, s)
+!______________________________________________________________________________
+!
+!   same as energy_force_stress, but with the lattice vectors in the columns
+!   of a and with interleaved positions r(:,i) and forces f(:,i), which
+!   matches row-major (n, 3) arrays in c or numpy. the positions are read and
+!   the forces written in place, through strided sections, without repacking.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)   ::  a(3,3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  r(3,n)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  f(3,n)
+    real(dp), intent(out)  ::  s(6)
+!______________________________________________________________________________
+!
+    call energy_force_stress(a(:,1), a(:,2), a(:,3), n, r(1,:), r(2,:), &
+                             r(3,:), z, rc, rd, do_e, do_f, do_s, &
+                             e, f(1,:), f(2,:), f(3,:), s)
+
+end subroutine
+
+subroutine energy_sweep(a1, a2, a3, n, rx, ry, rz, z, m, rc, rd, e)
+!______________________________________________________________________________
+!
+!   computes the energy for m pairs of cutoffs (rc(k), rd(k)). the images
+!   within maxval(rc) are gathered once per ion and sorted by distance, and
+!   each rd is then handled by a single sweep over the sorted pairs in order
+!   of increasing rc.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  z(n)
+    integer,  intent(in)   ::  m
+    real(dp), intent(in)   ::  rc(m)
+    real(dp), intent(in)   ::  rd(m)
+    real(dp), intent(out)  ::  e(m)
+
+    real(dp) ::  rho, rcmax, ei, qi, ra
+    real(dp), allocatable ::  dx(:), dy(:), dz(:), r(:), zr(:), e_ik(:,:)
+    integer,  allocatable ::  idx(:)
+    integer  ::  i, k, kk, p, np, order(m)
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    e = 0.0_dp
+    if (m < 1) return
+
+    ! compute average density
+    rho = sum(z) / cell_volume(a1, a2, a3)
+
+    ! order the cutoffs by rd, then by rc
+    call sort_cutoffs(m, rc, rd, order)
+
+    ! bin the periodic images of the ions for the largest cutoff
+    rcmax = maxval(rc)
+    call build_cell_list(a1, a2, a3, n, rx, ry, rz, rcmax, cl)
+
+    ! per-ion energies are summed in a fixed order afterward
+    allocate(e_ik(m,n))
+
+    !$omp parallel num_threads(effective_num_threads()) default(shared) &
+    !$omp     private(i, k, kk, p, np, ei, qi, ra, dx, dy, dz, idx, r, zr)
+    allocate(dx(cl%nimg), dy(cl%nimg), dz(cl%nimg), idx(cl%nimg), &
+             r(cl%nimg), zr(cl%nimg))
 
     ! loop over ions in cell
+    !$omp do schedule(dynamic)
     do i = 1, n
-    
-        ! loop over cells
-        do shift3 = -shift3max, shift3max
-        do shift2 = -shift2max, shift2max
-        do shift1 = -shift1max, shift1max
 
-            ! get origin of shifted cell and loop over ions in that cell
-            origin_j = shift1*a1 + shift2*a2 + shift3*a3            
-            do j = 1, n
+        ! gather the images within the largest cutoff and sort by distance
+        call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), rcmax, &
+                              np, dx, dy, dz, idx)
+        r(1:np) = sqrt(dx(1:np)**2 + dy(1:np)**2 + dz(1:np)**2)
+        zr(1:np) = z(idx(1:np))
+        call sort_by_key(np, r, zr)
+
+        ! sweep over the cutoffs, restarting whenever rd changes
+        do kk = 1, m
+            k = order(kk)
+            if (kk == 1) then
+                p = 0
+            else if (rd(k) /= rd(order(kk-1))) then
+                p = 0
+            end if
+            if (p == 0) then
+                ei = 0.0_dp
+                qi = z(i)  ! b/c the i==j part of the sum is skipped
+            end if
+            do while (p < np)
+                if (r(p+1) > rc(k)) exit
+                p = p + 1
+                ei = ei + zr(p) * erfc(r(p)/rd(k)) / r(p)
+                qi = qi + zr(p)
+            end do
+            ra = (3.0_dp * qi / (4.0_dp * pi * rho))**one_third
+            e_ik(k,i) = 0.5_dp * z(i) * ei + energy_correction(z(i), ra, rho, rd(k))
+        end do
 
-                ! exclude i==j
-                if (i==j .and. shift1==0 .and. shift2==0 .and. shift3==0) cycle
+    end do  ! i
+    !$omp end do
+
+    deallocate(dx, dy, dz, idx, r, zr)
+    !$omp end parallel
+
+    ! sum the per-ion contributions in order
+    do i = 1, n
+        e = e + e_ik(:,i)
+    end do
 
-                ! compute distance between points
-                xyz_ij = (/rx(i), ry(i), rz(i)/) &
-                                - (origin_j + (/rx(j), ry(j), rz(j)/))
-                rijrij = sum(xyz_ij * xyz_ij)
-                rij = sqrt(rijrij)
-                rij_rd = rij / rd
+end subroutine
 
-                ! only proceed if rij < rc
-                if (rij > rc) cycle
+subroutine sort_cutoffs(m, rc, rd, order)
+!______________________________________________________________________________
+!
+!   returns the permutation that orders the cutoffs by rd, then by rc
+!   (insertion sort; m is expected to be modest).
+!______________________________________________________________________________
+!
+    implicit none
 
-                ! compute common term
-                t = z(j) * & 
-                    (2.0_dp / sqrt_pi * rij_rd * exp(-rij_rd * rij_rd) &
-                        + erfc(rij_rd)) / (rij * rijrij)
+    integer,  intent(in)   ::  m
+    real(dp), intent(in)   ::  rc(m), rd(m)
+    integer,  intent(out)  ::  order(m)
 
-                ! add contributions to forces
-                fx(i) = fx(i) + t * xyz_ij(1)
-                fy(i) = fy(i) + t * xyz_ij(2)
-                fz(i) = fz(i) + t * xyz_ij(3)
+    integer  ::  k, kk, t
+!______________________________________________________________________________
+!
+    order = (/(k, k = 1, m)/)
+    do k = 2, m
+        t = order(k)
+        kk = k - 1
+        do while (kk >= 1)
+            if (rd(order(kk)) < rd(t)) exit
+            if (rd(order(kk)) == rd(t) .and. rc(order(kk)) <= rc(t)) exit
+            order(kk+1) = order(kk)
+            kk = kk - 1
+        end do
+        order(kk+1) = t
+    end do
 
-            end do  ! j
+end subroutine
 
-        end do  ! shift1
-        end do  ! shift2
-        end do  ! shift3
+subroutine sort_by_key(np, key, val)
+!______________________________________________________________________________
+!
+!   sorts key(1:np) in increasing order (heapsort), permuting val alongside.
+!______________________________________________________________________________
+!
+    implicit none
 
-        ! apply z(i) factor
-        fx(i) = z(i) * fx(i)
-        fy(i) = z(i) * fy(i)
-        fz(i) = z(i) * fz(i)
+    integer,  intent(in)     ::  np
+    real(dp), intent(inout)  ::  key(:), val(:)
 
-    end do  ! i
+    real(dp) ::  tk, tv
+    integer  ::  i, j, l, ir
+!______________________________________________________________________________
+!
+    if (np < 2) return
+    l = np / 2 + 1
+    ir = np
+    do
+        if (l > 1) then
+            l = l - 1
+            tk = key(l);  tv = val(l)
+        else
+            tk = key(ir);  tv = val(ir)
+            key(ir) = key(1);  val(ir) = val(1)
+            ir = ir - 1
+            if (ir == 1) then
+                key(1) = tk;  val(1) = tv
+                return
+            end if
+        end if
+        i = l
+        j = l + l
+        do while (j <= ir)
+            if (j < ir) then
+                if (key(j) < key(j+1)) j = j + 1
+            end if
+            if (tk < key(j)) then
+                key(i) = key(j);  val(i) = val(j)
+                i = j
+                j = j + j
+            else
+                j = ir + 1
+            end if
+        end do
+        key(i) = tk;  val(i) = tv
+    end do
 
 end subroutine
 
-subroutine stress(a1, a2, a3, n, rx, ry, rz, z, rc, rd, s)
+subroutine energy_force_stress_batch(nf, n, a, rx, ry, rz, z, rc, rd, &
+                                     do_e, do_f, do_s, e, fx, fy, fz, s)
+!______________________________________________________________________________
+!
+!   evaluates energy_force_stress for nf frames in a packed layout. frame k
+!   has n(k) ions, lattice vectors a(:,1,k), a(:,2,k), a(:,3,k), and its ions
+!   follow those of frames 1 to k-1 in rx, ry, rz, z, fx, fy, and fz.
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer,  intent(in)   ::  nf
+    integer,  intent(in)   ::  n(nf)
+    real(dp), intent(in)   ::  a(3,3,nf)
+    real(dp), intent(in)   ::  rx(*), ry(*), rz(*)
+    real(dp), intent(in)   ::  z(*)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e(nf)
+    real(dp), intent(out)  ::  fx(*), fy(*), fz(*)
+    real(dp), intent(out)  ::  s(6,nf)
+
+    integer  ::  k, offset(nf)
+!______________________________________________________________________________
+!
+    ! locate the first ion of each frame
+    offset(1) = 0
+    do k = 2, nf
+        offset(k) = offset(k-1) + n(k-1)
+    end do
+
+    ! loop over frames (in parallel when there are enough of them, in which
+    ! case each frame is evaluated by a single thread)
+    !$omp parallel do schedule(dynamic) num_threads(effective_num_threads()) &
+    !$omp     if(nf >= effective_num_threads())
+    do k = 1, nf
+        call energy_force_stress(a(:,1,k), a(:,2,k), a(:,3,k), n(k), &
+                rx(offset(k)+1:offset(k)+n(k)), ry(offset(k)+1:offset(k)+n(k)), &
+                rz(offset(k)+1:offset(k)+n(k)), z(offset(k)+1:offset(k)+n(k)), &
+                rc, rd, do_e, do_f, do_s, e(k), &
+                fx(offset(k)+1:offset(k)+n(k)), fy(offset(k)+1:offset(k)+n(k)), &
+                fz(offset(k)+1:offset(k)+n(k)), s(:,k))
+    end do
+    !$omp end parallel do
+
+end subroutine
+
+subroutine sum_over_ions(n, rx, ry, rz, z, rc, rd, vol, &
+                         do_e, do_f, do_s, e, fx, fy, fz, s, cl, nl, q, &
+                         first, last, single)
+!______________________________________________________________________________
+!
+!   the main loop shared by the kernels. the neighbors of each ion are taken
+!   from either a cell list (cl) or a neighbor list (nl); exactly one should
+!   be present. if present, q returns the charge within rc of each ion (the
+!   qi that determines its adaptive cutoff). if first and last are present,
+!   only the contributions of ions first to last are computed: their forces
+!   and charges within rc, and their parts of the energy and stress. fx, fy,
+!   fz and q then hold ions first to last only (element i-first+1 is ion i),
+!   so no arrays of size n are allocated for the range. if
+!   single is present and true, the pair terms are evaluated in single
+!   precision (and accumulated in double precision).
 !______________________________________________________________________________
 !
     implicit none
 
-    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
     integer,  intent(in)   ::  n
-    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  rx(:), ry(:), rz(:)
     real(dp), intent(in)   ::  z(n)
     real(dp), intent(in)   ::  rc
     real(dp), intent(in)   ::  rd
+    real(dp), intent(in)   ::  vol
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  fx(:), fy(:), fz(:)
     real(dp), intent(out)  ::  s(6)
-
-    real(dp) ::  vol, rho, qi, rij, rijrij, rij_rd, a(3,3), bt(3,3), &
-                 d_100, d_010, d_001, origin_j(3), xyz_ij(3), t, si(6), &
-                 ra, ra_rd
-    integer  ::  i, j, shift1, shift2, shift3, &
-                 shift1max, shift2max, shift3max
+    type(cell_list),     intent(in), optional  ::  cl
+    type(neighbor_list), intent(in), optional  ::  nl
+    real(dp), intent(out), optional            ::  q(:)
+    integer,  intent(in), optional             ::  first, last
+    logical,  intent(in), optional             ::  single
+
+    real(dp) ::  rho, ei, qi, t, fi(3), si(6), ra, ra_rd, clock(3)
+    real(dp), allocatable ::  dx(:), dy(:), dz(:), zq(:), r(:), ef(:), g(:), &
+                              e_i(:), s_i(:,:), q_i(:)
+    real(sp), allocatable ::  r_sp(:), ef_sp(:), g_sp(:)
+    integer,  allocatable ::  idx(:)
+    integer  ::  i, m, mmax, nc, ilo, ihi
+    integer(i8)  ::  ncandidates, npairs
+    logical  ::  use_table, use_sp
+    type(erfc_table), pointer ::  tab
 !______________________________________________________________________________
 !
-    ! compute cell volume and average density
-    vol = a1(1) * (a2(2)*a3(3) - a2(3)*a3(2)) + &
-          a1(2) * (a2(3)*a3(1) - a2(1)*a3(3)) + &
-          a1(3) * (a2(1)*a3(2) - a2(2)*a3(1))
-    vol = abs(vol) ! for left-handed coordinate systems
+    ! compute average density
     rho = sum(z) / vol
 
-    ! compute reciprocal lattice vectors
-    a(:,1) = a1;  a(:,2) = a2;  a(:,3) = a3
-    call invert_3x3(a, bt)  ! note: bt still missing factor of 2*pi
-
-    ! compute distances between planes (accounts for missing 2*pi in bt)
-    d_100 = 1.0_dp / sqrt(sum(bt(1,:) * bt(1,:)))
-    d_010 = 1.0_dp / sqrt(sum(bt(2,:) * bt(2,:)))
-    d_001 = 1.0_dp / sqrt(sum(bt(3,:) * bt(3,:)))
+    ! range of ions to sum over
+    ilo = 1
+    ihi = n
+    if (present(first)) ilo = first
+    if (present(last)) ihi = last
+
+    ! fetch the interpolation tables, if requested (the single-precision
+    ! kernel always evaluates erfc and exp directly)
+    if (stats_enabled) clock(1) = wall_time()
+    use_sp = .false.
+    if (present(single)) use_sp = single
+    use_table = table_tol > 0.0_dp .and. .not. use_sp
+    nullify(tab)
+    if (use_table) call get_erfc_table(rd, rc, table_tol, tab)
+
+    ! size of the neighbor buffers
+    if (present(cl)) then
+        mmax = cl%nimg
+    else
+        mmax = nl%mmax
+    end if
+
+    ! prepare for loop over ions in cell (per-ion energies and stresses are
+    ! summed in a fixed order afterward, so results do not depend on threads)
+    allocate(e_i(ilo:ihi), s_i(6,ilo:ihi), q_i(ilo:ihi))
+    e_i = 0.0_dp
+    s_i = 0.0_dp
+    q_i = 0.0_dp
+    fx = 0.0_dp
+    fy = 0.0_dp
+    fz = 0.0_dp
+    ncandidates = 0
+    npairs = 0
+    if (stats_enabled) clock(2) = wall_time()
+
+    !$omp parallel num_threads(effective_num_threads()) default(shared) &
+    !$omp     private(i, m, nc, ei, qi, fi, si, dx, dy, dz, zq, idx, &
+    !$omp             r, ef, g, r_sp, ef_sp, g_sp)
+    allocate(dx(mmax), dy(mmax), dz(mmax), zq(mmax), idx(mmax))
+    if (use_sp) then
+        allocate(r_sp(mmax), ef_sp(mmax), g_sp(mmax))
+    else
+        allocate(r(mmax), ef(mmax), g(mmax))
+    end if
 
-    ! compute the number of cells to include along each direction
-    shift1max = ceiling(rc / d_100)
-    shift2max = ceiling(rc / d_010)
-    shift3max = ceiling(rc / d_001)
+    ! loop over ions in cell
+    !$omp do schedule(dynamic) reduction(+:ncandidates, npairs)
+    do i = ilo, ihi
+
+        ! find the images within rc (the i==j part of the sum is excluded)
+        if (present(cl)) then
+            if (stats_enabled) then
+                call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), &
+                                      rc, m, dx, dy, dz, idx, nc)
+                ncandidates = ncandidates + nc
+            else
+                call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), &
+                                      rc, m, dx, dy, dz, idx)
+            end if
+        else
+            call gather_from_list(nl, i, n, rx, ry, rz, rc, m, dx, dy, dz, idx)
+            if (stats_enabled) ncandidates = ncandidates &
+                                   + (nl%start(i+1) - nl%start(i))
+        end if
+        if (stats_enabled) npairs = npairs + m
+
+        ! gather the charges, so the pair terms run over contiguous arrays
+        zq(1:m) = z(idx(1:m))
+        qi = z(i) + sum(zq(1:m))  ! z(i) b/c the i==j part of the sum is skipped
+
+        ! evaluate the pair terms
+        if (use_sp) then
+            call pair_terms_sp(m, dx, dy, dz, zq, rd, do_e, do_f, do_s, &
+                               r_sp, ef_sp, g_sp, ei, fi, si)
+        else
+            call pair_terms(m, dx, dy, dz, zq, rd, tab, use_table, &
+                            do_e, do_f, do_s, r, ef, g, ei, fi, si)
+        end if
+
+        ! store the charge within rc, which sets the adaptive cutoff
+        q_i(i) = qi
+
+        ! energy: apply 1/2 z(i) factor
+        if (do_e) e_i(i) = 0.5_dp * z(i) * ei
+
+        ! forces: apply z(i) factor
+        if (do_f) then
+            fx(i-ilo+1) = z(i) * fi(1)
+            fy(i-ilo+1) = z(i) * fi(2)
+            fz(i-ilo+1) = z(i) * fi(3)
+        end if
+
+        ! stress: apply factor of -z(i) / (2 * volume)
+        if (do_s) s_i(:,i) = -z(i) / (2.0_dp * vol) * si
 
-    ! prepare for loop over ions in cell
+    end do  ! i
+    !$omp end do
+
+    deallocate(dx, dy, dz, zq, idx)
+    if (use_sp) then
+        deallocate(r_sp, ef_sp, g_sp)
+    else
+        deallocate(r, ef, g)
+    end if
+    !$omp end parallel
+    if (use_table) call release_erfc_table(tab)
+    if (stats_enabled) clock(3) = wall_time()
+
+    ! add the correction terms, which depend on the adaptive cutoffs
+    !$omp parallel do num_threads(effective_num_threads()) &
+    !$omp     private(ra, ra_rd, t) schedule(static)
+    do i = ilo, ihi
+
+        ! compute adaptive cutoff for the correction terms
+        ra = (3.0_dp * q_i(i) / (4.0_dp * pi * rho))**one_third
+
+        ! energy: add correction terms
+        if (do_e) e_i(i) = e_i(i) + energy_correction(z(i), ra, rho, rd)
+
+        ! stress: add remaining terms
+        if (do_s) then
+            ra_rd = ra / rd
+            t = pi / (2.0_dp * vol) * rd * rd * rho * z(i) &
+                * (1.0_dp - 2.0/sqrt_pi * ra_rd * exp(-ra_rd * ra_rd) &
+                    + (2.0_dp / 3.0_dp * ra_rd * ra_rd - 1.0_dp) * erfc(ra_rd))
+            s_i(1:3,i) = s_i(1:3,i) + t
+        end if
+
+    end do
+    !$omp end parallel do
+    if (present(q)) q = q_i
+
+    ! sum the per-ion contributions in order
+    e = 0.0_dp
     s = 0.0_dp
+    do i = ilo, ihi
+        e = e + e_i(i)
+        s = s + s_i(:,i)
+    end do
 
-    ! loop over ions in cell
-    do i = 1, n
-    
-        ! prepare for loop over neighboring ions
-        si = 0.0_dp
-        qi = z(i)  ! b/c the i==j part of the sum is skipped below
-        
-        ! loop over cells
-        do shift3 = -shift3max, shift3max
-        do shift2 = -shift2max, shift2max
-        do shift1 = -shift1max, shift1max
+    ! record the counters and timings
+    if (stats_enabled) call add_stats(ncalls=1_i8, ncandidates=ncandidates, &
+            npairs=npairs, t_setup=clock(2)-clock(1), &
+            t_pairs=clock(3)-clock(2), t_correction=wall_time()-clock(3))
 
-            ! get origin of shifted cell and loop over ions in that cell
-            origin_j = shift1*a1 + shift2*a2 + shift3*a3            
-            do j = 1, n
-
-                ! exclude i==j
-                if (i==j .and. shift1==0 .and. shift2==0 .and. shift3==0) cycle
-
-                ! compute distance between points
-                xyz_ij = (/rx(i), ry(i), rz(i)/) &
-                                - (origin_j + (/rx(j), ry(j), rz(j)/))
-                rijrij = sum(xyz_ij * xyz_ij)
-                rij = sqrt(rijrij)
-                rij_rd = rij / rd
-
-                ! only proceed if rij < rc
-                if (rij > rc) cycle
-
-                ! compute common term
-                t = z(j) * & 
-                    (2.0_dp / sqrt_pi * rij_rd * exp(-rij_rd * rij_rd) &
-                        + erfc(rij_rd)) / (rij * rijrij)
-
-                ! add contributions to stresses and charge
-                si(1:3) = si(1:3) + t * xyz_ij(1:3) * xyz_ij(1:3)
-                si(4) = si(4) + t * xyz_ij(2) * xyz_ij(3)
-                si(5) = si(5) + t * xyz_ij(1) * xyz_ij(3)
-                si(6) = si(6) + t * xyz_ij(1) * xyz_ij(2)
-                qi = qi + z(j)
-
-            end do  ! j
-
-        end do  ! shift1
-        end do  ! shift2
-        end do  ! shift3
-
-        ! apply factor of -z(i) / (2 * volume)
-        si = -z(i) / (2.0_dp * vol) * si
-    
-        ! add remaining terms
-        ra = (3.0_dp * qi / (4.0_dp * pi * rho))**one_third  ! adaptive cutoff
-        ra_rd = ra / rd
-        t = pi / (2.0_dp * vol) * rd * rd * rho * z(i) &
-            * (1.0_dp - 2.0/sqrt_pi * ra_rd * exp(-ra_rd * ra_rd) &
-                + (2.0_dp / 3.0_dp * ra_rd * ra_rd - 1.0_dp) * erfc(ra_rd))
-        si(1:3) = si(1:3) + t
-
-        ! increment the total stress
-        s = s + si
+end subroutine
 
-    end do  ! i
+subroutine pair_terms(m, dx, dy, dz, zq, rd, tab, use_table, &
+                      do_e, do_f, do_s, r, ef, g, ei, fi, si)
+!______________________________________________________________________________
+!
+!   sums the pair terms of one ion over its m neighbors, given the
+!   displacements (dx, dy, dz) and charges (zq) of the neighbors. returns the
+!   sums of zq*erfc(r/rd)/r (ei), of t*(dx, dy, dz) (fi), and of t times the
+!   products of displacements (si), where t = zq*g/r**3 and g is the force/
+!   stress factor. each loop runs over contiguous arrays without branches, so
+!   it can be vectorized; r, ef, and g are workspace. tab is only referenced
+!   if use_table is true.
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer,  intent(in)   ::  m
+    real(dp), intent(in)   ::  dx(m), dy(m), dz(m), zq(m)
+    real(dp), intent(in)   ::  rd
+    type(erfc_table), pointer, intent(in)  ::  tab
+    logical,  intent(in)   ::  use_table, do_e, do_f, do_s
+    real(dp), intent(out)  ::  r(m), ef(m), g(m)
+    real(dp), intent(out)  ::  ei, fi(3), si(6)
+
+    real(dp) ::  x, u, f1, f2, f3, s1, s2, s3, s4, s5, s6
+    integer  ::  k, l
+!______________________________________________________________________________
+!
+    ! distances
+    !$omp simd
+    do k = 1, m
+        r(k) = sqrt(dx(k)*dx(k) + dy(k)*dy(k) + dz(k)*dz(k))
+    end do
+
+    ! erfc (and the force/stress factor) exactly or from tables
+    if (use_table) then
+        !$omp simd private(x, u, l)
+        do k = 1, m
+            x = r(k) * tab%inv_h
+            l = min(int(x), tab%nint)
+            u = x - l
+            l = l + 1
+            ef(k) = tab%cf(0,l) + u * (tab%cf(1,l) &
+                        + u * (tab%cf(2,l) + u * tab%cf(3,l)))
+            g(k) = tab%cg(0,l) + u * (tab%cg(1,l) &
+                       + u * (tab%cg(2,l) + u * tab%cg(3,l)))
+        end do
+    else
+        do k = 1, m
+            ef(k) = erfc(r(k) / rd)
+        end do
+        if (do_f .or. do_s) then
+            !$omp simd private(x)
+            do k = 1, m
+                x = r(k) / rd
+                g(k) = 2.0_dp / sqrt_pi * x * exp(-x * x) + ef(k)
+            end do
+        end if
+    end if
+
+    ! energy
+    ei = 0.0_dp
+    if (do_e) then
+        !$omp simd reduction(+:ei)
+        do k = 1, m
+            ei = ei + zq(k) * ef(k) / r(k)
+        end do
+    end if
+
+    ! the forces and stress share a common term
+    fi = 0.0_dp
+    si = 0.0_dp
+    if (.not. (do_f .or. do_s)) return
+    !$omp simd
+    do k = 1, m
+        g(k) = zq(k) * g(k) / (r(k) * r(k) * r(k))
+    end do
+
+    ! forces
+    if (do_f) then
+        f1 = 0.0_dp;  f2 = 0.0_dp;  f3 = 0.0_dp
+        !$omp simd reduction(+:f1, f2, f3)
+        do k = 1, m
+            f1 = f1 + g(k) * dx(k)
+            f2 = f2 + g(k) * dy(k)
+            f3 = f3 + g(k) * dz(k)
+        end do
+        fi = (/f1, f2, f3/)
+    end if
+
+    ! stresses
+    if (do_s) then
+        s1 = 0.0_dp;  s2 = 0.0_dp;  s3 = 0.0_dp
+        s4 = 0.0_dp;  s5 = 0.0_dp;  s6 = 0.0_dp
+        !$omp simd reduction(+:s1, s2, s3, s4, s5, s6)
+        do k = 1, m
+            s1 = s1 + g(k) * dx(k) * dx(k)
+            s2 = s2 + g(k) * dy(k) * dy(k)
+            s3 = s3 + g(k) * dz(k) * dz(k)
+            s4 = s4 + g(k) * dy(k) * dz(k)
+            s5 = s5 + g(k) * dx(k) * dz(k)
+            s6 = s6 + g(k) * dx(k) * dy(k)
+        end do
+        si = (/s1, s2, s3, s4, s5, s6/)
+    end if
+
+end subroutine
+
+subroutine pair_terms_sp(m, dx, dy, dz, zq, rd, do_e, do_f, do_s, &
+                         r, ef, g, ei, fi, si)
+!______________________________________________________________________________
+!
+!   same as pair_terms, but evaluates the terms in single precision (without
+!   tables). the sums are accumulated in double precision.
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer,  intent(in)   ::  m
+    real(dp), intent(in)   ::  dx(m), dy(m), dz(m), zq(m)
+    real(dp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(sp), intent(out)  ::  r(m), ef(m), g(m)
+    real(dp), intent(out)  ::  ei, fi(3), si(6)
+
+    real(sp) ::  x, inv_rd
+    real(dp) ::  f1, f2, f3, s1, s2, s3, s4, s5, s6
+    integer  ::  k
+!______________________________________________________________________________
+!
+    ! distances
+    !$omp simd
+    do k = 1, m
+        r(k) = sqrt(real(dx(k)*dx(k) + dy(k)*dy(k) + dz(k)*dz(k), sp))
+    end do
+
+    ! erfc (and the force/stress factor)
+    inv_rd = real(1.0_dp / rd, sp)
+    do k = 1, m
+        ef(k) = erfc(r(k) * inv_rd)
+    end do
+    if (do_f .or. do_s) then
+        !$omp simd private(x)
+        do k = 1, m
+            x = r(k) * inv_rd
+            g(k) = real(2.0_dp / sqrt_pi, sp) * x * exp(-x * x) + ef(k)
+        end do
+    end if
+
+    ! energy
+    ei = 0.0_dp
+    if (do_e) then
+        !$omp simd reduction(+:ei)
+        do k = 1, m
+            ei = ei + real(real(zq(k), sp) * ef(k) / r(k), dp)
+        end do
+    end if
+
+    ! the forces and stress share a common term
+    fi = 0.0_dp
+    si = 0.0_dp
+    if (.not. (do_f .or. do_s)) return
+    !$omp simd
+    do k = 1, m
+        g(k) = real(zq(k), sp) * g(k) / (r(k) * r(k) * r(k))
+    end do
+
+    ! forces
+    if (do_f) then
+        f1 = 0.0_dp;  f2 = 0.0_dp;  f3 = 0.0_dp
+        !$omp simd reduction(+:f1, f2, f3)
+        do k = 1, m
+            f1 = f1 + g(k) * dx(k)
+            f2 = f2 + g(k) * dy(k)
+            f3 = f3 + g(k) * dz(k)
+        end do
+        fi = (/f1, f2, f3/)
+    end if
+
+    ! stresses
+    if (do_s) then
+        s1 = 0.0_dp;  s2 = 0.0_dp;  s3 = 0.0_dp
+        s4 = 0.0_dp;  s5 = 0.0_dp;  s6 = 0.0_dp
+        !$omp simd reduction(+:s1, s2, s3, s4, s5, s6)
+        do k = 1, m
+            s1 = s1 + g(k) * dx(k) * dx(k)
+            s2 = s2 + g(k) * dy(k) * dy(k)
+            s3 = s3 + g(k) * dz(k) * dz(k)
+            s4 = s4 + g(k) * dy(k) * dz(k)
+            s5 = s5 + g(k) * dx(k) * dz(k)
+            s6 = s6 + g(k) * dx(k) * dy(k)
+        end do
+        si = (/s1, s2, s3, s4, s5, s6/)
+    end if
+
+end subroutine
+
+subroutine neighbor_list_init(nl, skin)
+!______________________________________________________________________________
+!
+!   prepares an empty neighbor list; it is built on first use.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(neighbor_list), intent(out) ::  nl
+    real(dp), intent(in)             ::  skin
+!______________________________________________________________________________
+!
+    nl%skin = max(0.0_dp, skin)
 
 end subroutine
 
+subroutine neighbor_list_energy_force_stress(nl, a1, a2, a3, n, rx, ry, rz, &
+                                             z, rc, rd, do_e, do_f, do_s, &
+                                             e, fx, fy, fz, s)
+!______________________________________________________________________________
+!
+!   same as energy_force_stress, but takes the neighbors from a persistent
+!   neighbor list, which is rebuilt only when necessary.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(neighbor_list), intent(inout) ::  nl
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+    logical,  intent(in)   ::  do_e, do_f, do_s
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  fx(n), fy(n), fz(n)
+    real(dp), intent(out)  ::  s(6)
+
+    real(dp) ::  t0
+!______________________________________________________________________________
+!
+    ! rebuild the list if necessary
+    if (stats_enabled) t0 = wall_time()
+    call neighbor_list_update(nl, a1, a2, a3, n, rx, ry, rz, rc)
+    if (stats_enabled) call add_stats(t_setup=wall_time()-t0)
+
+    ! sum over the ions in the cell
+    call sum_over_ions(n, rx, ry, rz, z, rc, rd, cell_volume(a1, a2, a3), &
+                       do_e, do_f, do_s, e, fx, fy, fz, s, nl=nl)
+
+end subroutine
+
+subroutine neighbor_list_update(nl, a1, a2, a3, n, rx, ry, rz, rc)
+!______________________________________________________________________________
+!
+!   rebuilds the neighbor list if the number of ions, the lattice, or the
+!   cutoff has changed, or if any ion has moved by more than half the skin
+!   since the last build.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(neighbor_list), intent(inout) ::  nl
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  rc
+
+    real(dp) ::  rl, half_skin2
+    real(dp), allocatable ::  dx(:), dy(:), dz(:)
+    integer,  allocatable ::  idx(:)
+    integer  ::  i, k, m, p
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    ! check whether the current list is still valid
+    if (nl%nbuilds > 0 .and. nl%n == n .and. nl%rc == rc &
+            .and. all(nl%a(:,1) == a1) .and. all(nl%a(:,2) == a2) &
+            .and. all(nl%a(:,3) == a3)) then
+        half_skin2 = 0.25_dp * nl%skin * nl%skin
+        if (maxval((rx - nl%x0)**2 + (ry - nl%y0)**2 + (rz - nl%z0)**2) &
+                <= half_skin2) return
+    end if
+
+    ! record the state at this build
+    nl%n = n
+    nl%rc = rc
+    nl%a(:,1) = a1;  nl%a(:,2) = a2;  nl%a(:,3) = a3
+    nl%x0 = rx;  nl%y0 = ry;  nl%z0 = rz
+    nl%nbuilds = nl%nbuilds + 1
+
+    ! bin the periodic images of the ions using the extended cutoff
+    rl = rc + nl%skin
+    call build_cell_list(a1, a2, a3, n, rx, ry, rz, rl, cl)
+    allocate(dx(cl%nimg), dy(cl%nimg), dz(cl%nimg), idx(cl%nimg))
+
+    ! count the neighbors of each ion
+    if (allocated(nl%start)) deallocate(nl%start)
+    allocate(nl%start(n+1))
+    nl%start(1) = 1
+    nl%mmax = 0
+    do i = 1, n
+        call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), rl, &
+                              m, dx, dy, dz, idx)
+        nl%start(i+1) = nl%start(i) + m
+        nl%mmax = max(nl%mmax, m)
+    end do
+
+    ! store the neighbors as (source ion, lattice translation) pairs
+    if (allocated(nl%j)) deallocate(nl%j, nl%tx, nl%ty, nl%tz)
+    allocate(nl%j(nl%start(n+1)-1), nl%tx(nl%start(n+1)-1), &
+             nl%ty(nl%start(n+1)-1), nl%tz(nl%start(n+1)-1))
+    do i = 1, n
+        call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), rl, &
+                              m, dx, dy, dz, idx)
+        do k = 1, m
+            p = nl%start(i) + k - 1
+            nl%j(p) = idx(k)
+            nl%tx(p) = (rx(i) - dx(k)) - rx(idx(k))
+            nl%ty(p) = (ry(i) - dy(k)) - ry(idx(k))
+            nl%tz(p) = (rz(i) - dz(k)) - rz(idx(k))
+        end do
+    end do
+
+end subroutine
+
+subroutine gather_from_list(nl, i, n, rx, ry, rz, rc, m, dx, dy, dz, idx)
+!______________________________________________________________________________
+!
+!   collects the neighbors of ion i within rc from a neighbor list. returns
+!   the displacements (ion minus image) and the source ion of each.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(neighbor_list), intent(in) ::  nl
+    integer,  intent(in)            ::  i
+    integer,  intent(in)            ::  n
+    real(dp), intent(in)            ::  rx(:), ry(:), rz(:)
+    real(dp), intent(in)            ::  rc
+    integer,  intent(out)           ::  m
+    real(dp), intent(out)           ::  dx(:), dy(:), dz(:)
+    integer,  intent(out)           ::  idx(:)
+
+    real(dp) ::  ddx, ddy, ddz, rc2
+    integer  ::  j, p
+!______________________________________________________________________________
+!
+    rc2 = rc * rc
+    m = 0
+    do p = nl%start(i), nl%start(i+1) - 1
+        j = nl%j(p)
+        ddx = rx(i) - (rx(j) + nl%tx(p))
+        ddy = ry(i) - (ry(j) + nl%ty(p))
+        ddz = rz(i) - (rz(j) + nl%tz(p))
+        dx(m+1) = ddx;  dy(m+1) = ddy;  dz(m+1) = ddz
+        idx(m+1) = j
+        m = m + merge(1, 0, ddx*ddx + ddy*ddy + ddz*ddz <= rc2)
+    end do
+
+end subroutine
+
+subroutine mc_init(mc, a1, a2, a3, n, rx, ry, rz, z, rc, rd)
+!______________________________________________________________________________
+!
+!   prepares a monte carlo state for the given configuration, including a
+!   full evaluation of its energy. the positions are mapped into the cell,
+!   and the ions are binned for the proposals.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(out)  ::  mc
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  z(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+
+    real(dp) ::  s(6), vol, h(3), scale
+    real(dp), allocatable ::  fx(:), fy(:), fz(:), f(:,:)
+    integer  ::  d, mmax
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    ! store the configuration
+    mc%n = n
+    mc%a(:,1) = a1;  mc%a(:,2) = a2;  mc%a(:,3) = a3
+    mc%rc = rc
+    mc%rd = rd
+    allocate(mc%r(3,n), mc%z(n), mc%q(n), mc%dq(n), mc%touched(n), &
+             mc%listed(n))
+    mc%z = z
+    mc%dq = 0.0_dp
+    mc%listed = .false.
+    mc%ntouched = 0
+
+    ! wrap the positions into the cell
+    call invert_3x3(mc%a, mc%ainv)
+    allocate(f(3,n))
+    f(1,:) = rx;  f(2,:) = ry;  f(3,:) = rz
+    f = matmul(mc%ainv, f)
+    f = f - floor(f)
+    mc%r = matmul(mc%a, f)
+    vol = cell_volume(a1, a2, a3)
+    mc%rho = sum(z) / vol
+
+    ! evaluate the energy and the charge within rc of each ion
+    allocate(fx(n), fy(n), fz(n))
+    call build_cell_list(a1, a2, a3, n, mc%r(1,:), mc%r(2,:), mc%r(3,:), &
+                         rc, cl)
+    call sum_over_ions(n, mc%r(1,:), mc%r(2,:), mc%r(3,:), z, rc, rd, vol, &
+                       .true., .false., .false., mc%e, fx, fy, fz, s, &
+                       cl=cl, q=mc%q)
+
+    ! choose bins of width ~bin_width_rc*rc along each lattice direction (h
+    ! is the spacing of the lattice planes), but no more bins than ions
+    do d = 1, 3
+        h(d) = 1.0_dp / sqrt(sum(mc%ainv(d,:)**2))
+    end do
+    mc%nb = max(1, floor(h / (bin_width_rc * rc)))
+    if (product(real(mc%nb, dp)) > real(max(n, 27), dp)) then
+        scale = (real(max(n, 27), dp) / product(real(mc%nb, dp)))**one_third
+        mc%nb = max(1, floor(mc%nb * scale))
+    end if
+    mc%rf = rc / h
+
+    ! bin the ions
+    allocate(mc%bin(n), mc%slot(n))
+    call mc_rebin(mc)
+
+    ! a search visits at most 2*rf*nb+2 bins along each direction, and so
+    ! each bin at most this many times over nb
+    mmax = n * product(ceiling((2.0_dp * mc%rf * mc%nb + 2.0_dp) / mc%nb))
+    allocate(mc%dx(mmax+1), mc%dy(mmax+1), mc%dz(mmax+1), mc%zq(mmax+1), &
+             mc%rr(mmax+1), mc%ef(mmax+1), mc%g(mmax+1), mc%idx(mmax+1))
+
+    ! the translations are reused for the pairs of moved ions
+    call get_translation_list(a1, a2, a3, rc, mc%tl)
+
+end subroutine
+
+subroutine mc_propose_move(mc, k, x, y, z, de)
+!______________________________________________________________________________
+!
+!   proposes moving ion k to (x, y, z) and returns the change in energy. the
+!   new position is mapped back into the cell. if k is not an ion (1 to n),
+!   nothing is proposed and de is nan.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    integer,  intent(in)   ::  k
+    real(dp), intent(in)   ::  x, y, z
+    real(dp), intent(out)  ::  de
+
+    real(dp) ::  f(3)
+!______________________________________________________________________________
+!
+    mc%nm = 0
+    if (k < 1 .or. k > mc%n) then
+        de = ieee_value(de, ieee_quiet_nan)
+        return
+    end if
+
+    ! wrap the new position into the cell
+    f = matmul(mc%ainv, (/x, y, z/))
+    f = f - floor(f)
+
+    mc%nm = 1
+    mc%moved(1) = k
+    mc%r_new(:,1) = matmul(mc%a, f)
+    mc%z_new(1) = mc%z(k)
+    call mc_delta(mc)
+    de = mc%de
+
+end subroutine
+
+subroutine mc_propose_swap(mc, k, l, de)
+!______________________________________________________________________________
+!
+!   proposes exchanging the charges of ions k and l and returns the change
+!   in energy. if k or l is not an ion (1 to n), nothing is proposed and de
+!   is nan.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    integer,  intent(in)   ::  k, l
+    real(dp), intent(out)  ::  de
+!______________________________________________________________________________
+!
+    mc%nm = 0
+    if (k < 1 .or. k > mc%n .or. l < 1 .or. l > mc%n) then
+        de = ieee_value(de, ieee_quiet_nan)
+        return
+    end if
+    if (k == l .or. mc%z(k) == mc%z(l)) then
+        de = 0.0_dp
+        return
+    end if
+    mc%nm = 2
+    mc%moved = (/k, l/)
+    mc%r_new(:,1) = mc%r(:,k)
+    mc%r_new(:,2) = mc%r(:,l)
+    mc%z_new = (/mc%z(l), mc%z(k)/)
+    call mc_delta(mc)
+    de = mc%de
+
+end subroutine
+
+subroutine mc_accept(mc)
+!______________________________________________________________________________
+!
+!   applies the most recent proposal (if any) to the state, moving the ions
+!   to their new bins.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+
+    integer  ::  b, i, p, c
+!______________________________________________________________________________
+!
+    if (mc%nm == 0) return
+    do p = 1, mc%ntouched
+        i = mc%touched(p)
+        mc%q(i) = mc%q(i) + mc%dq(i)
+    end do
+    do b = 1, mc%nm
+        i = mc%moved(b)
+        mc%r(:,i) = mc%r_new(:,b)
+        mc%z(i) = mc%z_new(b)
+        c = mc_bin(mc, mc%r(:,i))
+        if (c == mc%bin(i)) then
+            mc%bx(mc%slot(i)) = mc%r(1,i)
+            mc%by(mc%slot(i)) = mc%r(2,i)
+            mc%bz(mc%slot(i)) = mc%r(3,i)
+        else
+            call mc_unlink(mc, i)
+            call mc_link(mc, i, c)
+        end if
+    end do
+    mc%e = mc%e + mc%de
+    mc%nm = 0
+
+end subroutine
+
+subroutine mc_delta(mc)
+!______________________________________________________________________________
+!
+!   computes the energy change de (and the changes dq in the charges within
+!   rc) for the proposal stored in mc. only the pairs involving the moved
+!   ions are evaluated, before and after the move, and the correction terms
+!   are updated for every ion whose charge within rc changes. the total
+!   charge, and hence the average density, is unchanged by the moves. the
+!   neighbors are taken from the bins near the moved ions, so the cost is
+!   that of a few neighbor searches and independent of n for a fixed
+!   density.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+
+    real(dp) ::  e_old, e_new, qm_old(2), qm_new(2), r_old(3,2), z_old(2)
+    integer  ::  b, i, p
+!______________________________________________________________________________
+!
+    ! discard the changes of the previous proposal
+    do p = 1, mc%ntouched
+        i = mc%touched(p)
+        mc%dq(i) = 0.0_dp
+        mc%listed(i) = .false.
+    end do
+    mc%ntouched = 0
+
+    ! pair terms involving the moved ions, before and after the move
+    do b = 1, mc%nm
+        r_old(:,b) = mc%r(:,mc%moved(b))
+        z_old(b) = mc%z(mc%moved(b))
+    end do
+    call mc_moved_terms(mc, r_old, z_old, -1.0_dp, e_old, qm_old)
+    call mc_moved_terms(mc, mc%r_new, mc%z_new, 1.0_dp, e_new, qm_new)
+    mc%de = e_new - e_old
+
+    ! correction terms of the ions that were not moved
+    do p = 1, mc%ntouched
+        i = mc%touched(p)
+        if (mc%dq(i) == 0.0_dp) cycle
+        mc%de = mc%de + correction(mc%z(i), mc%q(i) + mc%dq(i)) &
+                      - correction(mc%z(i), mc%q(i))
+    end do
+
+    ! correction terms of the moved ions
+    do b = 1, mc%nm
+        i = mc%moved(b)
+        mc%de = mc%de + correction(mc%z_new(b), qm_new(b)) &
+                      - correction(z_old(b), mc%q(i))
+        call mc_touch(mc, i, qm_new(b) - mc%q(i))
+    end do
+
+contains
+
+    function correction(zi, qi) result(ei)
+        real(dp), intent(in)  ::  zi, qi
+        real(dp) ::  ei, ra
+        ra = (3.0_dp * qi / (4.0_dp * pi * mc%rho))**one_third
+        ei = energy_correction(zi, ra, mc%rho, mc%rd)
+    end function
+
+end subroutine
+
+subroutine mc_moved_terms(mc, rm, zm, sgn, e, qm)
+!______________________________________________________________________________
+!
+!   for the moved ions at positions rm with charges zm (the other ions as in
+!   mc), returns the pair energy of all pairs involving a moved ion (e) and
+!   the charge within rc of each moved ion (qm), and adds sgn times the
+!   charge of the moved ions within rc of each other ion to dq.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    real(dp), intent(in)   ::  rm(3,2), zm(2)
+    real(dp), intent(in)   ::  sgn
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  qm(2)
+
+    real(dp) ::  d(3), rij2, rij, rc2, ei, fi(3), si(6)
+    integer  ::  b, c, k, m
+    type(erfc_table), pointer ::  tab
+!______________________________________________________________________________
+!
+    rc2 = mc%rc * mc%rc
+    nullify(tab)
+    e = 0.0_dp
+    qm(1:mc%nm) = zm(1:mc%nm)  ! b/c the i==j part of the sum is skipped
+
+    ! loop over moved ions
+    do b = 1, mc%nm
+
+        ! pairs of moved ions (in their proposed state), which are visited
+        ! twice and so carry a factor of 1/2
+        do c = 1, mc%nm
+            do k = 1, mc%tl%nt
+                if (c == b .and. k == mc%tl%k0) cycle
+                d = rm(:,b) - (rm(:,c) + mc%tl%t(:,k))
+                rij2 = sum(d * d)
+                if (rij2 > rc2) cycle
+                rij = sqrt(rij2)
+                e = e + 0.5_dp * zm(b) * zm(c) * erfc(rij / mc%rd) / rij
+                qm(b) = qm(b) + zm(c)
+            end do
+        end do
+
+        ! the other ions
+        call mc_gather(mc, rm(:,b), m)
+        mc%zq(1:m) = mc%z(mc%idx(1:m))
+        call pair_terms(m, mc%dx, mc%dy, mc%dz, mc%zq, mc%rd, tab, .false., &
+                        .true., .false., .false., mc%rr, mc%ef, mc%g, &
+                        ei, fi, si)
+        e = e + zm(b) * ei
+        qm(b) = qm(b) + sum(mc%zq(1:m))
+        do k = 1, m
+            call mc_touch(mc, mc%idx(k), sgn * zm(b))
+        end do
+    end do
+
+end subroutine
+
+subroutine mc_gather(mc, rp, m)
+!______________________________________________________________________________
+!
+!   collects the images of the ions that were not moved within rc of the
+!   point rp (inside the cell) into the buffers dx, dy, dz (point minus
+!   image) and idx (source ion), visiting the bins within rc. a bin index
+!   outside the grid maps to a bin inside it and a lattice translation.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    real(dp), intent(in)   ::  rp(3)
+    integer,  intent(out)  ::  m
+
+    real(dp) ::  f(3), t(3), ddx, ddy, ddz, rc2
+    integer  ::  lo(3), hi(3), c1, c2, c3, b1, b2, b3, s1, s2, s3, c, p, &
+                 m1, m2, mm
+!______________________________________________________________________________
+!
+    ! range of bins to visit
+    f = matmul(mc%ainv, rp)
+    lo = floor((f - mc%rf) * mc%nb)
+    hi = floor((f + mc%rf) * mc%nb)
+
+    ! the moved ions are skipped
+    m1 = mc%moved(1)
+    m2 = mc%moved(mc%nm)
+
+    rc2 = mc%rc * mc%rc
+    m = 0
+    do c3 = lo(3), hi(3)
+        b3 = modulo(c3, mc%nb(3))
+        s3 = (c3 - b3) / mc%nb(3)
+    do c2 = lo(2), hi(2)
+        b2 = modulo(c2, mc%nb(2))
+        s2 = (c2 - b2) / mc%nb(2)
+    do c1 = lo(1), hi(1)
+        b1 = modulo(c1, mc%nb(1))
+        s1 = (c1 - b1) / mc%nb(1)
+        t = rp - s1 * mc%a(:,1) - s2 * mc%a(:,2) - s3 * mc%a(:,3)
+
+        ! each image is written to the buffers, and kept (by advancing m)
+        ! if it lies within rc, so the test is not a branch
+        c = b1 + mc%nb(1) * (b2 + mc%nb(2) * b3)
+        do p = c * mc%cap + 1, c * mc%cap + mc%count(c+1)
+            ddx = t(1) - mc%bx(p)
+            ddy = t(2) - mc%by(p)
+            ddz = t(3) - mc%bz(p)
+            mc%dx(m+1) = ddx;  mc%dy(m+1) = ddy;  mc%dz(m+1) = ddz
+            mc%idx(m+1) = mc%bsrc(p)
+            m = m + merge(1, 0, ddx*ddx + ddy*ddy + ddz*ddz <= rc2)
+        end do
+    end do
+    end do
+    end do
+
+    ! drop the moved ions
+    mm = 0
+    do p = 1, m
+        mc%dx(mm+1) = mc%dx(p);  mc%dy(mm+1) = mc%dy(p);  mc%dz(mm+1) = mc%dz(p)
+        mc%idx(mm+1) = mc%idx(p)
+        mm = mm + merge(1, 0, mc%idx(p) /= m1 .and. mc%idx(p) /= m2)
+    end do
+    m = mm
+
+end subroutine
+
+subroutine mc_touch(mc, i, dq)
+!______________________________________________________________________________
+!
+!   adds dq to the change in the charge within rc of ion i, listing i among
+!   the ions changed by the proposal.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    integer,  intent(in)   ::  i
+    real(dp), intent(in)   ::  dq
+!______________________________________________________________________________
+!
+    if (.not. mc%listed(i)) then
+        mc%listed(i) = .true.
+        mc%ntouched = mc%ntouched + 1
+        mc%touched(mc%ntouched) = i
+    end if
+    mc%dq(i) = mc%dq(i) + dq
+
+end subroutine
+
+function mc_bin_coords(mc, r) result(cb)
+!______________________________________________________________________________
+!
+!   returns the bin coordinates (0 to nb-1) of a position inside the cell.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(in)  ::  mc
+    real(dp), intent(in)        ::  r(3)
+    integer                     ::  cb(3)
+!______________________________________________________________________________
+!
+    cb = min(mc%nb - 1, max(0, floor(matmul(mc%ainv, r) * mc%nb)))
+
+end function
+
+function mc_bin(mc, r) result(c)
+!______________________________________________________________________________
+!
+!   returns the index of the bin of a position inside the cell.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(in)  ::  mc
+    real(dp), intent(in)        ::  r(3)
+    integer                     ::  c
+
+    integer ::  cb(3)
+!______________________________________________________________________________
+!
+    cb = mc_bin_coords(mc, r)
+    c = 1 + cb(1) + mc%nb(1) * (cb(2) + mc%nb(2) * cb(3))
+
+end function
+
+subroutine mc_rebin(mc)
+!______________________________________________________________________________
+!
+!   bins all of the ions, with room for twice as many ions as the fullest
+!   bin holds.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+
+    integer  ::  i, c, p, nbins
+!______________________________________________________________________________
+!
+    ! size the bins
+    nbins = product(mc%nb)
+    if (allocated(mc%count)) deallocate(mc%count, mc%bx, mc%by, mc%bz, mc%bsrc)
+    allocate(mc%count(nbins))
+    mc%count = 0
+    do i = 1, mc%n
+        mc%bin(i) = mc_bin(mc, mc%r(:,i))
+        mc%count(mc%bin(i)) = mc%count(mc%bin(i)) + 1
+    end do
+    mc%cap = max(4, 2 * maxval(mc%count))
+    allocate(mc%bx(nbins*mc%cap), mc%by(nbins*mc%cap), mc%bz(nbins*mc%cap), &
+             mc%bsrc(nbins*mc%cap))
+
+    ! fill them
+    mc%count = 0
+    do i = 1, mc%n
+        c = mc%bin(i)
+        mc%count(c) = mc%count(c) + 1
+        p = (c - 1) * mc%cap + mc%count(c)
+        mc%bx(p) = mc%r(1,i);  mc%by(p) = mc%r(2,i);  mc%bz(p) = mc%r(3,i)
+        mc%bsrc(p) = i
+        mc%slot(i) = p
+    end do
+
+end subroutine
+
+subroutine mc_link(mc, i, c)
+!______________________________________________________________________________
+!
+!   adds ion i to bin c, or bins all of the ions again (with larger bins) if
+!   bin c is full.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    integer,  intent(in)   ::  i, c
+
+    integer  ::  p
+!______________________________________________________________________________
+!
+    if (mc%count(c) == mc%cap) then
+        call mc_rebin(mc)
+        return
+    end if
+    mc%count(c) = mc%count(c) + 1
+    p = (c - 1) * mc%cap + mc%count(c)
+    mc%bx(p) = mc%r(1,i);  mc%by(p) = mc%r(2,i);  mc%bz(p) = mc%r(3,i)
+    mc%bsrc(p) = i
+    mc%bin(i) = c
+    mc%slot(i) = p
+
+end subroutine
+
+subroutine mc_unlink(mc, i)
+!______________________________________________________________________________
+!
+!   removes ion i from its bin, moving the last ion of the bin into its slot.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(mc_state), intent(inout)  ::  mc
+    integer,  intent(in)   ::  i
+
+    integer  ::  c, p, last
+!______________________________________________________________________________
+!
+    c = mc%bin(i)
+    p = mc%slot(i)
+    last = (c - 1) * mc%cap + mc%count(c)
+    if (p /= last) then
+        mc%bx(p) = mc%bx(last);  mc%by(p) = mc%by(last);  mc%bz(p) = mc%bz(last)
+        mc%bsrc(p) = mc%bsrc(last)
+        mc%slot(mc%bsrc(p)) = p
+    end if
+    mc%count(c) = mc%count(c) - 1
+
+end subroutine
+
+subroutine site_matrix_init(sm, a1, a2, a3, n, rx, ry, rz, rc, rd)
+!______________________________________________________________________________
+!
+!   tabulates the pair terms of the given geometry, which are independent of
+!   the charges. requires storage for 2*n*n reals.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(site_matrix), intent(out)  ::  sm
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)   ::  n
+    real(dp), intent(in)   ::  rx(n), ry(n), rz(n)
+    real(dp), intent(in)   ::  rc
+    real(dp), intent(in)   ::  rd
+
+    real(dp) ::  rij
+    real(dp), allocatable ::  dx(:), dy(:), dz(:)
+    integer,  allocatable ::  idx(:)
+    integer  ::  i, j, k, m
+    type(cell_list) ::  cl
+!______________________________________________________________________________
+!
+    sm%n = n
+    sm%rd = rd
+    sm%vol = cell_volume(a1, a2, a3)
+    allocate(sm%p(n,n), sm%c(n,n))
+
+    ! bin the periodic images of the ions
+    call build_cell_list(a1, a2, a3, n, rx, ry, rz, rc, cl)
+
+    !$omp parallel num_threads(effective_num_threads()) default(shared) &
+    !$omp     private(i, j, k, m, rij, dx, dy, dz, idx)
+    allocate(dx(cl%nimg), dy(cl%nimg), dz(cl%nimg), idx(cl%nimg))
+
+    ! each ion fills its own column
+    !$omp do schedule(dynamic)
+    do i = 1, n
+        sm%p(:,i) = 0.0_dp
+        sm%c(:,i) = 0.0_dp
+        call gather_neighbors(cl, rx(i), ry(i), rz(i), cl%home(i), rc, &
+                              m, dx, dy, dz, idx)
+        do k = 1, m
+            j = idx(k)
+            rij = sqrt(dx(k)*dx(k) + dy(k)*dy(k) + dz(k)*dz(k))
+            sm%p(j,i) = sm%p(j,i) + erfc(rij / rd) / rij
+            sm%c(j,i) = sm%c(j,i) + 1.0_dp
+        end do
+    end do
+    !$omp end do
+
+    deallocate(dx, dy, dz, idx)
+    !$omp end parallel
+
+end subroutine
+
+subroutine site_matrix_energy(sm, z, e, v, dedz)
+!______________________________________________________________________________
+!
+!   returns the energy for charges z, the potential v(i) of the pair terms at
+!   each ion (so the pair part of the energy is z.v/2), and the derivative of
+!   the energy with respect to each charge. the correction terms, which
+!   depend on the charges through rho and the adaptive cutoffs, are
+!   evaluated exactly.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(site_matrix), intent(in)  ::  sm
+    real(dp), intent(in)   ::  z(sm%n)
+    real(dp), intent(out)  ::  e
+    real(dp), intent(out)  ::  v(sm%n)
+    real(dp), intent(out)  ::  dedz(sm%n)
+
+    real(dp) ::  rho, ra, ra_rd, h, g
+    real(dp), allocatable ::  q(:), w(:), cw(:), e_i(:), r_i(:)
+    integer  ::  i, n
+!______________________________________________________________________________
+!
+    n = sm%n
+    allocate(q(n), w(n), cw(n), e_i(n), r_i(n))
+    rho = sum(z) / sm%vol
+
+    ! potentials and charges within rc (the matrices are symmetric, so each
+    ! row is a contiguous column)
+    !$omp parallel do num_threads(effective_num_threads()) schedule(static)
+    do i = 1, n
+        v(i) = dot_product(sm%p(:,i), z)
+        q(i) = z(i) + dot_product(sm%c(:,i), z)
+    end do
+    !$omp end parallel do
+
+    ! energy and the derivatives of the correction terms. writing the
+    ! correction as zi*rho*h(ra) - zi**2/(sqrt(pi)*rd), with dh/dra =
+    ! -2*pi*ra*erfc(ra/rd) and ra**3 = 3*qi/(4*pi*rho), a change in qi enters
+    ! through w(i) = -zi*erfc(ra/rd)/(2*ra), and a change in rho (which every
+    ! charge shares) through r_i(i) = zi*(h - ra*dh/dra/3) / vol
+    do i = 1, n
+        ra = (3.0_dp * q(i) / (4.0_dp * pi * rho))**one_third
+        ra_rd = ra / sm%rd
+        e_i(i) = 0.5_dp * z(i) * v(i) + energy_correction(z(i), ra, rho, sm%rd)
+        h = - pi * ra * ra + pi * (ra*ra - sm%rd*sm%rd/2.0_dp) * erf(ra_rd) &
+            + sqrt_pi * ra * sm%rd * exp(-ra_rd*ra_rd)
+        g = erfc(ra_rd)
+        w(i) = - z(i) * g / (2.0_dp * ra)
+        r_i(i) = z(i) * (h + 2.0_dp / 3.0_dp * pi * ra * ra * g) / sm%vol
+        dedz(i) = v(i) + rho * h - 2.0_dp / (sqrt_pi * sm%rd) * z(i) + w(i)
+    end do
+    e = sum(e_i)
+
+    ! a change in zk changes the charge within rc of ion k and of its
+    ! neighbors
+    !$omp parallel do num_threads(effective_num_threads()) schedule(static)
+    do i = 1, n
+        cw(i) = dot_product(sm%c(:,i), w)
+    end do
+    !$omp end parallel do
+    dedz = dedz + cw + sum(r_i)
+
+end subroutine
+
+subroutine set_table_tolerance(tol)
+!______________________________________________________________________________
+!
+!   selects how erfc(r/rd) and exp(-(r/rd)**2) are evaluated in the energy,
+!   force, and stress kernels. with tol <= 0 (the default) they are evaluated
+!   exactly; otherwise they are interpolated from cubic tables whose maximum
+!   absolute error in erfc(r/rd) and in 2/sqrt(pi)*(r/rd)*exp(-(r/rd)**2) +
+!   erfc(r/rd) is below tol. tol bounds these functions, not the energy,
+!   forces, or stress. tables are built once per (rd, rc, tol) and are
+!   limited to max_table_intervals, so very small tolerances may not be
+!   reached; get_table_error returns the error actually achieved.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)  ::  tol
+!______________________________________________________________________________
+!
+    table_tol = max(0.0_dp, tol)
+
+end subroutine
+
+subroutine get_erfc_table(rd, rmax, tol, tab)
+!______________________________________________________________________________
+!
+!   points tab to the interpolation tables for rd over [0, rmax] with error
+!   below tol, rebuilding the cached tables if they do not match. the tables
+!   are read in place, so release_erfc_table must be called after use. if
+!   the cached tables are in use with other parameters (by a concurrent
+!   call), tab points to private tables instead.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)  ::  rd, rmax, tol
+    type(erfc_table), pointer, intent(out)  ::  tab
+!______________________________________________________________________________
+!
+    !$omp critical (erfc_table_cache)
+    if (cached_table%rd == rd .and. cached_table%rmax == rmax &
+            .and. cached_table%tol == tol) then
+        tab => cached_table
+    else if (cached_table%users == 0) then
+        call build_erfc_table(rd, rmax, tol, cached_table)
+        tab => cached_table
+    else
+        allocate(tab)
+        call build_erfc_table(rd, rmax, tol, tab)
+    end if
+    tab%users = tab%users + 1
+    table_err = tab%err
+    !$omp end critical (erfc_table_cache)
+
+end subroutine
+
+subroutine release_erfc_table(tab)
+!______________________________________________________________________________
+!
+!   releases tables obtained from get_erfc_table.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(erfc_table), pointer, intent(inout)  ::  tab
+!______________________________________________________________________________
+!
+    !$omp critical (erfc_table_cache)
+    tab%users = tab%users - 1
+    if (.not. associated(tab, cached_table)) deallocate(tab)
+    nullify(tab)
+    !$omp end critical (erfc_table_cache)
+
+end subroutine
+
+function get_table_error() result(err)
+!______________________________________________________________________________
+!
+!   returns the maximum interpolation error of the tables used by the most
+!   recent kernel call (0 if none). this exceeds the tolerance if it could
+!   not be reached within max_table_intervals.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp) ::  err
+!______________________________________________________________________________
+!
+    err = table_err
+
+end function
+
+subroutine build_erfc_table(rd, rmax, tol, tab)
+!______________________________________________________________________________
+!
+!   builds cubic hermite tables (exact values and slopes at the knots),
+!   halving the grid spacing until the error, checked between the knots,
+!   is below tol or the grid reaches max_table_intervals. the error
+!   achieved is stored in tab%err.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)           ::  rd, rmax, tol
+    type(erfc_table), intent(out)  ::  tab
+
+    real(dp) ::  h, x, f0, f1, df0, df1, g0, g1, dg0, dg1, u, fu, gu, &
+                 err, fe, ge
+    integer  ::  k, l
+!______________________________________________________________________________
+!
+    tab%rd = rd
+    tab%rmax = rmax
+    tab%tol = tol
+
+    ! start from a coarse grid and refine
+    h = 0.25_dp * rd
+    do
+        tab%nint = max(1, ceiling(rmax / h))
+        h = max(rmax, tiny(1.0_dp)) / tab%nint
+        tab%inv_h = 1.0_dp / h
+        if (allocated(tab%cf)) deallocate(tab%cf, tab%cg)
+        allocate(tab%cf(0:3,tab%nint+1), tab%cg(0:3,tab%nint+1))
+
+        ! hermite coefficients on each interval (slopes scaled by h). the
+        ! extra interval guards against rounding at r == rmax.
+        do k = 1, tab%nint + 1
+            call erfc_and_slopes((k-1) * h, f0, df0, g0, dg0)
+            call erfc_and_slopes(k * h, f1, df1, g1, dg1)
+            tab%cf(:,k) = hermite(f0, f1, h*df0, h*df1)
+            tab%cg(:,k) = hermite(g0, g1, h*dg0, h*dg1)
+        end do
+
+        ! check the error between the knots
+        err = 0.0_dp
+        do k = 1, tab%nint
+            do l = 1, 3
+                u = 0.25_dp * l
+                x = ((k-1) + u) * h
+                call interpolate_erfc_table(tab, x, fu, gu)
+                call erfc_and_slopes(x, fe, df0, ge, dg0)
+                err = max(err, abs(fu - fe), abs(gu - ge))
+            end do
+        end do
+        if (err <= tol .or. 2 * tab%nint > max_table_intervals) exit
+        h = 0.5_dp * h
+    end do
+    tab%err = err
+
+contains
+
+    subroutine erfc_and_slopes(r, f, df, g, dg)
+        real(dp), intent(in)   ::  r
+        real(dp), intent(out)  ::  f, df, g, dg
+        real(dp) ::  xr, ex
+        xr = r / rd
+        ex = exp(-xr * xr)
+        f = erfc(xr)
+        df = -2.0_dp / (sqrt_pi * rd) * ex
+        g = 2.0_dp / sqrt_pi * xr * ex + f
+        dg = -4.0_dp / (sqrt_pi * rd) * xr * xr * ex
+    end subroutine
+
+    function hermite(p0, p1, m0, m1) result(c)
+        real(dp), intent(in)   ::  p0, p1, m0, m1
+        real(dp) ::  c(0:3)
+        c(0) = p0
+        c(1) = m0
+        c(2) = 3.0_dp * (p1 - p0) - 2.0_dp * m0 - m1
+        c(3) = 2.0_dp * (p0 - p1) + m0 + m1
+    end function
+
+end subroutine
+
+pure subroutine interpolate_erfc_table(tab, r, f, g)
+!______________________________________________________________________________
+!
+!   interpolates erfc(r/rd) (f) and the force/stress factor (g) at r.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(erfc_table), intent(in)  ::  tab
+    real(dp), intent(in)          ::  r
+    real(dp), intent(out)         ::  f, g
+
+    real(dp) ::  t, u
+    integer  ::  k
+!______________________________________________________________________________
+!
+    t = r * tab%inv_h
+    k = min(int(t), tab%nint)
+    u = t - k
+    k = k + 1
+    f = tab%cf(0,k) + u * (tab%cf(1,k) + u * (tab%cf(2,k) + u * tab%cf(3,k)))
+    g = tab%cg(0,k) + u * (tab%cg(1,k) + u * (tab%cg(2,k) + u * tab%cg(3,k)))
+
+end subroutine
+
+subroutine set_stats_enabled(enabled)
+!______________________________________________________________________________
+!
+!   enables or disables the instrumentation counters and timings.
+!______________________________________________________________________________
+!
+    implicit none
+
+    logical, intent(in)  ::  enabled
+!______________________________________________________________________________
+!
+    stats_enabled = enabled
+
+end subroutine
+
+subroutine reset_stats()
+!______________________________________________________________________________
+!
+    implicit none
+!______________________________________________________________________________
+!
+    !$omp critical (stats_update)
+    stats = kernel_stats()
+    !$omp end critical (stats_update)
+
+end subroutine
+
+subroutine add_stats(ncalls, nimages, ncandidates, npairs, &
+                     t_setup, t_pairs, t_correction)
+!______________________________________________________________________________
+!
+!   adds to the accumulated statistics. safe to call from concurrent kernels
+!   (e.g. the frames of a batch), in which case the times are summed.
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer(i8), intent(in), optional  ::  ncalls, nimages, ncandidates, npairs
+    real(dp),    intent(in), optional  ::  t_setup, t_pairs, t_correction
+!______________________________________________________________________________
+!
+    !$omp critical (stats_update)
+    if (present(ncalls)) stats%ncalls = stats%ncalls + ncalls
+    if (present(nimages)) stats%nimages = stats%nimages + nimages
+    if (present(ncandidates)) &
+        stats%ncandidates = stats%ncandidates + ncandidates
+    if (present(npairs)) stats%npairs = stats%npairs + npairs
+    if (present(t_setup)) stats%t_setup = stats%t_setup + t_setup
+    if (present(t_pairs)) stats%t_pairs = stats%t_pairs + t_pairs
+    if (present(t_correction)) &
+        stats%t_correction = stats%t_correction + t_correction
+    !$omp end critical (stats_update)
+
+end subroutine
+
+function wall_time() result(t)
+!______________________________________________________________________________
+!
+!   returns the wall-clock time in seconds (from an arbitrary origin).
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp)     ::  t
+    integer(i8)  ::  count, rate
+!______________________________________________________________________________
+!
+    call system_clock(count, rate)
+    t = real(count, dp) / real(rate, dp)
+
+end function
+
+subroutine set_num_threads(nt)
+!______________________________________________________________________________
+!
+!   sets the number of threads used by the kernels. nt <= 0 restores the
+!   default, which is determined by the OpenMP runtime (e.g. OMP_NUM_THREADS).
+!______________________________________________________________________________
+!
+    implicit none
+
+    integer, intent(in)  ::  nt
+!______________________________________________________________________________
+!
+    num_threads = max(0, nt)
+
+end subroutine
+
+function effective_num_threads() result(nt)
+!______________________________________________________________________________
+!
+!   returns the number of threads the kernels will use (1 without OpenMP).
+!______________________________________________________________________________
+!
+    !$ use omp_lib, only: omp_get_max_threads
+    implicit none
+
+    integer  ::  nt
+!______________________________________________________________________________
+!
+    nt = 1
+    !$ nt = omp_get_max_threads()
+    !$ if (num_threads > 0) nt = num_threads
+
+end function
+
+subroutine build_cell_list(a1, a2, a3, n, rx, ry, rz, rc, cl, first, last)
+!______________________________________________________________________________
+!
+!   bins every periodic image of the ions that can lie within rc of an ion in
+!   the cell. the images are sorted by bin (counting sort), so the contents of
+!   each bin are contiguous in memory. if first and last are present, only
+!   the images that can lie within rc of ions first to last are binned, and
+!   home is set only for those ions. translations that cannot bring any image
+!   near the selected ions are skipped, but every remaining translation is
+!   checked against all n ions, so the cost is not proportional to the range.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)         ::  a1(3), a2(3), a3(3)
+    integer,  intent(in)         ::  n
+    real(dp), intent(in)         ::  rx(:), ry(:), rz(:)
+    real(dp), intent(in)         ::  rc
+    type(cell_list), intent(out) ::  cl
+    integer,  intent(in), optional  ::  first, last
+
+    real(dp) ::  xyz(3), hi(3), span(3), scale, lo_all(3), hi_all(3)
+    real(dp), allocatable ::  tx(:), ty(:), tz(:)
+    integer,  allocatable ::  tsrc(:), tbin(:), thome(:), fill(:)
+    integer  ::  j, k, p, b(3), nbins, ilo, ihi, nt_near
+    logical, allocatable ::  near(:)
+    type(translation_list) ::  tl
+!______________________________________________________________________________
+!
+    ! get the lattice translations whose cells can contain images within rc
+    call get_translation_list(a1, a2, a3, rc, tl)
+
+    ! only images within rc of the bounding box of the (selected) ions are
+    ! needed
+    ilo = 1
+    ihi = n
+    if (present(first)) ilo = first
+    if (present(last)) ihi = last
+    cl%lo = (/minval(rx(ilo:ihi)), minval(ry(ilo:ihi)), &
+              minval(rz(ilo:ihi))/) - rc
+    hi = (/maxval(rx(ilo:ihi)), maxval(ry(ilo:ihi)), &
+           maxval(rz(ilo:ihi))/) + rc
+
+    ! skip the translations that move the bounding box of all the ions
+    ! clear of the box above (for a small range, most of them)
+    lo_all = (/minval(rx(1:n)), minval(ry(1:n)), minval(rz(1:n))/)
+    hi_all = (/maxval(rx(1:n)), maxval(ry(1:n)), maxval(rz(1:n))/)
+    allocate(near(tl%nt))
+    do k = 1, tl%nt
+        near(k) = all(hi_all + tl%t(:,k) >= cl%lo) &
+                  .and. all(lo_all + tl%t(:,k) <= hi)
+    end do
+    nt_near = count(near)
+
+    ! count the images inside the bounding box
+    if (stats_enabled) call add_stats(nimages=int(nt_near, i8)*n)
+    cl%nimg = 0
+    do k = 1, tl%nt
+        if (.not. near(k)) cycle
+        do j = 1, n
+            xyz = tl%t(:,k) + (/rx(j), ry(j), rz(j)/)
+            if (any(xyz < cl%lo) .or. any(xyz > hi)) cycle
+            cl%nimg = cl%nimg + 1
+        end do
+    end do
+
+    ! choose bins of width ~bin_width_rc*rc, but no more bins than images
+    span = hi - cl%lo
+    cl%nb = max(1, floor(span / (bin_width_rc * rc)))
+    if (product(real(cl%nb, dp)) > real(max(cl%nimg, 27), dp)) then
+        scale = (real(max(cl%nimg, 27), dp) / product(real(cl%nb, dp)))**one_third
+        cl%nb = max(1, floor(cl%nb * scale))
+    end if
+    cl%w = span / cl%nb
+    cl%reach = ceiling(rc / cl%w)
+    nbins = product(cl%nb)
+
+    ! store the images (unsorted) with their bins
+    allocate(tx(cl%nimg), ty(cl%nimg), tz(cl%nimg), &
+             tsrc(cl%nimg), tbin(cl%nimg), thome(n))
+    thome = 0
+    p = 0
+    do k = 1, tl%nt
+        if (.not. near(k)) cycle
+        do j = 1, n
+            xyz = tl%t(:,k) + (/rx(j), ry(j), rz(j)/)
+            if (any(xyz < cl%lo) .or. any(xyz > hi)) cycle
+            p = p + 1
+            tx(p) = xyz(1);  ty(p) = xyz(2);  tz(p) = xyz(3)
+            tsrc(p) = j
+            b = min(cl%nb - 1, int((xyz - cl%lo) / cl%w))
+            tbin(p) = 1 + b(1) + cl%nb(1) * (b(2) + cl%nb(2) * b(3))
+            if (k == tl%k0) thome(j) = p
+        end do
+    end do
+
+    ! counting sort of the images by bin
+    allocate(cl%start(nbins+1), fill(nbins))
+    cl%start = 0
+    do p = 1, cl%nimg
+        cl%start(tbin(p)+1) = cl%start(tbin(p)+1) + 1
+    end do
+    cl%start(1) = 1
+    do k = 1, nbins
+        cl%start(k+1) = cl%start(k+1) + cl%start(k)
+    end do
+    allocate(cl%x(cl%nimg), cl%y(cl%nimg), cl%z(cl%nimg), &
+             cl%src(cl%nimg), cl%home(n))
+    cl%home = 0
+    fill = cl%start(1:nbins)
+    do p = 1, cl%nimg
+        k = fill(tbin(p))
+        fill(tbin(p)) = k + 1
+        cl%x(k) = tx(p);  cl%y(k) = ty(p);  cl%z(k) = tz(p)
+        cl%src(k) = tsrc(p)
+        if (p == thome(tsrc(p))) cl%home(tsrc(p)) = k
+    end do
+
+end subroutine
+
+subroutine get_translation_list(a1, a2, a3, rc, tl)
+!______________________________________________________________________________
+!
+!   returns (a copy of) the translation list for the lattice and cutoff,
+!   rebuilding the cached list if it does not match.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)                 ::  a1(3), a2(3), a3(3)
+    real(dp), intent(in)                 ::  rc
+    type(translation_list), intent(out)  ::  tl
+!______________________________________________________________________________
+!
+    !$omp critical (translation_list_cache)
+    if (cached_translations%rc /= rc &
+            .or. any(cached_translations%a(:,1) /= a1) &
+            .or. any(cached_translations%a(:,2) /= a2) &
+            .or. any(cached_translations%a(:,3) /= a3)) then
+        call build_translation_list(a1, a2, a3, rc, cached_translations)
+    end if
+    tl = cached_translations
+    !$omp end critical (translation_list_cache)
+
+end subroutine
+
+subroutine build_translation_list(a1, a2, a3, rc, tl)
+!______________________________________________________________________________
+!
+!   enumerates the translations whose cells can contain images within rc of
+!   an ion in the cell. the parallelepiped of shifts implied by the distances
+!   between lattice planes is pruned to those shifts for which the minimum
+!   distance between the cell and its translation is at most rc.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)                 ::  a1(3), a2(3), a3(3)
+    real(dp), intent(in)                 ::  rc
+    type(translation_list), intent(out)  ::  tl
+
+    real(dp) ::  a(3,3), bt(3,3), g(3,3), d_100, d_010, d_001, t(3), t2, diag
+    integer  ::  k, pass, shift1, shift2, shift3, &
+                 shift1max, shift2max, shift3max
+!______________________________________________________________________________
+!
+    tl%a(:,1) = a1;  tl%a(:,2) = a2;  tl%a(:,3) = a3
+    tl%rc = rc
+
+    ! compute reciprocal lattice vectors
+    a = tl%a
+    call invert_3x3(a, bt)  ! note: bt still missing factor of 2*pi
+
+    ! compute distances between planes (accounts for missing 2*pi in bt)
+    d_100 = 1.0_dp / sqrt(sum(bt(1,:) * bt(1,:)))
+    d_010 = 1.0_dp / sqrt(sum(bt(2,:) * bt(2,:)))
+    d_001 = 1.0_dp / sqrt(sum(bt(3,:) * bt(3,:)))
+
+    ! compute the number of cells to include along each direction
+    shift1max = ceiling(rc / d_100)
+    shift2max = ceiling(rc / d_010)
+    shift3max = ceiling(rc / d_001)
+
+    ! metric tensor, for distances in terms of shifts
+    g = matmul(transpose(a), a)
+
+    ! longest diagonal of the cell
+    diag = sqrt(max(sum((a1 + a2 + a3)**2), sum((a1 + a2 - a3)**2), &
+                    sum((a1 - a2 + a3)**2), sum((-a1 + a2 + a3)**2)))
+
+    ! count the translations in the first pass and store them in the second
+    do pass = 1, 2
+        k = 0
+        do shift3 = -shift3max, shift3max
+        do shift2 = -shift2max, shift2max
+        do shift1 = -shift1max, shift1max
+            t = shift1*a1 + shift2*a2 + shift3*a3
+            t2 = sum(t * t)
+
+            ! cheap bounds on the minimum distance (at most |t|, and at least
+            ! |t| minus the longest cell diagonal) settle most shifts; only
+            ! those in between need the exact minimum
+            if (t2 > rc*rc) then
+                if (sqrt(t2) - diag > rc) cycle
+                if (min_cell_distance2(g, (/shift1, shift2, shift3/)) &
+                        > rc*rc) cycle
+            end if
+            k = k + 1
+            if (pass == 1) cycle
+            tl%shift(:,k) = (/shift1, shift2, shift3/)
+            tl%t(:,k) = t
+            if (shift1==0 .and. shift2==0 .and. shift3==0) tl%k0 = k
+        end do
+        end do
+        end do
+        if (pass == 1) then
+            tl%nt = k
+            allocate(tl%t(3,k), tl%shift(3,k))
+        end if
+    end do
+
+end subroutine
+
+pure function min_cell_distance2(g, shift) result(d2)
+!______________________________________________________________________________
+!
+!   returns the squared minimum distance between the cell and the cell
+!   translated by shift, i.e., the minimum of v.g.v over the box
+!   shift-1 <= v <= shift+1 (in units of the lattice vectors, with metric g).
+!   the quadratic program is solved exactly by trying each combination of
+!   free and bound components.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)   ::  g(3,3)
+    integer,  intent(in)   ::  shift(3)
+
+    real(dp) ::  d2, v(3), lo(3), hi(3), rhs(3), m(3,3), det
+    integer  ::  c, k, state(3), free(3), nf
+!______________________________________________________________________________
+!
+    ! the cell overlaps itself
+    if (all(shift == 0)) then
+        d2 = 0.0_dp
+        return
+    end if
+
+    lo = shift - 1.0_dp
+    hi = shift + 1.0_dp
+    d2 = huge(1.0_dp)
+    do c = 0, 26
+
+        ! each component is free (0), at its lower bound (1), or upper (2)
+        state = (/mod(c, 3), mod(c / 3, 3), c / 9/)
+        nf = 0
+        do k = 1, 3
+            select case (state(k))
+                case (0)
+                    nf = nf + 1
+                    free(nf) = k
+                    v(k) = 0.0_dp
+                case (1)
+                    v(k) = lo(k)
+                case (2)
+                    v(k) = hi(k)
+            end select
+        end do
+
+        ! minimize over the free components (g is positive definite)
+        rhs = -matmul(g, v)
+        select case (nf)
+            case (1)
+                v(free(1)) = rhs(free(1)) / g(free(1),free(1))
+            case (2)
+                m(1:2,1:2) = g(free(1:2),free(1:2))
+                det = m(1,1)*m(2,2) - m(1,2)*m(2,1)
+                v(free(1)) = (m(2,2)*rhs(free(1)) - m(1,2)*rhs(free(2))) / det
+                v(free(2)) = (m(1,1)*rhs(free(2)) - m(2,1)*rhs(free(1))) / det
+            case (3)
+                cycle  ! the unconstrained minimum (v = 0) is excluded above
+        end select
+
+        ! keep the best feasible candidate
+        if (any(v < lo) .or. any(v > hi)) cycle
+        d2 = min(d2, dot_product(v, matmul(g, v)))
+
+    end do
+
+end function
+
+subroutine gather_neighbors(cl, xi, yi, zi, iself, rc, m, dx, dy, dz, idx, nc)
+!______________________________________________________________________________
+!
+!   collects the images within rc of the point (xi, yi, zi) by visiting the
+!   neighboring bins. returns the displacements (point minus image) and the
+!   source ion of each, skipping the image at position iself. if present, nc
+!   returns the number of images tested.
+!______________________________________________________________________________
+!
+    implicit none
+
+    type(cell_list), intent(in)   ::  cl
+    real(dp), intent(in)          ::  xi, yi, zi
+    integer,  intent(in)          ::  iself
+    real(dp), intent(in)          ::  rc
+    integer,  intent(out)         ::  m
+    real(dp), intent(out)         ::  dx(:), dy(:), dz(:)
+    integer,  intent(out)         ::  idx(:)
+    integer,  intent(out), optional  ::  nc
+
+    real(dp) ::  rc2
+    integer  ::  b(3), lo(3), hi(3), b2, b3, p0, p1
+!______________________________________________________________________________
+!
+    ! find the range of bins to visit
+    b = int(((/xi, yi, zi/) - cl%lo) / cl%w)
+    b = max(0, min(cl%nb - 1, b))
+    lo = max(0, b - cl%reach)
+    hi = min(cl%nb - 1, b + cl%reach)
+
+    ! the bins in a row along the first axis hold a contiguous range of
+    ! images, [p0, p1]. the range holding iself is split in two, so that the
+    ! self term is skipped outside the inner loop.
+    rc2 = rc * rc
+    m = 0
+    if (present(nc)) nc = 0
+    do b3 = lo(3), hi(3)
+    do b2 = lo(2), hi(2)
+        p0 = cl%start(1 + lo(1) + cl%nb(1) * (b2 + cl%nb(2) * b3))
+        p1 = cl%start(2 + hi(1) + cl%nb(1) * (b2 + cl%nb(2) * b3)) - 1
+        if (p0 <= iself .and. iself <= p1) then
+            call gather_range(p0, iself - 1)
+            call gather_range(iself + 1, p1)
+        else
+            call gather_range(p0, p1)
+        end if
+    end do
+    end do
+
+contains
+
+    subroutine gather_range(q0, q1)
+        ! tests the images q0 to q1. each is written to the buffers, and kept
+        ! (by advancing m) if it lies within rc, so the test is not a branch.
+        integer, intent(in)  ::  q0, q1
+        real(dp) ::  ddx, ddy, ddz
+        integer  ::  p
+        do p = q0, q1
+            ddx = xi - cl%x(p)
+            ddy = yi - cl%y(p)
+            ddz = zi - cl%z(p)
+            dx(m+1) = ddx;  dy(m+1) = ddy;  dz(m+1) = ddz
+            idx(m+1) = cl%src(p)
+            m = m + merge(1, 0, ddx*ddx + ddy*ddy + ddz*ddz <= rc2)
+        end do
+        if (present(nc)) nc = nc + max(q1 - q0 + 1, 0)
+    end subroutine
+
+end subroutine
+
+pure function energy_correction(zi, ra, rho, rd) result(ei)
+!______________________________________________________________________________
+!
+!   returns the correction terms in the energy of an ion with charge zi and
+!   adaptive cutoff ra, including the self-interaction term.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)   ::  zi, ra, rho, rd
+
+    real(dp) ::  ei
+!______________________________________________________________________________
+!
+    ei = - pi * zi * rho * ra * ra  &
+         + pi * zi * rho * (ra*ra - rd*rd/2.0_dp) * erf(ra/rd)  &
+         + sqrt_pi * zi * rho * ra * rd * exp(-ra*ra/(rd*rd)) &
+         - 1.0/(sqrt_pi * rd) * zi * zi
+
+end function
+
+function cell_volume(a1, a2, a3) result(vol)
+!______________________________________________________________________________
+!
+!   returns the (positive) volume of the cell.
+!______________________________________________________________________________
+!
+    implicit none
+
+    real(dp), intent(in)   ::  a1(3), a2(3), a3(3)
+
+    real(dp) ::  vol
+!______________________________________________________________________________
+!
+    vol = a1(1) * (a2(2)*a3(3) - a2(3)*a3(2)) + &
+          a1(2) * (a2(3)*a3(1) - a2(1)*a3(3)) + &
+          a1(3) * (a2(1)*a3(2) - a2(2)*a3(1))
+    vol = abs(vol) ! for left-handed coordinate systems
+
+end function
+
 subroutine invert_3x3(a, b)
 !______________________________________________________________________________
 !
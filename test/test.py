@@ -20,14 +20,62 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextlib
+import io
+import json
 import numpy as np
 import os
 import sys
+import tempfile
 import unittest
 
 sys.path.append(os.path.join(
         os.path.dirname(os.path.abspath(__file__)), '../python/'))
+import benchmark
+import calculators
 import real_space_electrostatic_sum
+import sharding
+import trajectory
+import tuning
+
+def _structure(name):
+    # (a, loc, chg, h_max) for one of the benchmark structures, with the
+    # lattice vectors as the rows of a and cartesian positions
+    a, frac, chg, h_max = benchmark.structures()[name]
+    return a, frac.dot(a), chg, h_max
+
+def _al():
+    return _structure('Al')
+
+def _si():
+    return _structure('Si')
+
+def _sio2():
+    return _structure('SiO2')
+
+class StubAtoms:
+    """The parts of ase.Atoms that calculators.ASECalculator uses."""
+
+    def __init__(self, cell, positions, charges, pbc=True):
+        self.cell = np.array(cell, dtype=float)
+        self.positions = np.array(positions, dtype=float)
+        self.charges = np.array(charges, dtype=float)
+        self.pbc = np.array(np.broadcast_to(pbc, 3), dtype=bool)
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def get_cell(self):
+        return self.cell.copy()
+
+    def get_positions(self):
+        return self.positions.copy()
+
+    def get_initial_charges(self):
+        return self.charges.copy()
+
+    def copy(self):
+        return StubAtoms(self.cell, self.positions, self.charges, self.pbc)
 
 class TestRealSpaceElectrostaticSum(unittest.TestCase):
 
@@ -267,5 +315,667 @@ class TestRealSpaceElectrostaticSum(unittest.TestCase):
             s_finite_difference = 1.0/volume*(ene_p-ene_m)/(2*d)
             self.assertAlmostEqual(stress[i], s_finite_difference, places=8)
 
+    def test_energy_force_stress(self):
+
+        # strained SiO2
+        a, loc, chg, h_max = _sio2()
+        t = np.eye(3) + np.array([[-0.25,  0.35, -0.15],
+                                  [ 0.35,  0.15,  0.25],
+                                  [-0.15,  0.25, -0.20]])
+        a_1, a_2, a_3 = a.dot(t.T)
+        loc = loc.dot(t.T)
+        r_d_hat = 1.5
+        args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, 3.0*r_d_hat**2*h_max, r_d_hat*h_max)
+
+        # compare fused evaluation with the individual routines
+        e, fx, fy, fz, s = real_space_electrostatic_sum.energy_force_stress(*args)
+        self.assertAlmostEqual(e, real_space_electrostatic_sum.energy(*args),
+                               places=10)
+        f = real_space_electrostatic_sum.force(*args)
+        np.testing.assert_allclose(fx, f[0], rtol=0, atol=1e-10)
+        np.testing.assert_allclose(fy, f[1], rtol=0, atol=1e-10)
+        np.testing.assert_allclose(fz, f[2], rtol=0, atol=1e-10)
+        np.testing.assert_allclose(s, real_space_electrostatic_sum.stress(*args),
+                                   rtol=0, atol=1e-10)
+
+        # unrequested quantities are not returned
+        e, fx, fy, fz, s = real_space_electrostatic_sum.energy_force_stress(
+                *args, compute_energy=False, compute_stress=False)
+        self.assertIsNone(e)
+        self.assertIsNone(s)
+        np.testing.assert_allclose(fx, f[0], rtol=0, atol=1e-10)
+
+    def test_num_threads(self):
+
+        # Si
+        a, loc, chg, h_max = _si()
+        a_1, a_2, a_3 = a
+        loc = np.vstack((loc, np.dot([0.5, 0.1, 0.3], a))) # an extra ion
+        chg = np.append(chg, -2.0)
+        r_d_hat = 2.0
+        args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, 3.0*r_d_hat**2*h_max, r_d_hat*h_max)
+
+        # results are identical for any number of threads
+        try:
+            real_space_electrostatic_sum.set_num_threads(1)
+            self.assertEqual(real_space_electrostatic_sum.get_num_threads(), 1)
+            ref = real_space_electrostatic_sum.energy_force_stress(*args)
+            real_space_electrostatic_sum.set_num_threads(3)
+            res = real_space_electrostatic_sum.energy_force_stress(*args)
+        finally:
+            real_space_electrostatic_sum.set_num_threads(0)
+        self.assertEqual(res[0], ref[0])
+        for i in range(1, 5):
+            np.testing.assert_array_equal(res[i], ref[i])
+
+    def test_neighbor_list(self):
+
+        # SiO2
+        a, loc, chg, h_max = _sio2()
+        a_1, a_2, a_3 = a
+        r_d_hat = 1.0
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+
+        # small random steps reuse the list and match the direct evaluation
+        nl = real_space_electrostatic_sum.NeighborList(skin=1.0)
+        rng = np.random.RandomState(0)
+        for step in range(4):
+            loc = loc + rng.uniform(-0.05, 0.05, loc.shape)
+            args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                    chg, rc, rd)
+            ref = real_space_electrostatic_sum.energy_force_stress(*args)
+            res = nl.energy_force_stress(*args)
+            self.assertAlmostEqual(res[0], ref[0], places=9)
+            for i in range(1, 5):
+                np.testing.assert_allclose(res[i], ref[i], rtol=0, atol=1e-9)
+        self.assertEqual(nl.num_builds, 1)
+
+        # a displacement beyond skin/2 triggers a rebuild
+        loc[0,:] += 0.6
+        args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        self.assertAlmostEqual(nl.energy(*args),
+                               real_space_electrostatic_sum.energy(*args),
+                               places=9)
+        self.assertEqual(nl.num_builds, 2)
+
+        # so does a change of lattice
+        args = (1.01*a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        np.testing.assert_allclose(nl.stress(*args),
+                                   real_space_electrostatic_sum.stress(*args),
+                                   rtol=0, atol=1e-9)
+        self.assertEqual(nl.num_builds, 3)
+
+    def test_energy_force_stress_batch(self):
+
+        # Al, Si, and SiO2 (rattled) packed together
+        structures = [_al(), _si(), _sio2()]
+        a = np.array([x[0] for x in structures])
+        loc = [x[1] for x in structures]
+        loc[2] += np.random.RandomState(0).uniform(-0.1, 0.1, loc[2].shape)
+        chg = [x[2] for x in structures]
+        n = np.array([l.shape[0] for l in loc])
+        h_max = max(x[3] for x in structures)
+        r_d_hat = 1.0
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+
+        # compare with frame-by-frame evaluation
+        pos = np.vstack(loc)
+        e, fx, fy, fz, s = real_space_electrostatic_sum.energy_force_stress_batch(
+                a, n, pos[:,0], pos[:,1], pos[:,2], np.concatenate(chg), rc, rd)
+        for k in range(len(n)):
+            ref = real_space_electrostatic_sum.energy_force_stress(
+                    a[k,0], a[k,1], a[k,2], n[k],
+                    loc[k][:,0], loc[k][:,1], loc[k][:,2], chg[k], rc, rd)
+            i0 = n[:k].sum()
+            self.assertAlmostEqual(e[k], ref[0], places=10)
+            np.testing.assert_allclose(fx[i0:i0+n[k]], ref[1], rtol=0, atol=1e-10)
+            np.testing.assert_allclose(fy[i0:i0+n[k]], ref[2], rtol=0, atol=1e-10)
+            np.testing.assert_allclose(fz[i0:i0+n[k]], ref[3], rtol=0, atol=1e-10)
+            np.testing.assert_allclose(s[k], ref[4], rtol=0, atol=1e-10)
+
+    def test_energy_sweep(self):
+
+        # Si
+        a, loc, chg, h_max = _si()
+        a_1, a_2, a_3 = a
+
+        # unsorted cutoffs, with two values of rd
+        r_d_hat = np.array([2.0, 1.0, 1.5, 1.0, 2.0, 1.5, 0.5])
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        rc[3] = 0.5*rc[3]
+        rd[5] = rd[2]
+        ene = real_space_electrostatic_sum.energy_sweep(
+                a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2], chg,
+                rc, rd)
+        for k in range(len(rc)):
+            ref = real_space_electrostatic_sum.energy(
+                    a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                    chg, rc[k], rd[k])
+            self.assertAlmostEqual(ene[k], ref, places=9)
+        ewald = -8.39857465282205418
+        self.assertAlmostEqual(ene[0], ewald, places=9)
+
+        # scalar rd is shared by all cutoffs
+        ene = real_space_electrostatic_sum.energy_sweep(
+                a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2], chg,
+                rc[:3], rd[0])
+        self.assertAlmostEqual(ene[0], ewald, places=9)
+        self.assertAlmostEqual(ene[2], real_space_electrostatic_sum.energy(
+                a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2], chg,
+                rc[2], rd[0]), places=9)
+
+    def test_table_tolerance(self):
+
+        # SiO2
+        a, loc, chg, h_max = _sio2()
+        a_1, a_2, a_3 = a
+        r_d_hat = 2.0
+        args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, 3.0*r_d_hat**2*h_max, r_d_hat*h_max)
+        ewald_per_ion = -69.48809871723248932 / loc.shape[0]
+
+        # exact evaluation is the default
+        self.assertEqual(real_space_electrostatic_sum.get_table_tolerance(), 0.0)
+        ref = real_space_electrostatic_sum.energy_force_stress(*args)
+
+        # compare tabulated results with the ewald energy and exact forces
+        try:
+            for tol, places in [(1e-6, 5), (1e-10, 9)]:
+                real_space_electrostatic_sum.set_table_tolerance(tol)
+                res = real_space_electrostatic_sum.energy_force_stress(*args)
+                self.assertNotEqual(res[0], ref[0])
+                self.assertAlmostEqual(res[0] / loc.shape[0], ewald_per_ion,
+                                       places=places)
+                for i in range(1, 5):
+                    np.testing.assert_allclose(res[i], ref[i],
+                                               rtol=0, atol=10*tol)
+                self.assertLessEqual(
+                        real_space_electrostatic_sum.get_table_error(), tol)
+
+            # a tolerance the tables cannot reach is reported
+            real_space_electrostatic_sum.set_table_tolerance(1e-30)
+            real_space_electrostatic_sum.energy(*args)
+            self.assertGreater(real_space_electrostatic_sum.get_table_error(),
+                               1e-30)
+        finally:
+            real_space_electrostatic_sum.set_table_tolerance(0.0)
+
+    def test_skewed_cell(self):
+
+        # SiO2
+        a, loc, chg, h_max = _sio2()
+        a_1, a_2, a_3 = a
+        r_d_hat = 1.5
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+
+        # the same crystal described by a highly skewed cell
+        b_1 = a_1
+        b_2 = a_2 + 3.0*a_1
+        b_3 = a_3 - 2.0*a_2 + a_1
+        b = np.vstack((b_1, b_2, b_3)).T
+        x = np.linalg.solve(b, loc.T).T
+        loc_b = b.dot((x - np.floor(x)).T).T # wrap into the skewed cell
+
+        # energies, forces, and stresses do not depend on the description
+        ref = real_space_electrostatic_sum.energy_force_stress(
+                a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        res = real_space_electrostatic_sum.energy_force_stress(
+                b_1, b_2, b_3, loc.shape[0], loc_b[:,0], loc_b[:,1], loc_b[:,2],
+                chg, rc, rd)
+        self.assertAlmostEqual(res[0], ref[0], places=9)
+        for i in range(1, 5):
+            np.testing.assert_allclose(res[i], ref[i], rtol=0, atol=1e-9)
+
+    def test_calculator(self):
+
+        # SiO2 (rattled)
+        a, loc, chg, h_max = _sio2()
+        loc += np.random.RandomState(0).uniform(-0.1, 0.1, loc.shape)
+        r_d_hat = 1.0
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        ref = real_space_electrostatic_sum.energy_force_stress(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+
+        # compare with the module-level function
+        calc = real_space_electrostatic_sum.Calculator(rc, rd)
+        e, f, s = calc.energy_force_stress(a, loc, chg)
+        self.assertAlmostEqual(e, ref[0], places=10)
+        np.testing.assert_allclose(f, np.vstack(ref[1:4]).T, rtol=0, atol=1e-10)
+        np.testing.assert_allclose(s, ref[4], rtol=0, atol=1e-10)
+
+        # internal buffers are reused, out arrays are filled in place
+        self.assertIs(calc.force(a, loc, chg), f)
+        out = np.zeros_like(loc)
+        self.assertIs(calc.force(a, loc, chg, out=out), out)
+        np.testing.assert_allclose(out, f, rtol=0, atol=0)
+        self.assertAlmostEqual(calc.energy(a, loc, chg), ref[0], places=10)
+        with self.assertRaises(ValueError):
+            calc.force(a, loc, chg, out=np.zeros((3, loc.shape[0])))
+
+    def test_cached_calculator(self):
+
+        # SiO2 (rattled)
+        a, loc, chg, h_max = _sio2()
+        loc += np.random.RandomState(0).uniform(-0.1, 0.1, loc.shape)
+        r_d_hat = 1.0
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        e, f, s = real_space_electrostatic_sum.Calculator(
+                rc, rd).energy_force_stress(a, loc, chg)
+        f, s = f.copy(), s.copy()
+
+        # separate requests for one structure cost a single evaluation
+        calc = calculators.CachedCalculator(rc, rd, maxsize=2)
+        self.assertAlmostEqual(calc.energy(a, loc, chg), e, places=10)
+        np.testing.assert_allclose(calc.force(a, loc, chg), f, rtol=0, atol=0)
+        np.testing.assert_allclose(calc.stress(a, loc, chg), s, rtol=0, atol=0)
+        self.assertEqual((calc.cache.hits, calc.cache.misses), (2, 1))
+        with self.assertRaises(ValueError):
+            calc.force(a, loc, chg)[0,0] = 0.0
+
+        # the least recently used structure is evicted
+        loc_1, loc_2 = loc + 0.01, loc + 0.02
+        calc.energy(a, loc_1, chg)
+        calc.energy(a, loc, chg)
+        calc.energy(a, loc_2, chg)  # evicts loc_1
+        self.assertEqual((calc.cache.hits, calc.cache.misses), (4, 3))
+        calc.energy(a, loc, chg)
+        calc.energy(a, loc_1, chg)
+        self.assertEqual((calc.cache.hits, calc.cache.misses), (5, 4))
+        self.assertEqual(len(calc.cache), 2)
+
+    def test_ase_calculator(self):
+
+        # SiO2, in angstrom
+        bohr = 0.5291772105638411
+        a, loc, chg, h_max = _sio2()
+        a, loc = bohr * a, bohr * loc
+        atoms = StubAtoms(a, loc, chg)
+        rc = 3.0*h_max*bohr
+        rd = h_max*bohr
+        calc = calculators.ASECalculator(rc, rd)
+
+        # results are the array interface's, in eV
+        e, f, s = real_space_electrostatic_sum.Calculator(
+                rc, rd).energy_force_stress(a, loc, chg)
+        k = calculators.coulomb_constant
+        self.assertAlmostEqual(calc.get_potential_energy(atoms), k * e,
+                               places=8)
+        np.testing.assert_allclose(calc.get_forces(atoms), k * f,
+                                   rtol=0, atol=1e-8)
+        np.testing.assert_allclose(calc.get_stress(atoms), k * s,
+                                   rtol=0, atol=1e-8)
+
+        # an unchanged structure (or a copy) reuses the results, a changed
+        # one does not, and charges given to the calculator take precedence
+        self.assertFalse(calc.calculation_required(atoms.copy(), ['energy']))
+        calc.get_forces(atoms.copy())
+        self.assertEqual(calc.calc.cache.misses, 1)
+        moved = atoms.copy()
+        moved.positions[0] += 0.1
+        self.assertTrue(calc.calculation_required(moved, ['energy']))
+        self.assertNotAlmostEqual(calc.get_potential_energy(moved),
+                                  k * e, places=6)
+        self.assertEqual(calc.calc.cache.misses, 2)
+        calc = calculators.ASECalculator(rc, rd, charges=chg)
+        self.assertAlmostEqual(
+                calc.get_potential_energy(StubAtoms(a, loc, 0.0 * chg)),
+                k * e, places=8)
+
+        # only fully periodic cells are supported
+        slab = StubAtoms(a, loc, chg, pbc=[True, True, False])
+        with self.assertRaises(ValueError):
+            calculators.ASECalculator(rc, rd).get_potential_energy(slab)
+
+    def test_monte_carlo(self):
+
+        # SiO2
+        a, loc, chg, h_max = _sio2()
+        r_d_hat = 0.5
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        def energy(loc, chg):
+            return real_space_electrostatic_sum.energy(
+                    a[0], a[1], a[2], loc.shape[0],
+                    loc[:,0], loc[:,1], loc[:,2], chg, rc, rd)
+        mc = real_space_electrostatic_sum.MonteCarlo(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        self.assertAlmostEqual(mc.energy, energy(loc, chg), places=10)
+
+        # each energy change matches a full evaluation
+        rng = np.random.RandomState(0)
+        inv_a = np.linalg.inv(a)
+        for step in range(20):
+            e_old = energy(loc, chg)
+            new_loc, new_chg = loc.copy(), chg.copy()
+            if step % 2 == 0:
+                k = rng.randint(loc.shape[0])
+                new_loc[k] += rng.uniform(-1.0, 1.0, 3)
+                de = mc.propose_move(k, new_loc[k])
+                new_loc[k] = (new_loc[k].dot(inv_a) % 1.0).dot(a) # wrap
+            else:
+                k, l = rng.randint(6), rng.randint(6, 9) # O and Si
+                de = mc.propose_swap(k, l)
+                new_chg[[k, l]] = new_chg[[l, k]]
+            self.assertAlmostEqual(de, energy(new_loc, new_chg) - e_old,
+                                   places=9)
+            if step % 3 != 2: # reject every third proposal
+                mc.accept()
+                loc, chg = new_loc, new_chg
+        self.assertAlmostEqual(mc.energy, energy(loc, chg), places=9)
+
+        # positions outside the cell are mapped into it
+        shifted = loc + a[0] - 2.0 * a[2]
+        mc = real_space_electrostatic_sum.MonteCarlo(
+                a[0], a[1], a[2], loc.shape[0],
+                shifted[:,0], shifted[:,1], shifted[:,2], chg, rc, rd)
+        self.assertAlmostEqual(mc.energy, energy(loc, chg), places=9)
+        new_loc = loc.copy()
+        new_loc[0] += np.array([0.3, -0.2, 0.1])
+        self.assertAlmostEqual(mc.propose_move(0, new_loc[0] - a[1]),
+                               energy(new_loc, chg) - energy(loc, chg),
+                               places=9)
+
+        # ion indices are checked
+        for k in (-1, loc.shape[0]):
+            self.assertRaises(ValueError, mc.propose_move, k, loc[0])
+            self.assertRaises(ValueError, mc.propose_swap, 0, k)
+
+        # a supercell, binned along each direction, in which ions are
+        # gathered into one bin until it overflows
+        a = a * np.array([[3.0], [3.0], [2.0]])
+        loc = np.concatenate([loc + i*a[0]/3 + j*a[1]/3 + k*a[2]/2
+                              for i in range(3) for j in range(3)
+                              for k in range(2)])
+        chg = np.tile(chg, 18)
+        mc = real_space_electrostatic_sum.MonteCarlo(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        for k in range(0, 120, 8):
+            new_loc = loc.copy()
+            new_loc[k] = np.array([1.0, 1.0, 1.0]) + 0.3 * rng.uniform(size=3)
+            self.assertAlmostEqual(mc.propose_move(k, new_loc[k]),
+                                   energy(new_loc, chg) - energy(loc, chg),
+                                   places=8)
+            mc.accept()
+            loc = new_loc
+        self.assertAlmostEqual(mc.energy, energy(loc, chg), places=8)
+
+    def test_site_matrix(self):
+
+        # SiO2
+        a, loc, chg, h_max = _sio2()
+        r_d_hat = 1.5
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        geometry = (a[0], a[1], a[2], loc.shape[0],
+                    loc[:,0], loc[:,1], loc[:,2])
+        sm = real_space_electrostatic_sum.SiteMatrix(*geometry, rc, rd)
+
+        # energies and derivatives for perturbed charges match full evaluations
+        rng = np.random.RandomState(0)
+        h = 1e-3
+        for trial in range(3):
+            z = chg * (1.0 + 0.1 * rng.standard_normal(chg.shape[0]))
+            e, v, dedz = sm.evaluate(z)
+            self.assertAlmostEqual(e, real_space_electrostatic_sum.energy(
+                    *geometry, z, rc, rd), places=9)
+            for k in range(z.shape[0]):
+                dz = h * np.eye(z.shape[0])[k]
+                de = (real_space_electrostatic_sum.energy(
+                          *geometry, z + dz, rc, rd)
+                      - real_space_electrostatic_sum.energy(
+                          *geometry, z - dz, rc, rd)) / (2.0 * h)
+                self.assertAlmostEqual(dedz[k], de, places=6)
+
+    def test_tuning(self):
+
+        # Si
+        a, loc, chg, h_max = _si()
+        ewald = -8.39857465282205418
+
+        # tuned cutoffs meet the target, and are cheaper for looser targets
+        tuning.clear_cache()
+        rc_loose, rd_loose = tuning.tune(a, loc, chg, energy_tol=1e-4)
+        rc, rd = tuning.tune(a, loc, chg, energy_tol=1e-8)
+        self.assertLess(rc_loose, rc)
+        ene = real_space_electrostatic_sum.energy(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        self.assertLess(abs(ene - ewald), 1e-8)
+
+        # the result is cached per cell shape, including rotated cells
+        rot = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        self.assertEqual(tuning.tune(a.dot(rot), loc.dot(rot), chg,
+                                     energy_tol=1e-8), (rc, rd))
+        self.assertEqual(len(tuning._cache), 2)
+
+        # force and stress targets
+        rc, rd = tuning.tune(a, loc, chg, force_tol=1e-6, stress_tol=1e-6)
+        ref = real_space_electrostatic_sum.stress(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, 3.0*2.0**2*h_max, 2.0*h_max)
+        s = real_space_electrostatic_sum.stress(
+                a[0], a[1], a[2], loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, rc, rd)
+        np.testing.assert_allclose(s, ref, rtol=0, atol=1e-6)
+        with self.assertRaises(ValueError):
+            tuning.tune(a, loc, chg)
+
+    def test_benchmark(self):
+
+        # a skewed supercell has the same ions and energy as the primitive cell
+        a, frac, z, h_max = benchmark.structures()['Si']
+        a_2, r_2, z_2 = benchmark.supercell(a, frac, z, 2, skew=1)
+        self.assertEqual(r_2.shape, (16, 3))
+        self.assertAlmostEqual(abs(np.linalg.det(a_2)),
+                               8.0 * abs(np.linalg.det(a)), places=8)
+        calc = real_space_electrostatic_sum.Calculator(
+                3.0*2.0**2*h_max, 2.0*h_max)
+        self.assertAlmostEqual(calc.energy(a_2, r_2, z_2) / 8.0,
+                               -8.39857465282205418, places=8)
+
+        # the suite writes machine-readable results
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.json')
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                benchmark.main(['--structures', 'Si', '--sizes', '1',
+                                '--r-d-hat', '1.0', '--skew', '0',
+                                '--threads', '1', '--repeat', '1', '-o', path])
+            with open(path) as f:
+                results = json.load(f)['results']
+        self.assertEqual([r['quantity'] for r in results],
+                         list(benchmark.quantities))
+        for r in results:
+            self.assertGreater(r['wall_time_min'], 0.0)
+            self.assertGreater(r['pairs_per_second'], 0.0)
+            self.assertGreater(r['peak_rss_mb'], 0.0)
+
+    def test_energy_force_stress_f32(self):
+
+        # strained SiO2
+        a, loc, chg, h_max = _sio2()
+        t = np.eye(3) + np.array([[-0.25,  0.35, -0.15],
+                                  [ 0.35,  0.15,  0.25],
+                                  [-0.15,  0.25, -0.20]])
+        a_1, a_2, a_3 = a.dot(t.T)
+        loc = loc.dot(t.T)
+        r_d_hat = 1.5
+        args = (a_1, a_2, a_3, loc.shape[0], loc[:,0], loc[:,1], loc[:,2],
+                chg, 3.0*r_d_hat**2*h_max, r_d_hat*h_max)
+
+        # compare with double precision, to about 1e-6 relative error
+        e, fx, fy, fz, s = real_space_electrostatic_sum.energy_force_stress(*args)
+        e_32, fx_32, fy_32, fz_32, s_32 = \
+                real_space_electrostatic_sum.energy_force_stress_f32(*args)
+        self.assertEqual(fx_32.dtype, np.float32)
+        self.assertEqual(s_32.dtype, np.float32)
+        self.assertLess(abs(e_32 - e), 1e-5 * abs(e))
+        f = np.array((fx, fy, fz))
+        f_32 = np.array((fx_32, fy_32, fz_32))
+        self.assertLess(np.abs(f_32 - f).max(), 1e-5 * np.abs(f).max())
+        self.assertLess(np.abs(s_32 - s).max(), 1e-5 * np.abs(s).max())
+
+    def test_stats(self):
+
+        # Si
+        a, loc, chg, h_max = _si()
+        rc, rd = 3.0*2.0**2*h_max, 2.0*h_max
+        calc = real_space_electrostatic_sum.Calculator(rc, rd)
+
+        # nothing is recorded while disabled
+        real_space_electrostatic_sum.reset_stats()
+        calc.energy(a, loc, chg)
+        self.assertTrue(all(v == 0 for v in
+                            real_space_electrostatic_sum.get_stats().values()))
+
+        # the accepted pairs match a brute-force count
+        real_space_electrostatic_sum.set_stats_enabled(True)
+        try:
+            e = calc.energy(a, loc, chg)
+            stats = real_space_electrostatic_sum.get_stats()
+        finally:
+            real_space_electrostatic_sum.set_stats_enabled(False)
+        self.assertAlmostEqual(e, -8.39857465282205418, places=9)
+        m = int(np.ceil(rc / 4.0)) + 1
+        shifts = np.array(np.meshgrid(*[np.arange(-m, m+1)]*3)).reshape(3, -1).T
+        d = (loc[:,None,None,:] - loc[None,:,None,:]
+                - shifts.dot(a)[None,None,:,:])
+        d = np.sqrt((d**2).sum(axis=-1))
+        self.assertEqual(stats['num_pairs'], np.sum((d > 0) & (d <= rc)))
+        self.assertEqual(stats['num_calls'], 1)
+        self.assertGreaterEqual(stats['num_candidates'], stats['num_pairs'])
+        self.assertGreater(stats['num_images'], 0)
+        for key in ['setup_time', 'pair_time', 'correction_time']:
+            self.assertGreaterEqual(stats[key], 0.0)
+        real_space_electrostatic_sum.reset_stats()
+        self.assertEqual(real_space_electrostatic_sum.get_stats()['num_pairs'], 0)
+
+    def test_sharding(self):
+
+        # SiO2 slab: a 2x2x1 supercell with vacuum along the c axis
+        a, frac, chg, h_max = benchmark.structures()['SiO2']
+        a, loc, chg = benchmark.supercell(a, frac, chg, 2)
+        a[2] *= 1.5
+        rc, rd = 20.0, 8.0
+        n = loc.shape[0]
+        ref = real_space_electrostatic_sum.energy_force_stress(
+                a[0], a[1], a[2], n, loc[:,0], loc[:,1], loc[:,2], chg,
+                rc, rd)
+
+        # ranges that partition the ions sum to the totals
+        e, f, s = 0.0, [], np.zeros(6)
+        for i0, i1 in [(0, 7), (7, 7), (7, 40), (40, n)]:
+            part = real_space_electrostatic_sum.energy_force_stress_range(
+                    a[0], a[1], a[2], n, loc[:,0], loc[:,1], loc[:,2], chg,
+                    rc, rd, i0, i1)
+            e += part[0]
+            f.append(np.vstack(part[1:4]))
+            s += part[4]
+        self.assertAlmostEqual(e, ref[0], places=10)
+        np.testing.assert_allclose(np.hstack(f), np.vstack(ref[1:4]),
+                                   rtol=0, atol=1e-10)
+        np.testing.assert_allclose(s, ref[4], rtol=0, atol=1e-10)
+
+        # ranges outside the ions are rejected
+        for i0, i1 in [(0, n + 1), (-2, n), (5, 3)]:
+            with self.assertRaises(ValueError):
+                real_space_electrostatic_sum.energy_force_stress_range(
+                        a[0], a[1], a[2], n, loc[:,0], loc[:,1], loc[:,2],
+                        chg, rc, rd, i0, i1)
+
+        # the pool matches, including after rebalancing and a change of n
+        with sharding.ShardedEvaluator(num_workers=2) as pool:
+            for _ in range(2):
+                e, f, s = pool.energy_force_stress(a, loc, chg, rc, rd)
+                self.assertAlmostEqual(e, ref[0], places=10)
+                np.testing.assert_allclose(f, np.vstack(ref[1:4]).T,
+                                           rtol=0, atol=1e-10)
+                np.testing.assert_allclose(s, ref[4], rtol=0, atol=1e-10)
+            calc = real_space_electrostatic_sum.Calculator(rc, rd)
+            self.assertAlmostEqual(pool.energy(a, loc[:9], chg[:9], rc, rd),
+                                   calc.energy(a, loc[:9], chg[:9]),
+                                   places=10)
+
+    def test_trajectory(self):
+
+        # rattled and strained SiO2 frames
+        a, loc, chg, h_max = _sio2()
+        rng = np.random.RandomState(0)
+        frames = [(a * (1.0 + 0.01 * k),
+                   loc * (1.0 + 0.01 * k) + rng.uniform(-0.1, 0.1, loc.shape),
+                   chg) for k in range(7)]
+        r_d_hat = 1.0
+        rc = 3.0*r_d_hat**2*h_max
+        rd = r_d_hat*h_max
+        calc = real_space_electrostatic_sum.Calculator(rc, rd)
+        ref = [[np.copy(x) for x in calc.energy_force_stress(*frame)]
+               for frame in frames]
+
+        with tempfile.TemporaryDirectory() as tmp:
+
+            # write the frames in both formats (charges in a column)
+            xyz = os.path.join(tmp, 'frames.xyz')
+            with open(xyz, 'w') as f:
+                for a_k, r_k, z_k in frames:
+                    f.write('{}\nLattice="{}" '
+                            'Properties=species:S:1:pos:R:3:charge:R:1\n'
+                            .format(z_k.shape[0],
+                                    ' '.join(map(repr, a_k.ravel().tolist()))))
+                    for r_i, z_i in zip(r_k.tolist(), z_k.tolist()):
+                        f.write('X {!r} {!r} {!r} {!r}\n'.format(*r_i, z_i))
+            binary = os.path.join(tmp, 'frames.bin')
+            with open(binary, 'wb') as f:
+                for a_k, r_k, _ in frames:
+                    f.write(np.concatenate((a_k.ravel(), r_k.ravel()))
+                            .astype('<f8').tobytes())
+
+            # the generator yields one result per frame
+            results = list(trajectory.evaluate(
+                    trajectory.read_extxyz(xyz), rc, rd, chunk_size=3))
+            self.assertEqual(len(results), len(frames))
+            for (e, f, s), (e_ref, f_ref, s_ref) in zip(results, ref):
+                self.assertAlmostEqual(e, e_ref, places=10)
+                np.testing.assert_allclose(f, f_ref, rtol=0, atol=1e-10)
+                np.testing.assert_allclose(s, s_ref, rtol=0, atol=1e-10)
+
+            # an interrupted run is resumed, and both formats give the same
+            # memory-mapped results
+            out_xyz = os.path.join(tmp, 'out_xyz')
+            self.assertEqual(trajectory.run(xyz, out_xyz, rc, rd,
+                                            chunk_size=2, max_frames=3), 3)
+            self.assertEqual(trajectory.run(xyz, out_xyz, rc, rd,
+                                            chunk_size=2, resume=True), 4)
+            out_bin = os.path.join(tmp, 'out_bin')
+            trajectory.run(binary, out_bin, rc, rd, chg, binary=True)
+            for out in (out_xyz, out_bin):
+                e = np.load(os.path.join(out, 'energies.npy'), mmap_mode='r')
+                f = np.load(os.path.join(out, 'forces.npy'), mmap_mode='r')
+                s = np.load(os.path.join(out, 'stresses.npy'), mmap_mode='r')
+                np.testing.assert_allclose(e, [x[0] for x in ref],
+                                           rtol=0, atol=1e-10)
+                np.testing.assert_allclose(f, [x[1] for x in ref],
+                                           rtol=0, atol=1e-10)
+                np.testing.assert_allclose(s, [x[2] for x in ref],
+                                           rtol=0, atol=1e-10)
+                del e, f, s
+
+            # resuming with different cutoffs is an error
+            with self.assertRaises(ValueError):
+                trajectory.run(xyz, out_xyz, rc, 0.5 * rd, resume=True)
+
 if __name__ == '__main__':
     unittest.main()